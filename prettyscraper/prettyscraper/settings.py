@@ -16,6 +16,10 @@ import os
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
 
+# Where the database and downloads are kept. The Docker image points it at a
+# volume that the web and crawl_worker containers share.
+DATA_DIR = Path(os.environ.get('PRETTYSCRAPER_DATA_DIR', BASE_DIR))
+
 
 # Quick-start development settings - unsuitable for production
 # See https://docs.djangoproject.com/en/5.1/howto/deployment/checklist/
@@ -80,7 +84,24 @@ WSGI_APPLICATION = "prettyscraper.wsgi.application"
 DATABASES = {
     "default": {
         "ENGINE": "django.db.backends.sqlite3",
-        "NAME": BASE_DIR / "db.sqlite3",
+        "NAME": DATA_DIR / "db.sqlite3",
+        # WAL lets the status and download views read while a crawl writes,
+        # synchronous=NORMAL is safe with WAL and skips an fsync per commit.
+        "OPTIONS": {
+            "init_command": (
+                # Lets prune_data return freed pages to the filesystem. Only takes effect
+                # on a new database, hence before WAL, or after prune_data --full-vacuum.
+                "PRAGMA auto_vacuum=INCREMENTAL;"
+                "PRAGMA journal_mode=WAL;"
+                "PRAGMA synchronous=NORMAL;"
+                "PRAGMA cache_size=-20000;"
+                "PRAGMA temp_store=MEMORY;"
+            ),
+            "transaction_mode": "IMMEDIATE",
+            "timeout": 20,
+        },
+        # The distributed crawl tests fork worker processes, which can not share an in-memory database.
+        "TEST": {"NAME": DATA_DIR / "test_db.sqlite3"},
     }
 }
 
@@ -130,5 +151,176 @@ STATICFILES_DIRS = [
 
 DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 
-MEDIA_ROOT = os.path.join(BASE_DIR, 'downloads')
-MEDIA_URL = '/downloads/'
\ No newline at end of file
+MEDIA_ROOT = os.path.join(DATA_DIR, 'downloads')
+MEDIA_URL = '/downloads/'
+
+# Scraper settings.
+
+# Maximum number of page fetches in flight during one crawl.
+SCRAPER_CONCURRENCY = 8
+
+# Maximum number of page fetches in flight against a single host.
+SCRAPER_PER_HOST_CONCURRENCY = 4
+
+# Distributed crawls keep their frontier in the database, so that every
+# crawl_worker (on this host or another one sharing the database) works on
+# them together. Workers lease SCRAPER_CLAIM_BATCH URLs at a time for
+# SCRAPER_LEASE_SECONDS, renewing the leases while they hold them. URLs of a
+# worker that died are claimed again once their lease expires, up to
+# SCRAPER_LEASE_ATTEMPTS times. The concurrency and per-host rate limits
+# apply to each worker.
+SCRAPER_DISTRIBUTED = False
+SCRAPER_CLAIM_BATCH = 32
+SCRAPER_LEASE_SECONDS = 120
+SCRAPER_LEASE_ATTEMPTS = 3
+# Seconds a worker waits before looking for work again when none was left to claim.
+SCRAPER_FRONTIER_POLL = 0.5
+
+# A crawl_worker running a job writes a heartbeat to it with its progress. A
+# job that is not distributed and has had no heartbeat for
+# SCRAPER_JOB_STALE_SECONDS lost its worker: the next idle worker queues it
+# again, or fails it once it was claimed SCRAPER_JOB_ATTEMPTS times.
+SCRAPER_JOB_STALE_SECONDS = 300
+SCRAPER_JOB_ATTEMPTS = 3
+
+# Visited set used to fetch each URL once per crawl: 'exact' keeps every URL in
+# memory, 'bloom' uses a fixed size Bloom filter for very large crawls.
+SCRAPER_VISITED_SET = 'exact'
+SCRAPER_BLOOM_CAPACITY = 1_000_000
+SCRAPER_BLOOM_ERROR_RATE = 0.001
+
+# Sort query parameters when canonicalizing URLs.
+SCRAPER_SORT_QUERY = False
+
+# HTTP client used by crawls: timeouts in seconds, retries on connection errors
+# and 500/502/504 responses with exponential backoff. 429 and 503 responses are
+# not retried, they back off the whole host, see the politeness settings below.
+SCRAPER_CONNECT_TIMEOUT = 5
+SCRAPER_READ_TIMEOUT = 15
+SCRAPER_MAX_RETRIES = 2
+SCRAPER_RETRY_BACKOFF = 0.5
+SCRAPER_USER_AGENT = 'PrettyScraper'
+
+# Per-host politeness: every host gets at most SCRAPER_HOST_RATE requests per
+# second on average, in bursts of up to SCRAPER_HOST_BURST (None uses the
+# per-host concurrency). robots.txt rules and its Crawl-delay are honoured when
+# SCRAPER_OBEY_ROBOTS is on. Hosts answering 429 or 503 are left alone for
+# their Retry-After, or an exponential delay capped at SCRAPER_MAX_BACKOFF
+# seconds, and the page is tried up to SCRAPER_THROTTLE_RETRIES more times.
+SCRAPER_HOST_RATE = 5.0
+SCRAPER_HOST_BURST = None
+SCRAPER_OBEY_ROBOTS = True
+SCRAPER_THROTTLE_RETRIES = 3
+SCRAPER_MAX_BACKOFF = 60
+
+# Links a crawl follows: 'domain' (the root's host and its subdomains), 'host'
+# (exactly the root's host), 'prefix' (the root's host, under its path) or
+# 'any'. URLs must match one of SCRAPER_SCOPE_INCLUDE (when not empty) and none
+# of SCRAPER_SCOPE_EXCLUDE (regexes), and use one of SCRAPER_SCOPE_SCHEMES.
+# A crawl stops after storing SCRAPER_MAX_PAGES pages or downloading
+# SCRAPER_MAX_BYTES bytes of pages, None for no limit.
+SCRAPER_SCOPE = 'domain'
+SCRAPER_SCOPE_INCLUDE = ()
+SCRAPER_SCOPE_EXCLUDE = ()
+SCRAPER_SCOPE_SCHEMES = ('http', 'https')
+SCRAPER_MAX_PAGES = None
+SCRAPER_MAX_BYTES = None
+
+# Persistent HTTP response cache shared by all crawls. Responses without
+# max-age are served for SCRAPER_HTTP_CACHE_DEFAULT_FRESHNESS seconds, then
+# revalidated; entries are dropped after SCRAPER_HTTP_CACHE_TTL seconds and
+# least recently used bodies are evicted past SCRAPER_HTTP_CACHE_MAX_BYTES.
+SCRAPER_HTTP_CACHE = True
+SCRAPER_HTTP_CACHE_DIR = os.path.join(MEDIA_ROOT, 'http_cache')
+SCRAPER_HTTP_CACHE_MAX_BYTES = 512 * 1024 * 1024
+SCRAPER_HTTP_CACHE_TTL = 7 * 24 * 3600
+SCRAPER_HTTP_CACHE_DEFAULT_FRESHNESS = 300
+
+# Processes of the pool that renders PDF downloads, shared by every download
+# (None uses every available core, 1 renders in the request's own process), and
+# seconds after which one page is given up on. CSV and JSON are rendered in place.
+SCRAPER_EXPORT_PROCESSES = None
+SCRAPER_EXPORT_PAGE_TIMEOUT = 60
+
+# Cache of rendered download files, keyed by page content, download type and
+# template version, evicted least recently used first past the size limit.
+SCRAPER_ARTIFACT_CACHE = True
+SCRAPER_ARTIFACT_CACHE_DIR = os.path.join(MEDIA_ROOT, 'artifacts')
+SCRAPER_ARTIFACT_CACHE_MAX_BYTES = 1024 * 1024 * 1024
+
+# zlib level used to compress page bodies stored in PageBlob.
+SCRAPER_BLOB_COMPRESSION_LEVEL = 6
+
+# Crawled pages are written in bulk every SCRAPER_WRITE_BATCH_SIZE pages or
+# SCRAPER_WRITE_FLUSH_MS milliseconds, whichever comes first.
+SCRAPER_WRITE_BATCH_SIZE = 100
+SCRAPER_WRITE_FLUSH_MS = 500
+
+# Re-scraping a root URL the same user crawled before revalidates the pages of
+# that crawl (ETag, Last-Modified, then content hash) and only writes the pages
+# that were added, changed or removed. False stores every crawl from scratch.
+SCRAPER_INCREMENTAL = True
+
+# Store only the main readable text of crawled pages (headings, paragraphs,
+# lists and links) instead of the full HTML with its scripts, styles and
+# navigation. Crawls can choose either way, this is the default.
+SCRAPER_EXTRACT_MAIN_TEXT = False
+
+# Backend extracting titles and links from crawled pages: 'lxml' (default,
+# falls back to 'soup' when lxml is not installed), 'stream' or 'soup'.
+SCRAPER_PARSER = 'lxml'
+
+# Largest page body downloaded, in bytes. Bigger responses are abandoned.
+SCRAPER_MAX_BODY_BYTES = 5 * 1024 * 1024
+
+# Links ending in one of these extensions are probed with a HEAD request and
+# skipped when they are not HTML. Set to () to disable probing.
+SCRAPER_PROBE_EXTENSIONS = (
+    '.pdf', '.zip', '.gz', '.tgz', '.tar', '.rar', '.7z', '.exe', '.dmg', '.iso', '.apk',
+    '.jpg', '.jpeg', '.png', '.gif', '.webp', '.svg', '.ico', '.bmp', '.tif', '.tiff',
+    '.mp3', '.wav', '.ogg', '.flac', '.mp4', '.m4v', '.mov', '.avi', '.mkv', '.webm',
+    '.doc', '.docx', '.xls', '.xlsx', '.ppt', '.pptx', '.csv', '.json', '.xml',
+)
+
+# The job events stream (Server-Sent Events) reads the rows of all watched jobs
+# in one query every SCRAPER_EVENTS_INTERVAL seconds, shared by all clients,
+# and sends a keepalive comment after SCRAPER_EVENTS_KEEPALIVE seconds without progress.
+SCRAPER_EVENTS_INTERVAL = 1.0
+SCRAPER_EVENTS_KEEPALIVE = 15.0
+
+# The prune_data command deletes finished crawls SCRAPER_RETENTION_CRAWL_TTL
+# seconds after they finish, and the oldest ones of a user keeping more than
+# SCRAPER_RETENTION_MAX_CRAWLS crawls or SCRAPER_RETENTION_MAX_PAGES pages (the
+# newest crawl is always kept). Users without a crawl for
+# SCRAPER_RETENTION_USER_TTL seconds are deleted with their data. None disables
+# a limit. Rows are deleted SCRAPER_RETENTION_BATCH_SIZE at a time, pausing
+# SCRAPER_RETENTION_PAUSE seconds between transactions, and freed space is
+# returned to the filesystem SCRAPER_RETENTION_VACUUM_PAGES pages at a time.
+SCRAPER_RETENTION_CRAWL_TTL = 30 * 24 * 3600
+SCRAPER_RETENTION_USER_TTL = 90 * 24 * 3600
+SCRAPER_RETENTION_MAX_CRAWLS = 20
+SCRAPER_RETENTION_MAX_PAGES = None
+SCRAPER_RETENTION_BATCH_SIZE = 500
+SCRAPER_RETENTION_PAUSE = 0.05
+SCRAPER_RETENTION_VACUUM_PAGES = 1000
+
+# Crawl workers write their metrics here for the /scraper/metrics view to add up.
+SCRAPER_METRICS_DIR = os.path.join(MEDIA_ROOT, 'metrics')
+
+# Scraper log messages go to the console. Per-page messages are logged at
+# DEBUG, set SCRAPER_LOG_LEVEL=DEBUG in the environment to see them.
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+        },
+    },
+    'loggers': {
+        'scraper': {
+            'handlers': ['console'],
+            'level': os.environ.get('SCRAPER_LOG_LEVEL', 'INFO'),
+        },
+    },
+}
@@ -0,0 +1,393 @@
+'''
+Crawl and download benchmark on a synthetic site.
+
+SyntheticSite serves a generated link tree from a local HTTP server, with
+configurable fan-out, depth, page size, latency, error rate and links back up
+the tree. run_benchmark drives the real code paths against it: the scrape view
+queues a job, a worker runs it, and the download view streams every export
+type, then it reports throughput, fetch latency, peak memory and query counts
+as a dict that the benchmark_crawl command prints as JSON. With workers set,
+the job is distributed and crawled by that many forked worker processes.
+Unless asked to keep them, the rows it writes go to a throwaway database created
+and migrated for the run and dropped after it, the configured one is left alone.
+'''
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import tempfile
+import threading
+import time
+import uuid
+from contextlib import contextmanager, nullcontext
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import django
+from asgiref.sync import async_to_sync
+from django.db import connection, connections
+from django.test import Client, override_settings
+
+from .client import HttpClient
+from .jobs import claim_next_job, join_next_job, run_job
+from .models import CrawlJob
+
+
+WORDS = ('lorem', 'ipsum', 'dolor', 'sit', 'amet', 'consectetur', 'adipiscing', 'elit', 'sed', 'do',
+         'eiusmod', 'tempor', 'incididunt', 'ut', 'labore', 'et', 'dolore', 'magna', 'aliqua')
+
+
+class SyntheticSite:
+    '''
+    Local HTTP server generating a link tree. Page /a/b/c is child c of child b
+    of child a of the root, pages of the last level link to no children.
+    Everything a page contains is derived from its path and the seed, so two
+    runs with the same options serve the same site.
+    Args:
+      @ fan_out: children linked from every page above the last level.
+      @ depth: levels of the tree, the root being level 1.
+      @ page_bytes: approximate size of every page.
+      @ latency: seconds every response is delayed by.
+      @ error_rate: fraction of pages answering 500 instead of HTML.
+      @ cycles: also link every page to the root, its parent and a sibling.
+      @ seed: seed of the page text and of which pages fail.
+    '''
+
+    def __init__(self, fan_out=5, depth=3, page_bytes=20000, latency=0.0, error_rate=0.0, cycles=False, seed=0):
+        self.fan_out = fan_out
+        self.depth = depth
+        self.page_bytes = page_bytes
+        self.latency = latency
+        self.error_rate = error_rate
+        self.cycles = cycles
+        self.seed = seed
+        self.requests = 0
+        self._server = None
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self._server.server_port}/'
+
+    def expected_pages(self):
+        '''
+        Number of distinct pages of the site, including those answering errors.
+        '''
+        return sum(self.fan_out ** level for level in range(self.depth))
+
+    def fails(self, path):
+        return path != '/' and random.Random(f'{self.seed}:{path}').random() < self.error_rate
+
+    def render(self, path):
+        '''
+        Builds the HTML of the page at path.
+        '''
+        parts = [part for part in path.split('/') if part]
+        rng = random.Random(f'{self.seed}:{path}:text')
+        links = []
+        if len(parts) < self.depth - 1:
+            links += [f'{path.rstrip("/")}/{child}' for child in range(self.fan_out)]
+        if self.cycles and parts:
+            sibling = (int(parts[-1]) + 1) % self.fan_out
+            links += ['/', '/' + '/'.join(parts[:-1]), '/' + '/'.join(parts[:-1] + [str(sibling)])]
+
+        head = f'<html><head><title>Page {path}</title></head><body><h1>Page {path}</h1>'
+        anchors = ''.join(f'<a href="{link}">{link}</a> ' for link in links)
+        text = []
+        size = len(head) + len(anchors)
+        while size < self.page_bytes:
+            paragraph = '<p>' + ' '.join(rng.choice(WORDS) for _ in range(60)) + '</p>'
+            text.append(paragraph)
+            size += len(paragraph)
+        return f'{head}<nav>{anchors}</nav>{"".join(text)}</body></html>'.encode('utf-8')
+
+    def _handler(self):
+        site = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                site.requests += 1
+                if site.latency:
+                    time.sleep(site.latency)
+                path = self.path.split('?')[0]
+                if path == '/robots.txt':
+                    status, body = 404, b''
+                elif site.fails(path):
+                    status, body = 500, b'Synthetic error'
+                else:
+                    status, body = 200, site.render(path)
+                self.send_response(status)
+                self.send_header('Content-Type', 'text/html; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        return Handler
+
+    def start(self):
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def percentile(values, q):
+    '''
+    Returns the q-th percentile (0 to 100) of values by nearest rank, None if there are none.
+    '''
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, round(q / 100 * len(ordered)) - 1))]
+
+
+def peak_rss_mb(who=resource.RUSAGE_SELF):
+    '''
+    Peak resident memory so far of this process (or its largest child) in MB.
+    '''
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS.
+    scale = 1024 * 1024 if platform.system() == 'Darwin' else 1024
+    return round(resource.getrusage(who).ru_maxrss / scale, 1)
+
+
+class QueryCounter:
+    '''
+    Database execute wrapper counting the queries run through one connection.
+    '''
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+@contextmanager
+def count_queries():
+    counter = QueryCounter()
+    with connection.execute_wrapper(counter):
+        yield counter
+
+
+@contextmanager
+def record_fetch_latency():
+    '''
+    Times every HttpClient.get while the block runs.
+    Yields:
+      @ latencies: list the durations in seconds are appended to, from every crawl thread.
+    '''
+    latencies = []
+    get = HttpClient.get
+
+    def timed_get(client, url, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return get(client, url, *args, **kwargs)
+        finally:
+            latencies.append(time.perf_counter() - start)
+
+    HttpClient.get = timed_get
+    try:
+        yield latencies
+    finally:
+        HttpClient.get = get
+
+
+@contextmanager
+def throwaway_database():
+    '''
+    Creates and migrates a new database and points the default connection to it while the block runs,
+    like the test runner does, then drops it and points the connection back to the configured database.
+    '''
+    test_settings = connection.settings_dict.setdefault('TEST', {})
+    test_name = test_settings.get('NAME')
+    name = connection.settings_dict['NAME']
+    with tempfile.TemporaryDirectory() as directory:
+        if connection.vendor == 'sqlite':
+            # A file, forked workers can not share the in-memory database SQLite tests default to.
+            test_settings['NAME'] = os.path.join(directory, 'benchmark.sqlite3')
+        else:
+            test_settings['NAME'] = f'benchmark_{uuid.uuid4().hex[:12]}'
+        try:
+            connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+            try:
+                yield
+            finally:
+                connections.close_all()
+                connection.creation.destroy_test_db(name, verbosity=0)
+        finally:
+            test_settings['NAME'] = test_name
+
+
+def _work_on_job(job_id, claim):
+    # Runs in a forked process, like a crawl_worker that claims or joins the job.
+    job = claim_next_job(pk=job_id) if claim else None
+    while job is None:
+        if CrawlJob.objects.filter(pk=job_id, status__in=(CrawlJob.DONE, CrawlJob.FAILED)).exists():
+            return
+        job = join_next_job(pk=job_id)
+        if job is None:
+            time.sleep(0.05)
+    run_job(job)
+    connections.close_all()
+
+
+def run_workers(job_id, workers):
+    '''
+    Crawls a queued distributed job with worker processes forked from this one,
+    so that they share its settings, and waits for them.
+    Returns:
+      @ job: the finished CrawlJob.
+    '''
+    # Children open their own connections, none is shared across the fork.
+    connections.close_all()
+    context = multiprocessing.get_context('fork')
+    processes = [context.Process(target=_work_on_job, args=(job_id, index == 0)) for index in range(workers)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    return CrawlJob.objects.get(pk=job_id)
+
+
+def benchmark_crawl(client, site, workers=0):
+    '''
+    Queues a crawl of the site through the scrape view and runs it like crawl_worker does,
+    or like workers crawl_worker processes sharing a distributed job do.
+    Fetch latencies and query counts are only measured in this process, without workers.
+    '''
+    response = client.post('/scraper/scrape/', {'input_url': site.url, 'depth': site.depth})
+    if response.status_code != 200:
+        raise RuntimeError(f'The scrape view answered {response.status_code}: {response.content[:200]}')
+    job_id = response.json()['jobId']
+
+    requests_before = site.requests
+    with record_fetch_latency() as latencies, count_queries() as queries:
+        start = time.perf_counter()
+        job = run_workers(job_id, workers) if workers else run_job(claim_next_job(pk=job_id))
+        elapsed = time.perf_counter() - start
+
+    ms = [latency * 1000 for latency in latencies]
+    return job, {
+        'status': job.status,
+        'workers': workers or 1,
+        'pages': job.pages_fetched,
+        'failed': job.pages_failed,
+        'requests': site.requests - requests_before,
+        'seconds': round(elapsed, 3),
+        'pages_per_sec': round(job.pages_fetched / elapsed, 1),
+        'fetch_latency_ms': {
+            'p50': round(percentile(ms, 50), 2) if ms else None,
+            'p99': round(percentile(ms, 99), 2) if ms else None,
+            'mean': round(sum(ms) / len(ms), 2) if ms else None,
+        },
+        'db_queries': queries.count if not workers else None,
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+
+def read_streaming(response):
+    '''
+    Reads a streaming response chunk by chunk, as the server would send it, and returns its size in bytes.
+    '''
+    if not response.is_async:
+        return sum(len(chunk) for chunk in response.streaming_content)
+
+    async def read():
+        size = 0
+        async for chunk in response.streaming_content:
+            size += len(chunk)
+        return size
+
+    return async_to_sync(read)()
+
+
+def benchmark_download(client, download_type, pages):
+    '''
+    Streams the download of the crawled tree in one format and measures it.
+    '''
+    with count_queries() as queries:
+        start = time.perf_counter()
+        response = client.post('/scraper/download/', {'download_type': download_type})
+        if response.status_code != 200:
+            raise RuntimeError(f'The download view answered {response.status_code} for {download_type}')
+        size = read_streaming(response)
+        elapsed = time.perf_counter() - start
+
+    return {
+        'seconds': round(elapsed, 3),
+        'bytes': size,
+        'pages_per_sec': round(pages / elapsed, 1),
+        'mb_per_sec': round(size / 1e6 / elapsed, 2),
+        'db_queries': queries.count,
+        'peak_rss_mb': peak_rss_mb(),
+        'peak_child_rss_mb': peak_rss_mb(resource.RUSAGE_CHILDREN),
+    }
+
+
+def run_benchmark(site, download_types=('csv', 'json'), host_rate=1000.0, keep=False, workers=0, concurrency=None):
+    '''
+    Crawls a synthetic site and downloads the result in every requested format.
+    Caches are switched off so that every run starts cold.
+    Args:
+      @ site: a started SyntheticSite.
+      @ download_types: export types to download after the crawl.
+      @ host_rate: per-host request rate, high enough not to be what is measured.
+      @ keep: crawl into the configured database and leave the crawled pages there,
+        instead of a throwaway database.
+      @ workers: crawl as a distributed job with this many worker processes, 0 crawls in this process.
+      @ concurrency: fetches in flight per worker, defaults to settings.SCRAPER_CONCURRENCY.
+    Returns:
+      @ report: a JSON-serializable dict.
+    '''
+    user_id = f'benchmark-{uuid.uuid4().hex[:12]}'
+    report = {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'django': django.get_version(),
+        'site': {
+            'fan_out': site.fan_out,
+            'depth': site.depth,
+            'page_bytes': site.page_bytes,
+            'latency': site.latency,
+            'error_rate': site.error_rate,
+            'cycles': site.cycles,
+            'seed': site.seed,
+            'pages': site.expected_pages(),
+        },
+        'crawl': None,
+        'downloads': {},
+    }
+
+    overrides = override_settings(
+        SCRAPER_HTTP_CACHE=False,
+        SCRAPER_ARTIFACT_CACHE=False,
+        SCRAPER_HOST_RATE=host_rate,
+        SCRAPER_OBEY_ROBOTS=False,
+        SCRAPER_DISTRIBUTED=bool(workers),
+        **({'SCRAPER_CONCURRENCY': concurrency} if concurrency else {}),
+    )
+    client = Client(HTTP_HOST='localhost')
+    with overrides, (nullcontext() if keep else throwaway_database()):
+        client.post('/scraper/verify_user_id/', {'scraper_user_id': user_id}, content_type='application/json')
+        job, report['crawl'] = benchmark_crawl(client, site, workers)
+        for download_type in download_types:
+            report['downloads'][download_type] = benchmark_download(client, download_type, job.pages_fetched)
+    report['peak_rss_mb'] = peak_rss_mb()
+    return report
@@ -0,0 +1,330 @@
+'''
+On-disk caches shared by every crawl and every user.
+
+DiskCache keeps files under a directory, named by a hash key, with a small
+SQLite index next to them holding per-file metadata, sizes and access times
+for TTL expiry and size-bounded LRU eviction. SQLite keeps the index
+consistent between threads and between server processes.
+
+HttpCache stores response bodies keyed by canonical URL together with their
+validators (ETag, Last-Modified) and Cache-Control, for conditional GETs.
+'''
+import hashlib
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+import requests
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+from django.conf import settings
+
+from . import metrics
+from .frontier import canonicalize_url
+
+
+# Response headers kept with a cached body.
+STORED_HEADERS = ('Content-Type', 'ETag', 'Last-Modified', 'Cache-Control', 'Expires', 'Date')
+
+
+def parse_cache_control(value):
+    '''
+    Parses a Cache-Control header into a dict of lowercased directive -> value (or True).
+    '''
+    directives = {}
+    for part in (value or '').split(','):
+        name, _, arg = part.strip().partition('=')
+        if name:
+            directives[name.lower()] = arg.strip('"') if arg else True
+    return directives
+
+
+class CacheEntry:
+    '''
+    One cached response as read from the index.
+    '''
+
+    def __init__(self, url, path, headers, stored_at, final_url=None):
+        self.url = url
+        # Where the request ended up after redirects, the base of the page's relative links.
+        self.final_url = final_url or url
+        self.path = path
+        self.headers = CaseInsensitiveDict(headers)
+        self.stored_at = stored_at
+
+    def freshness_lifetime(self, default):
+        '''
+        Seconds the response may be served without revalidation.
+        '''
+        directives = parse_cache_control(self.headers.get('Cache-Control'))
+        if 'no-cache' in directives:
+            return 0
+        for name in ('s-maxage', 'max-age'):
+            if name in directives:
+                try:
+                    return int(directives[name])
+                except ValueError:
+                    return 0
+        return default
+
+    def is_fresh(self, default_freshness):
+        return time.time() - self.stored_at < self.freshness_lifetime(default_freshness)
+
+    def validators(self):
+        '''
+        Conditional request headers used to revalidate this entry.
+        '''
+        headers = {}
+        if self.headers.get('ETag'):
+            headers['If-None-Match'] = self.headers['ETag']
+        if self.headers.get('Last-Modified'):
+            headers['If-Modified-Since'] = self.headers['Last-Modified']
+        return headers
+
+    def to_response(self):
+        '''
+        Builds a requests.Response from the cached body, or None if the body file is gone.
+        '''
+        try:
+            with open(self.path, 'rb') as f:
+                body = f.read()
+        except OSError:
+            return None
+        response = requests.Response()
+        response.status_code = 200
+        response.url = self.final_url
+        response.headers = CaseInsensitiveDict(self.headers)
+        response.encoding = get_encoding_from_headers(response.headers)
+        response._content = body
+        return response
+
+
+class DiskCache:
+    '''
+    Size-bounded LRU store of files with a SQLite index.
+    Args:
+      @ directory: where the index and files live.
+      @ max_bytes: total file size kept before least recently used entries are evicted.
+      @ ttl: seconds after which an entry is dropped, None to keep entries until evicted.
+    '''
+
+    NAME = 'disk'
+    STATS = ('stored', 'evicted')
+    # Writes between two evictions. In between, an estimate of the total size
+    # (which does not see writes of other processes) starts one early.
+    EVICT_INTERVAL = 100
+
+    def __init__(self, directory, max_bytes, ttl=None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.stats = dict.fromkeys(self.STATS, 0)
+        self._estimated_size = None
+        self._writes = 0
+
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._connections = []
+        os.makedirs(os.path.join(self.directory, 'files'), exist_ok=True)
+        with self._connection() as db:
+            db.execute(
+                'CREATE TABLE IF NOT EXISTS files ('
+                ' key TEXT PRIMARY KEY, meta TEXT, size INTEGER, stored_at REAL, accessed_at REAL)'
+            )
+            db.execute('CREATE INDEX IF NOT EXISTS files_accessed_at ON files (accessed_at)')
+            db.execute('CREATE INDEX IF NOT EXISTS files_stored_at ON files (stored_at)')
+
+    def _connection(self):
+        # sqlite3 connections can not be shared between threads, keep one per thread.
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(os.path.join(self.directory, 'index.sqlite3'), timeout=30, check_same_thread=False)
+            db.execute('PRAGMA journal_mode=WAL')
+            self._local.db = db
+            with self._lock:
+                self._connections.append(db)
+        return db
+
+    def path(self, key):
+        return os.path.join(self.directory, 'files', key[:2], key)
+
+    def count(self, name):
+        with self._lock:
+            self.stats[name] += 1
+        metrics.inc('scraper_cache_events_total', cache=self.NAME, event=name)
+
+    def _expired(self, stored_at):
+        return self.ttl is not None and time.time() - stored_at > self.ttl
+
+    def get(self, key):
+        '''
+        Looks up an entry and marks it as recently used. Entries past the TTL are dropped.
+        Returns:
+          @ (path, meta, stored_at), or None.
+        '''
+        with self._connection() as db:
+            row = db.execute('SELECT meta, stored_at FROM files WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+            if self._expired(row[1]):
+                self._delete(db, key)
+                return None
+            db.execute('UPDATE files SET accessed_at = ? WHERE key = ?', (time.time(), key))
+        return self.path(key), json.loads(row[0]), row[1]
+
+    def read(self, key):
+        '''
+        Returns the bytes stored under key, or None.
+        '''
+        if self.get(key) is None:
+            return None
+        try:
+            with open(self.path(key), 'rb') as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def put(self, key, data, meta=None):
+        '''
+        Stores data under key, then evicts entries every EVICT_INTERVAL writes or
+        as soon as the cache seems to have grown past max_bytes.
+        '''
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # Write the file next to its final name and swap it in, readers never see half a file.
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+        now = time.time()
+        with self._connection() as db:
+            db.execute(
+                'INSERT OR REPLACE INTO files (key, meta, size, stored_at, accessed_at) VALUES (?, ?, ?, ?, ?)',
+                (key, json.dumps(meta or {}), len(data), now, now),
+            )
+        self.count('stored')
+        with self._lock:
+            self._writes += 1
+            if self._estimated_size is not None:
+                self._estimated_size += len(data)
+            due = (self._estimated_size is None or self._estimated_size > self.max_bytes
+                   or self._writes >= self.EVICT_INTERVAL)
+        if due:
+            self.evict()
+
+    def update(self, key, meta):
+        '''
+        Replaces the metadata of an entry and restarts its TTL.
+        '''
+        now = time.time()
+        with self._connection() as db:
+            db.execute(
+                'UPDATE files SET meta = ?, stored_at = ?, accessed_at = ? WHERE key = ?',
+                (json.dumps(meta), now, now, key),
+            )
+
+    def _delete(self, db, key):
+        db.execute('DELETE FROM files WHERE key = ?', (key,))
+        try:
+            os.remove(self.path(key))
+        except OSError:
+            pass
+
+    def evict(self):
+        '''
+        Drops expired entries, then least recently used ones until the cache fits in max_bytes.
+        '''
+        with self._connection() as db:
+            if self.ttl is not None:
+                for (key,) in db.execute('SELECT key FROM files WHERE stored_at < ?', (time.time() - self.ttl,)).fetchall():
+                    self._delete(db, key)
+                    self.count('evicted')
+
+            total = db.execute('SELECT COALESCE(SUM(size), 0) FROM files').fetchone()[0]
+            if total > self.max_bytes:
+                for key, size in db.execute('SELECT key, size FROM files ORDER BY accessed_at').fetchall():
+                    self._delete(db, key)
+                    self.count('evicted')
+                    total -= size
+                    if total <= self.max_bytes:
+                        break
+        with self._lock:
+            self._estimated_size = total
+            self._writes = 0
+
+    def close(self):
+        '''
+        Closes the index connections opened by every thread that used this cache.
+        '''
+        with self._lock:
+            connections, self._connections = self._connections, []
+        for db in connections:
+            db.close()
+        self._local = threading.local()
+
+
+class HttpCache(DiskCache):
+    '''
+    On-disk HTTP cache keyed by canonical URL.
+    Args:
+      @ directory: where the index and bodies live.
+      @ max_bytes: total body size kept before least recently used entries are evicted.
+      @ ttl: seconds after which an entry is dropped, whatever its headers say.
+      @ default_freshness: seconds a response without max-age is served without revalidation.
+    '''
+
+    NAME = 'http'
+    STATS = ('hits', 'misses', 'revalidated', 'stored', 'evicted')
+
+    def __init__(self, directory=None, max_bytes=None, ttl=None, default_freshness=None):
+        super().__init__(
+            directory or getattr(settings, 'SCRAPER_HTTP_CACHE_DIR', os.path.join(settings.MEDIA_ROOT, 'http_cache')),
+            max_bytes or getattr(settings, 'SCRAPER_HTTP_CACHE_MAX_BYTES', 512 * 1024 * 1024),
+            ttl or getattr(settings, 'SCRAPER_HTTP_CACHE_TTL', 7 * 24 * 3600),
+        )
+        self.default_freshness = (
+            default_freshness if default_freshness is not None
+            else getattr(settings, 'SCRAPER_HTTP_CACHE_DEFAULT_FRESHNESS', 300)
+        )
+
+    def _key(self, url):
+        return hashlib.sha256(canonicalize_url(url).encode('utf-8')).hexdigest()
+
+    def lookup(self, url):
+        '''
+        Returns the CacheEntry for url, or None.
+        '''
+        found = self.get(self._key(url))
+        if found is None:
+            return None
+        path, meta, stored_at = found
+        return CacheEntry(url, path, meta['headers'], stored_at, meta.get('final_url'))
+
+    def store(self, url, response):
+        '''
+        Stores a 200 response unless its Cache-Control forbids a shared cache to keep it.
+        '''
+        if response.status_code != 200:
+            return
+        directives = parse_cache_control(response.headers.get('Cache-Control'))
+        if 'no-store' in directives or 'private' in directives:
+            return
+
+        headers = {name: response.headers[name] for name in STORED_HEADERS if name in response.headers}
+        meta = {'url': url, 'final_url': response.url or url, 'headers': headers}
+        self.put(self._key(url), response.content, meta)
+
+    def refresh(self, entry, response):
+        '''
+        Marks an entry fresh again after a 304, taking any updated headers from it.
+        '''
+        for name in STORED_HEADERS:
+            if name in response.headers and name != 'Content-Type':
+                entry.headers[name] = response.headers[name]
+        self.update(self._key(entry.url), {'url': entry.url, 'final_url': entry.final_url, 'headers': dict(entry.headers)})
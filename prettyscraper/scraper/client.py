@@ -0,0 +1,190 @@
+'''
+HTTP client shared by every fetch of one crawl.
+
+One requests.Session keeps a pool of keep-alive connections per host, so after
+the first page of a host every fetch costs a single request round trip instead
+of a fresh TCP and TLS handshake. Responses are streamed, so a large or
+non-HTML link is abandoned after its headers instead of being downloaded.
+'''
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.request import ACCEPT_ENCODING
+from urllib3.util.retry import Retry
+
+from django.conf import settings
+
+from .cache import HttpCache
+
+
+# Content types worth parsing for a title and links.
+HTML_CONTENT_TYPES = ('text/html', 'application/xhtml+xml')
+
+
+class SkippedURL(Exception):
+    '''
+    Raised instead of downloading a URL that is not worth fetching. The message says why.
+    '''
+
+
+def check_content_type(content_type):
+    '''
+    Raises SkippedURL unless the Content-Type is HTML or XHTML. A missing header passes.
+    '''
+    if not content_type:
+        return
+    mime_type = content_type.split(';')[0].strip().lower()
+    if mime_type not in HTML_CONTENT_TYPES:
+        raise SkippedURL(f'Content-Type {mime_type} is not HTML')
+
+
+def check_content_length(content_length, max_bytes):
+    '''
+    Raises SkippedURL if the announced Content-Length is over max_bytes.
+    '''
+    if content_length and content_length.isdigit() and int(content_length) > max_bytes:
+        raise SkippedURL(f'Content-Length {content_length} is over the {max_bytes} bytes limit')
+
+
+class HttpClient:
+    '''
+    Crawl-scoped HTTP client with connection pooling, compression, timeouts and retries.
+    Safe to share between crawler worker threads. Use it as a context manager,
+    or call close, to release the pooled connections.
+    Args:
+      @ pool_size: connections kept alive per host, should be at least the per-host concurrency.
+      @ connect_timeout: seconds to wait for a connection.
+      @ read_timeout: seconds to wait between bytes of the response.
+      @ retries: retries on connection errors and retryable status codes.
+      @ backoff: backoff factor in seconds between retries (doubles every retry).
+      @ cache: an HttpCache, defaults to a new one when settings.SCRAPER_HTTP_CACHE is on.
+      @ max_bytes: largest response body read, defaults to settings.SCRAPER_MAX_BODY_BYTES.
+    '''
+
+    # 429 and 503 are not retried here: the crawler backs off the whole host
+    # instead of sleeping in one worker thread (see politeness.py).
+    RETRY_STATUSES = (500, 502, 504)
+
+    def __init__(self, pool_size=None, connect_timeout=None, read_timeout=None, retries=None, backoff=None, cache=None,
+                 max_bytes=None):
+        pool_size = pool_size or getattr(settings, 'SCRAPER_PER_HOST_CONCURRENCY', 4)
+        self.timeout = (
+            connect_timeout or getattr(settings, 'SCRAPER_CONNECT_TIMEOUT', 5),
+            read_timeout or getattr(settings, 'SCRAPER_READ_TIMEOUT', 15),
+        )
+        retry = Retry(
+            total=retries if retries is not None else getattr(settings, 'SCRAPER_MAX_RETRIES', 2),
+            backoff_factor=backoff if backoff is not None else getattr(settings, 'SCRAPER_RETRY_BACKOFF', 0.5),
+            status_forcelist=self.RETRY_STATUSES,
+            allowed_methods=('GET', 'HEAD'),
+            respect_retry_after_header=True,
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.session.headers.update({
+            'User-Agent': getattr(settings, 'SCRAPER_USER_AGENT', 'PrettyScraper'),
+            # Every encoding urllib3 can decode here: gzip and deflate, br when brotli is installed.
+            'Accept-Encoding': ACCEPT_ENCODING,
+        })
+
+        self.max_bytes = max_bytes or getattr(settings, 'SCRAPER_MAX_BODY_BYTES', 5 * 1024 * 1024)
+        self.probe_extensions = tuple(getattr(settings, 'SCRAPER_PROBE_EXTENSIONS', ()))
+
+        if cache is None and getattr(settings, 'SCRAPER_HTTP_CACHE', False):
+            cache = HttpCache()
+        self.cache = cache
+
+    def get(self, url, html_only=False, **kwargs):
+        '''
+        Sends a GET request through the pooled session.
+        With a cache, fresh entries are served without a request and stale
+        ones are revalidated with If-None-Match/If-Modified-Since.
+        Args:
+          @ url: URL to fetch.
+          @ html_only: refuse responses that are not HTML or XHTML, see _send.
+        Returns:
+          @ response: a requests.Response, with its body already read.
+        Raises:
+          @ SkippedURL: when the response is refused.
+        '''
+        kwargs.setdefault('timeout', self.timeout)
+        if self.cache is None:
+            return self._send(url, html_only, **kwargs)
+
+        entry = self.cache.lookup(url)
+        if entry and entry.is_fresh(self.cache.default_freshness):
+            response = entry.to_response()
+            if response is not None:
+                self.cache.count('hits')
+                return response
+
+        headers = dict(kwargs.pop('headers', None) or {})
+        if entry:
+            headers.update(entry.validators())
+        response = self._send(url, html_only, headers=headers, **kwargs)
+
+        if entry and response.status_code == 304:
+            cached = entry.to_response()
+            if cached is not None:
+                self.cache.refresh(entry, response)
+                self.cache.count('revalidated')
+                return cached
+            # The body vanished under us (evicted by another process), fetch it in full.
+            response = self._send(url, html_only, **kwargs)
+
+        self.cache.count('misses')
+        self.cache.store(url, response)
+        return response
+
+    def _send(self, url, html_only=False, **kwargs):
+        '''
+        Streams a response and reads its body, giving up as early as possible on
+        bodies larger than max_bytes and, with html_only, on non-HTML content.
+        URLs with a suspicious extension are probed with a HEAD request first.
+        '''
+        if html_only and self.probe_extensions and urlsplit(url).path.lower().endswith(self.probe_extensions):
+            self._probe(url, kwargs.get('timeout'))
+
+        response = self.session.get(url, stream=True, **kwargs)
+        # Closing a response that was not read to the end drops its connection instead of reusing it.
+        with response:
+            if html_only and response.status_code == 200:
+                check_content_type(response.headers.get('Content-Type'))
+            check_content_length(response.headers.get('Content-Length'), self.max_bytes)
+
+            body = bytearray()
+            for chunk in response.iter_content(64 * 1024):
+                body += chunk
+                if len(body) > self.max_bytes:
+                    raise SkippedURL(f'Body larger than {self.max_bytes} bytes')
+            response._content = bytes(body)
+        return response
+
+    def _probe(self, url, timeout):
+        '''
+        Asks for the headers only and raises SkippedURL if they rule the page out.
+        A server that does not answer HEAD properly gets the benefit of the doubt.
+        '''
+        try:
+            response = self.session.head(url, timeout=timeout, allow_redirects=True)
+        except requests.RequestException:
+            return
+        if response.ok:
+            check_content_type(response.headers.get('Content-Type'))
+            check_content_length(response.headers.get('Content-Length'), self.max_bytes)
+
+    def close(self):
+        self.session.close()
+        if self.cache is not None:
+            self.cache.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
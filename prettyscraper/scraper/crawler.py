@@ -0,0 +1,206 @@
+'''
+Crawl engine behind the scrape view.
+
+A crawl is almost entirely network wait, so pages are fetched by a pool of
+worker threads while the thread that started the crawl owns the database and
+stores every page as soon as its fetch completes. Workers never touch the ORM.
+Hosts are fetched no faster than their politeness budget allows, a host that
+is throttled is left alone for a while and its other URLs wait in the frontier.
+Links outside the crawl's ScopePolicy, rebased on where the root page
+redirected to, are never queued, and no new fetch is started once its page
+or byte budget is spent.
+'''
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from urllib.parse import urljoin
+
+from django.conf import settings
+
+from . import metrics
+from .frontier import Frontier, canonicalize_url, get_host
+from .politeness import Politeness
+from .scope import ScopePolicy
+
+
+ROBOTS_DISALLOWED = 'Disallowed by robots.txt'
+
+logger = logging.getLogger(__name__)
+
+
+class Crawler:
+    '''
+    Walks the link tree below a root URL, keeping a bounded number of fetches in flight.
+    Every canonical URL is fetched at most once per crawl.
+    Args:
+      @ fetch: callable(url) -> result or None. Runs in worker threads. A result dict
+        with 'throttled' set puts the URL back in the frontier and backs its host off
+        for result['retry_after'] seconds, or exponentially if that is None. Its 'size'
+        counts against the byte budget and links are resolved against its 'base_url'
+        (the URL after redirects), or the URL itself.
+      @ store: callable(url, result, depth, parent) -> (page, hrefs). Runs in the calling thread.
+      @ resolve: callable(link, base_url) -> absolute URL of a link found on the page at base_url,
+        defaults to urljoin.
+      @ concurrency: maximum number of fetches in flight.
+      @ per_host: maximum number of fetches in flight against one host.
+      @ progress: optional callable(stats) called in the calling thread as fetches complete.
+      @ flush: optional callable run in the calling thread at least every flush_interval seconds,
+        for buffered writes.
+      @ flush_interval: seconds between two calls of flush while fetches are in flight.
+      @ fetch_robots: optional callable(url) -> RobotFileParser or None, run in worker threads
+        once per host. Without it robots.txt is not consulted.
+      @ scope: the ScopePolicy of the crawl, defaults to one built from settings for the root URL.
+      @ frontier: optional callable(per_host, politeness, scope) building the frontier,
+        defaults to the in-memory Frontier. Distributed crawls pass a SharedFrontier.
+    '''
+
+    def __init__(self, fetch, store, resolve=None, concurrency=None, per_host=None, progress=None,
+                 flush=None, flush_interval=None, fetch_robots=None, scope=None, frontier=None):
+        self.fetch = fetch
+        self.store = store
+        self.resolve = resolve or urljoin
+        self.scope = scope
+        self.progress = progress
+        self.flush = flush
+        self.flush_interval = flush_interval
+        self.fetched = 0
+        self.failed = 0
+        self.downloaded = 0
+        self.fetch_robots = fetch_robots
+        self.concurrency = concurrency or getattr(settings, 'SCRAPER_CONCURRENCY', 8)
+        per_host = per_host or getattr(settings, 'SCRAPER_PER_HOST_CONCURRENCY', 4)
+        self.politeness = Politeness(
+            burst=getattr(settings, 'SCRAPER_HOST_BURST', None) or per_host,
+            obey_robots=fetch_robots is not None and getattr(settings, 'SCRAPER_OBEY_ROBOTS', True),
+        )
+        self.frontier = (frontier or Frontier)(per_host, politeness=self.politeness, scope=scope)
+        self._in_flight = {}
+        self._robots = {}
+
+    def stats(self):
+        '''
+        Returns a dict of pages fetched, failed, in flight and still queued (including those in flight).
+        '''
+        return {
+            'fetched': self.fetched,
+            'failed': self.failed,
+            'in_flight': len(self._in_flight),
+            'queued': len(self.frontier) + len(self._in_flight),
+            'out_of_scope': self.frontier.out_of_scope,
+        }
+
+    def _has_budget(self):
+        return self.scope is None or self.scope.has_budget(self.fetched + len(self._in_flight), self.downloaded)
+
+    def _fill(self, pool):
+        '''
+        Starts robots.txt fetches for new hosts, then submits queued tasks until
+        the global limit is reached or no host is ready.
+        '''
+        for host, url in self.frontier.take_new_hosts():
+            self._robots[pool.submit(self.fetch_robots, url)] = host
+        while len(self._in_flight) < self.concurrency and self._has_budget():
+            task = self.frontier.pop()
+            if task is None:
+                return
+            future = pool.submit(self.fetch, task[0])
+            self._in_flight[future] = task
+
+    def _wait(self):
+        '''
+        Waits until a fetch completes, a held back host becomes ready or it is time to flush.
+        Returns:
+          @ done: the completed futures.
+        '''
+        timeout = self.flush_interval
+        ready_in = self.frontier.next_ready_in()
+        if ready_in is not None:
+            timeout = ready_in if timeout is None else min(timeout, ready_in)
+        futures = list(self._in_flight) + list(self._robots)
+        if futures:
+            done, _ = wait(futures, timeout=timeout, return_when=FIRST_COMPLETED)
+            return done
+        time.sleep(timeout or 0)
+        return ()
+
+    def _robots_done(self, future):
+        host = self._robots.pop(future)
+        try:
+            robots = future.result()
+        except Exception as e:
+            logger.warning('Failed to fetch robots.txt of %s: %s', host, e)
+            robots = None
+        self.politeness.set_robots(host, robots)
+
+    def _skip(self, task, reason):
+        url, depth, parent = task
+        self.store(url, {'skipped': reason}, depth, parent)
+        self.failed += 1
+
+    def crawl(self, root_url, max_depth):
+        '''
+        Crawls root_url and the pages it links to, up to max_depth levels (the root is level 1).
+        Returns:
+          @ Boolean: whether the root page could be fetched and stored.
+        '''
+        root_stored = False
+        if self.scope is None:
+            self.scope = self.frontier.scope = ScopePolicy(root_url)
+        self.frontier.push(root_url, 1, None)
+
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            self._fill(pool)
+            # Pages still queued when the budget runs out are dropped.
+            while self._in_flight or self._robots or (len(self.frontier) and self._has_budget()):
+                for future in self._wait():
+                    if future in self._robots:
+                        self._robots_done(future)
+                        continue
+
+                    task = self._in_flight.pop(future)
+                    url, depth, parent = task
+                    self.frontier.done(url)
+
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        logger.error('Failed to fetch %s: %s', url, e)
+                        metrics.inc('scraper_errors_total', stage='fetch')
+                        result = None
+
+                    # A throttled host is backed off and the URL tried again later.
+                    if result and result.get('throttled'):
+                        self.politeness.throttled(get_host(url), result.get('retry_after'))
+                        if not self.frontier.requeue(task):
+                            self._skip(task, result['skipped'])
+                        continue
+                    self.politeness.succeeded(get_host(url))
+                    if result:
+                        self.downloaded += result.get('size', 0)
+
+                    page, hrefs = self.store(url, result, depth, parent)
+                    if not page:
+                        self.failed += 1
+                        continue
+                    self.fetched += 1
+                    if parent is None:
+                        root_stored = True
+                        # Links of a root that redirected, say to https://www., are judged by the site it landed on.
+                        if result and result.get('base_url'):
+                            self.scope.rebase(canonicalize_url(result['base_url']))
+
+                    # The current page becomes the parent of every page it links to.
+                    # Pages seen before keep their first parent, the edge itself is in the Link table.
+                    if depth < max_depth:
+                        base_url = result.get('base_url') or url
+                        for link in hrefs:
+                            self.frontier.push(self.resolve(link, base_url), depth + 1, page)
+                self._fill(pool)
+                for task in self.frontier.take_disallowed():
+                    self._skip(task, ROBOTS_DISALLOWED)
+                if self.flush:
+                    self.flush()
+                if self.progress:
+                    self.progress(self.stats())
+
+        return root_stored
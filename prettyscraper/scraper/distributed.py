@@ -0,0 +1,415 @@
+'''
+Distributed crawls: one crawl worked on by every crawl_worker that joins it.
+
+The frontier of a distributed crawl is the FrontierEntry table. Workers, in one
+process or many, on one host or several sharing the database, lease batches
+of pending entries, fetch them with the usual crawl engine and write the pages,
+the links found on them and the end of their leases in one transaction. A
+worker that dies holding leases stops renewing them, once they expire another
+worker claims the entries again. The last worker to run out of work finishes
+the job.
+'''
+import os
+import socket
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, F, Q
+from django.utils import timezone
+
+from .client import HttpClient
+from .crawler import Crawler
+from .frontier import Frontier, canonicalize_url
+from .graph import resolve_links
+from .models import CrawlJob, FrontierEntry, Page, SkippedPage
+from .politeness import get_robots
+from .scope import ScopePolicy
+from .views import (get_page_content, record_extract_mode, resolve_link, store_page_content,
+                    take_over_previous_crawl)
+from .writer import PageWriter
+
+
+# Rows per statement when updating entries by primary key, under SQLite's variable limit.
+CHUNK_SIZE = 500
+
+
+def get_worker_id():
+    '''
+    Returns the lease owner name of this process, unique across the hosts sharing the database.
+    '''
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+def chunked(items, size=CHUNK_SIZE):
+    items = list(items)
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def claimable(now):
+    '''
+    Entries a worker may lease: pending ones, and leased ones whose lease ran out.
+    '''
+    return Q(state=FrontierEntry.PENDING) | Q(state=FrontierEntry.LEASED, lease_expires__lt=now)
+
+
+class SharedFrontier:
+    '''
+    Frontier of one distributed crawl, kept in the FrontierEntry table, with the
+    interface of Frontier so that the Crawler runs it unchanged. Claimed entries
+    wait in a local Frontier, which applies this worker's politeness and per-host
+    limits. Links the crawler pushes and the entries it finishes are buffered and
+    written by flush, in the same transaction as the pages of the PageWriter, so
+    an entry is never marked done without its page and its links.
+    Args:
+      @ job: the distributed CrawlJob.
+      @ writer: the PageWriter of this worker.
+      @ per_host: maximum number of fetches in flight against one host, from this worker.
+      @ politeness: optional Politeness of this worker.
+      @ scope: optional ScopePolicy, links it does not allow are not queued. Its page
+        budget counts the pages stored by every worker.
+      @ batch_size: entries leased by one claim, defaults to settings.SCRAPER_CLAIM_BATCH.
+      @ lease: seconds a lease lasts, defaults to settings.SCRAPER_LEASE_SECONDS.
+        Leases of entries still held are renewed well before that.
+      @ max_attempts: leases an entry may take before it is given up on,
+        defaults to settings.SCRAPER_LEASE_ATTEMPTS.
+      @ poll_interval: seconds between two claims that found nothing,
+        defaults to settings.SCRAPER_FRONTIER_POLL.
+      @ owner: lease owner name of this worker, defaults to get_worker_id().
+    '''
+
+    def __init__(self, job, writer, per_host, politeness=None, scope=None, batch_size=None, lease=None,
+                 max_attempts=None, poll_interval=None, owner=None):
+        self.job = job
+        self.writer = writer
+        self.scope = scope
+        self.local = Frontier(per_host, visited=set(), politeness=politeness)
+        self.batch_size = batch_size or getattr(settings, 'SCRAPER_CLAIM_BATCH', 32)
+        self.lease = lease or getattr(settings, 'SCRAPER_LEASE_SECONDS', 120)
+        self.max_attempts = max_attempts or getattr(settings, 'SCRAPER_LEASE_ATTEMPTS', 3)
+        self.poll_interval = poll_interval or getattr(settings, 'SCRAPER_FRONTIER_POLL', 0.5)
+        self.flush_interval = writer.flush_interval
+        self.owner = owner or get_worker_id()
+        self.out_of_scope = 0
+        # Pages of an earlier crawl of the root, for the claimed entries that have one.
+        self.known = {}
+        self._seen = set()
+        self._pushes = []
+        # Primary key of every entry this worker holds a lease on, by URL.
+        self._held = {}
+        self._finished = {FrontierEntry.DONE: [], FrontierEntry.FAILED: []}
+        # Counts not yet added to the job row.
+        self._counts = {'pages_fetched': 0, 'pages_failed': 0, 'pages_unchanged': 0}
+        # Open entries held by other workers, and pages stored by all of them, as of the last flush.
+        self._remaining = None
+        self._stored = job.pages_fetched
+        self._last_flush = 0.0
+        self._last_claim = 0.0
+        self._claimed_all = False
+        self._last_renew = time.monotonic()
+        # Where the root page redirected to, once a worker fetched it, see claim.
+        self._final_url = job.final_url
+
+    def __len__(self):
+        if self.budget_spent():
+            return 0
+        if self._remaining is None:
+            self._count()
+        return len(self.local) + len(self._pushes) + self._remaining
+
+    def budget_spent(self):
+        if not (self.scope and self.scope.max_pages):
+            return False
+        return self._stored + self._counts['pages_fetched'] >= self.scope.max_pages
+
+    def push(self, url, depth, parent):
+        '''
+        Queues a URL for whichever worker claims it first, unless this worker
+        already saw it or the scope does not allow it. The table drops URLs
+        another worker queued before.
+        Returns:
+          @ url: the canonical URL if it was queued, otherwise None.
+        '''
+        url = canonicalize_url(url)
+        if url in self._seen:
+            return None
+        if self.scope and parent is not None and not self.scope.allows(url):
+            self.out_of_scope += 1
+            return None
+        self._seen.add(url)
+        self._pushes.append((url, depth, parent))
+        return url
+
+    def pop(self):
+        '''
+        Takes the next task of the local queue, claiming more entries when it runs low.
+        '''
+        if self.budget_spent():
+            return None
+        if len(self.local) < self.batch_size:
+            # Links of this worker only become claimable once they are written.
+            if not len(self.local) and self._pushes:
+                self.flush(force=True)
+            self.claim()
+        return self.local.pop()
+
+    def requeue(self, task):
+        return self.local.requeue(task)
+
+    def done(self, url):
+        self.local.done(url)
+
+    def take_new_hosts(self):
+        return self.local.take_new_hosts()
+
+    def take_disallowed(self):
+        return self.local.take_disallowed()
+
+    def next_ready_in(self):
+        ready_in = self.local.next_ready_in()
+        if ready_in is None and not len(self.local) and (self._remaining or self._pushes):
+            return self.poll_interval
+        return ready_in
+
+    def finish(self, url, stored, unchanged=False):
+        '''
+        Records the outcome of an entry, written to the table by the next flush.
+        Args:
+          @ url: canonical URL of a claimed entry.
+          @ stored: whether a page was stored for it.
+          @ unchanged: whether it is a page of an earlier crawl found unchanged.
+        '''
+        self._finished[FrontierEntry.DONE if stored else FrontierEntry.FAILED].append(url)
+        self._counts['pages_fetched' if stored else 'pages_failed'] += 1
+        self._counts['pages_unchanged'] += int(unchanged)
+
+    def claim(self):
+        '''
+        Leases up to batch_size of the shallowest claimable entries and queues them locally.
+        An empty claim is not repeated before poll_interval seconds.
+        Returns:
+          @ count: number of entries leased.
+        '''
+        if not self._claimed_all and time.monotonic() - self._last_claim < self.poll_interval:
+            return 0
+        self._last_claim = time.monotonic()
+        now = timezone.now()
+        expires = now + timedelta(seconds=self.lease)
+
+        with transaction.atomic():
+            self._give_up(now)
+            ids = list(
+                FrontierEntry.objects.filter(claimable(now), crawl=self.job)
+                .order_by('depth', 'id')
+                .values_list('pk', flat=True)[:self.batch_size]
+            )
+            # The state is checked again by the update, so two workers never lease the same entry.
+            if ids:
+                FrontierEntry.objects.filter(claimable(now), pk__in=ids).update(
+                    state=FrontierEntry.LEASED, lease_owner=self.owner, lease_expires=expires,
+                    attempts=F('attempts') + 1,
+                )
+        entries = list(
+            FrontierEntry.objects.filter(pk__in=ids, lease_owner=self.owner, lease_expires=expires)
+            .select_related('parent').only('url', 'depth', 'parent', 'parent__url')
+        ) if ids else []
+        self._claimed_all = len(ids) == self.batch_size
+        # Entries below the root are only written after its worker recorded where it redirected to.
+        if entries and self.scope and not self._final_url:
+            self._final_url = CrawlJob.objects.filter(pk=self.job.pk).values_list('final_url', flat=True).first()
+            if self._final_url:
+                self.scope.rebase(self._final_url)
+
+        urls = [entry.url for entry in entries]
+        for page in Page.objects.filter(crawl=self.job, url__in=urls):
+            self.known[page.url] = page
+        for entry in entries:
+            self._held[entry.url] = entry.pk
+            self._seen.add(entry.url)
+            self.local.push(entry.url, entry.depth, entry.parent)
+        return len(entries)
+
+    def _give_up(self, now):
+        # Entries whose leases expired max_attempts times are failed rather than handed out again.
+        stuck = FrontierEntry.objects.filter(
+            crawl=self.job, state=FrontierEntry.LEASED, lease_expires__lt=now, attempts__gte=self.max_attempts,
+        )
+        rows = list(stuck.values_list('pk', 'url', 'parent__url', 'attempts'))
+        if not rows:
+            return
+        for chunk in chunked(pk for pk, _, _, _ in rows):
+            FrontierEntry.objects.filter(pk__in=chunk).update(
+                state=FrontierEntry.FAILED, lease_owner='', lease_expires=None)
+        SkippedPage.objects.bulk_create([
+            SkippedPage(crawl=self.job, user_id=self.job.user_id, url=url, parent_url=parent_url,
+                        reason=f'Lease expired {attempts} times')
+            for _, url, parent_url, attempts in rows
+        ])
+        self._counts['pages_failed'] += len(rows)
+
+    def flush(self, force=False):
+        '''
+        Writes the buffered pages, the links found on them and the finished entries
+        in one transaction, at most every flush_interval seconds unless forced.
+        Renews the leases still held when a third of their time has passed.
+        '''
+        if not force and time.monotonic() - self._last_flush < self.flush_interval:
+            return
+        self._last_flush = time.monotonic()
+        pushes, self._pushes = self._pushes, []
+
+        with transaction.atomic():
+            # Pages first, the entries of their links point to them.
+            self.writer.flush()
+            FrontierEntry.objects.bulk_create([
+                FrontierEntry(crawl=self.job, url=url, depth=depth, parent=parent)
+                for url, depth, parent in pushes
+            ], ignore_conflicts=True, batch_size=CHUNK_SIZE)
+
+            for state, urls in self._finished.items():
+                ids = [self._held.pop(url) for url in urls if url in self._held]
+                urls.clear()
+                # A lease another worker took over after it expired is not ended by this one.
+                for chunk in chunked(ids):
+                    FrontierEntry.objects.filter(pk__in=chunk, lease_owner=self.owner).update(
+                        state=state, lease_owner='', lease_expires=None)
+
+            if self._held and time.monotonic() - self._last_renew >= self.lease / 3:
+                self._last_renew = time.monotonic()
+                expires = timezone.now() + timedelta(seconds=self.lease)
+                for chunk in chunked(self._held.values()):
+                    FrontierEntry.objects.filter(pk__in=chunk, lease_owner=self.owner).update(lease_expires=expires)
+
+            open_entries = self._count()
+            counts = {field: F(field) + value for field, value in self._counts.items() if value}
+            CrawlJob.objects.filter(pk=self.job.pk).update(
+                pages_queued=open_entries[FrontierEntry.PENDING] + open_entries[FrontierEntry.LEASED],
+                pages_in_flight=open_entries[FrontierEntry.LEASED],
+                **counts,
+            )
+            self._stored += self._counts['pages_fetched']
+            self._counts = dict.fromkeys(self._counts, 0)
+
+    def _count(self):
+        '''
+        Counts the open entries of the crawl, and refreshes what is left for the other workers.
+        '''
+        rows = (
+            FrontierEntry.objects.filter(crawl=self.job, state__in=(FrontierEntry.PENDING, FrontierEntry.LEASED))
+            .values_list('state').annotate(count=Count('id'))
+        )
+        open_entries = {FrontierEntry.PENDING: 0, FrontierEntry.LEASED: 0, **dict(rows)}
+        self._remaining = max(0, sum(open_entries.values()) - len(self._held))
+        self._stored = CrawlJob.objects.filter(pk=self.job.pk).values_list('pages_fetched', flat=True).first() or 0
+        return open_entries
+
+    def release(self):
+        '''
+        Hands the entries this worker still holds back to the other workers.
+        '''
+        for chunk in chunked(self._held.values()):
+            FrontierEntry.objects.filter(pk__in=chunk, lease_owner=self.owner, state=FrontierEntry.LEASED).update(
+                state=FrontierEntry.PENDING, lease_owner='', lease_expires=None)
+        self._held.clear()
+
+
+def crawl_distributed(job, progress=None, incremental=None, extract=None):
+    '''
+    Works on a distributed crawl job until no entry is left to claim and no other
+    worker holds one. The first worker on the job queues its root page, after
+    taking over an earlier crawl of it like crawl does.
+    Args:
+      @ job: a running CrawlJob with distributed set.
+      @ progress: optional callable receiving this worker's crawler stats.
+      @ incremental: re-crawl an earlier crawl in place, defaults to settings.SCRAPER_INCREMENTAL.
+      @ extract: store the main text of pages, defaults to job.extract_text then settings.SCRAPER_EXTRACT_MAIN_TEXT.
+    '''
+    if incremental is None:
+        incremental = getattr(settings, 'SCRAPER_INCREMENTAL', True)
+    if extract is None:
+        extract = job.extract_text if job.extract_text is not None else getattr(settings, 'SCRAPER_EXTRACT_MAIN_TEXT', False)
+    record_extract_mode(job, extract)
+    if incremental and not job.frontier.exists():
+        take_over_previous_crawl(job.user_id, job.root_url, job, extract)
+    scope = ScopePolicy(job.root_url, scope=job.scope or None, max_pages=job.max_pages)
+    if job.final_url:
+        scope.rebase(job.final_url)
+    shared = None
+
+    def make_frontier(per_host, politeness=None, scope=None):
+        nonlocal shared
+        shared = SharedFrontier(job, writer, per_host, politeness=politeness, scope=scope)
+        return shared
+
+    def store(url, fetched, depth, parent):
+        previous = shared.known.pop(url, None)
+        page, hrefs = store_page_content(writer, job.user_id, url, fetched, depth, parent, job, previous)
+        unchanged = page is not None and previous is not None and bool(fetched.get('unchanged'))
+        shared.finish(url, page is not None, unchanged)
+        # The other workers rebase their scope on where the root redirected to, see SharedFrontier.claim.
+        if parent is None and page is not None and fetched.get('base_url'):
+            CrawlJob.objects.filter(pk=job.pk).update(final_url=canonicalize_url(fetched['base_url']))
+        return page, hrefs
+
+    with HttpClient() as client, PageWriter() as writer:
+        crawler = Crawler(
+            fetch=lambda page_url: get_page_content(page_url, client, shared.known.get(page_url), extract),
+            store=store,
+            resolve=resolve_link,
+            progress=progress,
+            flush=lambda: shared.flush(),
+            flush_interval=writer.flush_interval,
+            fetch_robots=lambda page_url: get_robots(page_url, client),
+            scope=scope,
+            frontier=make_frontier,
+        )
+        try:
+            # The root is queued by every worker, the table keeps the first one.
+            crawler.crawl(job.root_url, job.max_depth)
+            shared.flush(force=True)
+        finally:
+            shared.release()
+
+
+def finish_distributed_job(job):
+    '''
+    Marks a distributed job done, or failed without a root page, once no entry is
+    pending or leased, or its page budget is spent and no entry is leased. Only one
+    of the workers racing to finish it does, and cleans up after the crawl: pages
+    of an earlier crawl that were not found again, then the frontier itself. The
+    links of the crawl are resolved last.
+    Returns:
+      @ Boolean: whether this call finished the job.
+    '''
+    entries = FrontierEntry.objects.filter(crawl=job)
+    scope = ScopePolicy(job.root_url, scope=job.scope or None, max_pages=job.max_pages)
+    with transaction.atomic():
+        job.refresh_from_db()
+        budget_spent = bool(scope.max_pages and job.pages_fetched >= scope.max_pages)
+        if entries.filter(state=FrontierEntry.LEASED).exists():
+            return False
+        if not budget_spent and entries.filter(state=FrontierEntry.PENDING).exists():
+            return False
+        root_stored = Page.objects.filter(crawl=job, url=job.root_url, parent__isnull=True).exists()
+        finished = CrawlJob.objects.filter(pk=job.pk, status=CrawlJob.RUNNING).update(
+            status=CrawlJob.DONE if root_stored else CrawlJob.FAILED,
+            error=None if root_stored else 'The root page could not be fetched.',
+            pages_queued=0,
+            pages_in_flight=0,
+            finished_at=timezone.now(),
+        )
+    if not finished:
+        return False
+
+    # They are kept when the root could not be fetched, the site may just be down.
+    if root_stored:
+        reached = entries.filter(state=FrontierEntry.DONE).values('url')
+        stale = list(Page.objects.filter(crawl=job).exclude(url__in=reached).values_list('pk', flat=True))
+        for chunk in chunked(stale):
+            Page.objects.filter(pk__in=chunk).delete()
+    entries.delete()
+    resolve_links(job)
+    job.refresh_from_db()
+    return True
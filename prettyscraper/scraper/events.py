@@ -0,0 +1,95 @@
+'''
+Shared polling of crawl jobs for the job events stream.
+
+Every client watching a job would otherwise read its row once per interval.
+A JobBroadcaster reads the rows of all watched jobs in one query per interval
+and hands each job to the asyncio queue of every client watching it, so the
+database load stays the same however many browser tabs are open. There is one
+broadcaster per event loop, asyncio queues and tasks cannot cross loops.
+'''
+import asyncio
+import logging
+import weakref
+
+from django.conf import settings
+
+from .models import CrawlJob
+
+
+logger = logging.getLogger(__name__)
+
+_broadcasters = weakref.WeakKeyDictionary()
+
+
+def _offer(queue, job):
+    '''
+    Puts job on a queue of size one, replacing a job the client has not read yet.
+    '''
+    if queue.full():
+        queue.get_nowait()
+    queue.put_nowait(job)
+
+
+class JobBroadcaster:
+    '''
+    Polls the crawl jobs that have subscribers and fans each of them out to its subscribers.
+    The poll task runs only while someone is subscribed.
+    Args:
+      @ interval: seconds between two reads of the job rows.
+    '''
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._queues = {}
+        self._task = None
+
+    def subscribe(self, job):
+        '''
+        Starts watching a job.
+        Args:
+          @ job: the CrawlJob as last read, the first thing the queue yields.
+        Returns:
+          @ queue: an asyncio.Queue yielding the job every interval, or None once it is deleted.
+        '''
+        queue = asyncio.Queue(maxsize=1)
+        queue.put_nowait(job)
+        self._queues.setdefault(job.pk, set()).add(queue)
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._poll())
+        return queue
+
+    def unsubscribe(self, job_id, queue):
+        '''
+        Stops feeding a queue returned by subscribe.
+        '''
+        queues = self._queues.get(job_id)
+        if queues is None:
+            return
+        queues.discard(queue)
+        if not queues:
+            del self._queues[job_id]
+
+    async def _poll(self):
+        while self._queues:
+            await asyncio.sleep(self.interval)
+            job_ids = list(self._queues)
+            try:
+                jobs = {job.pk: job async for job in CrawlJob.objects.filter(pk__in=job_ids)}
+            except Exception as e:
+                # The stream falls back to keepalives until the database answers again.
+                logger.error('Failed to read crawl jobs for events: %s', e)
+                continue
+            for job_id in job_ids:
+                for queue in list(self._queues.get(job_id, ())):
+                    _offer(queue, jobs.get(job_id))
+
+
+def get_broadcaster():
+    '''
+    Returns the JobBroadcaster of the running event loop, reading settings.SCRAPER_EVENTS_INTERVAL.
+    '''
+    loop = asyncio.get_running_loop()
+    broadcaster = _broadcasters.get(loop)
+    if broadcaster is None:
+        broadcaster = _broadcasters[loop] = JobBroadcaster(getattr(settings, 'SCRAPER_EVENTS_INTERVAL', 1.0))
+    return broadcaster
@@ -0,0 +1,496 @@
+'''
+Helpers for the download view.
+
+Archives are streamed: every entry is written to the zip as soon as it has been
+rendered and the bytes are handed to the response right away, so memory use
+does not grow with the number of pages in a crawl. PDF rendering is CPU bound
+and is spread over a process pool shared by every download, results still
+come back in page order.
+Rendered files are cached on disk by content, so downloading unchanged pages
+again is a plain copy. The whole-crawl types (NDJSON, one CSV) skip the zip:
+every page becomes one record of a single file, encoded as it is read. The
+link graph types (edge list CSV, GraphML) are read straight from the Link table.
+'''
+import asyncio
+import csv
+import hashlib
+import io
+import json
+import multiprocessing
+import os
+import re
+import threading
+import time
+from collections import deque
+from concurrent.futures import CancelledError, Future, ProcessPoolExecutor, ThreadPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from functools import lru_cache
+from itertools import islice
+from xml.sax.saxutils import escape, quoteattr
+from zipfile import ZipFile
+
+import django
+from django.conf import settings
+from django.db import connections
+from django.template.loader import get_template
+
+from . import metrics
+from .cache import DiskCache
+from .graph import get_crawl_links
+from .models import Page
+
+
+# Bump when generate_pdf, generate_fast_pdf, generate_csv or generate_json change their output,
+# cached artifacts rendered by an older version are then ignored.
+ARTIFACT_VERSION = 2
+
+# Download types rendered as one file per page in a zip, and the extension of those files.
+PAGE_TYPES = {'pdf': 'pdf', 'pdf-fast': 'pdf', 'csv': 'csv', 'json': 'json'}
+
+# Page types whose files list the links of the page, they are loaded along with the pages.
+LINK_TYPES = ('pdf', 'pdf-fast')
+
+# Page types rendered in the process pool. Rendering the others costs less than
+# sending the page to another process and its file back.
+POOLED_TYPES = ('pdf', 'pdf-fast')
+
+
+class ZipChunkSink:
+    '''
+    Write-only file object that collects what ZipFile writes until it is drained.
+    It has no tell or seek, which makes ZipFile write data descriptors instead of
+    going back to patch local headers, so the archive can be sent as it is produced.
+    '''
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def stream_zip(entries):
+    '''
+    Generator producing a zip archive chunk by chunk.
+    Args:
+      @ entries: iterable of (filename, content bytes), consumed lazily.
+    Yields:
+      @ bytes of the archive, at least one chunk per entry.
+    '''
+    sink = ZipChunkSink()
+    with ZipFile(sink, 'w') as zf:
+        for filename, content in entries:
+            zf.writestr(filename, content)
+            yield sink.drain()
+    # Closing the archive writes the central directory.
+    yield sink.drain()
+
+
+# Download types written as one file for the whole crawl: content type and file extension.
+STREAM_TYPES = {
+    'ndjson': ('application/x-ndjson; charset=utf-8', 'ndjson'),
+    'crawl-csv': ('text/csv; charset=utf-8', 'csv'),
+}
+
+# Fields of every page in the whole-crawl exports, in CSV column order.
+RECORD_FIELDS = ('url', 'title', 'depth', 'parent_url', 'content')
+
+# Encoded records are sent in chunks of about this size rather than one per page.
+STREAM_CHUNK_BYTES = 64 * 1024
+
+
+def page_record(page):
+    return {field: getattr(page, field) for field in RECORD_FIELDS}
+
+
+def encode_ndjson(pages):
+    '''
+    Generator of one JSON object per page, each on its own line.
+    '''
+    for page in pages:
+        yield json.dumps(page_record(page), ensure_ascii=False) + '\n'
+
+
+def encode_csv(pages):
+    '''
+    Generator of a CSV file with a header row and one row per page.
+    Values are quoted when needed, so contents with newlines still make one record.
+    '''
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(RECORD_FIELDS)
+    for page in pages:
+        writer.writerow([getattr(page, field) for field in RECORD_FIELDS])
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
+
+def join_chunks(download_type, records, chunk_bytes=STREAM_CHUNK_BYTES):
+    '''
+    Generator encoding text records to UTF-8 and grouping them in chunks of about chunk_bytes.
+    '''
+    chunk, size = [], 0
+    for record in records:
+        data = record.encode('utf-8')
+        metrics.inc('scraper_bytes_rendered_total', len(data), type=download_type)
+        chunk.append(data)
+        size += len(data)
+        if size >= chunk_bytes:
+            yield b''.join(chunk)
+            chunk, size = [], 0
+    if chunk:
+        yield b''.join(chunk)
+
+
+def stream_records(download_type, pages, chunk_bytes=STREAM_CHUNK_BYTES):
+    '''
+    Generator producing a whole-crawl export chunk by chunk, one page held in memory at a time.
+    Args:
+      @ download_type: one of STREAM_TYPES.
+      @ pages: iterable of Page objects, consumed lazily.
+      @ chunk_bytes: records are buffered up to about this many bytes before being yielded.
+    Yields:
+      @ bytes of the file, UTF-8 encoded.
+    '''
+    encode = encode_ndjson if download_type == 'ndjson' else encode_csv
+
+    def counted():
+        for record in encode(pages):
+            metrics.inc('scraper_pages_rendered_total', type=download_type)
+            yield record
+
+    yield from join_chunks(download_type, counted(), chunk_bytes)
+
+
+# Link graph exports of a crawl: content type and file extension.
+GRAPH_TYPES = {
+    'edges-csv': ('text/csv; charset=utf-8', 'edges.csv'),
+    'graphml': ('application/graphml+xml; charset=utf-8', 'graphml'),
+}
+
+# Columns of the edge list, in order.
+EDGE_FIELDS = ('source', 'target', 'anchor_text', 'status')
+
+# Characters XML 1.0 does not allow, even escaped.
+XML_INVALID = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f\ufffe\uffff]')
+
+
+def encode_edges_csv(crawl_id):
+    '''
+    Generator of a CSV file with one row per link of a crawl: source URL, target URL, anchor text and status.
+    '''
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EDGE_FIELDS)
+    rows = (
+        get_crawl_links(crawl_id).order_by('source_id', 'id')
+        .values_list('source__url', 'target_url', 'anchor_text', 'status')
+    )
+    for row in rows.iterator():
+        writer.writerow(row)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
+
+def xml_text(value):
+    return escape(XML_INVALID.sub('', str(value)))
+
+
+def graph_node_id(url):
+    # Targets without a page of the crawl are identified by their URL, which is not a valid XML id as is.
+    return 'u' + hashlib.sha1(url.encode('utf-8')).hexdigest()[:16]
+
+
+def encode_graphml(crawl_id):
+    '''
+    Generator of a GraphML document of a crawl: one node per stored page and per
+    target URL that was not stored, one directed edge per link.
+    '''
+    links = get_crawl_links(crawl_id)
+    yield (
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        '<graphml xmlns="http://graphml.graphdrawing.org/xmlns">\n'
+        '<key id="url" for="node" attr.name="url" attr.type="string"/>\n'
+        '<key id="title" for="node" attr.name="title" attr.type="string"/>\n'
+        '<key id="depth" for="node" attr.name="depth" attr.type="int"/>\n'
+        '<key id="anchor_text" for="edge" attr.name="anchor_text" attr.type="string"/>\n'
+        '<key id="status" for="edge" attr.name="status" attr.type="string"/>\n'
+        f'<graph id="crawl-{crawl_id}" edgedefault="directed">\n'
+    )
+    pages = Page.objects.filter(crawl_id=crawl_id).order_by('id').values_list('pk', 'url', 'title', 'depth')
+    for pk, url, title, depth in pages.iterator():
+        yield (f'<node id="p{pk}"><data key="url">{xml_text(url)}</data><data key="title">{xml_text(title or "")}</data>'
+               f'<data key="depth">{depth}</data></node>\n')
+    others = links.filter(target__isnull=True).order_by('target_url').values_list('target_url', flat=True).distinct()
+    for url in others.iterator():
+        yield f'<node id="{graph_node_id(url)}"><data key="url">{xml_text(url)}</data></node>\n'
+    edges = links.order_by('source_id', 'id').values_list('source_id', 'target_id', 'target_url', 'anchor_text', 'status')
+    for source_id, target_id, target_url, anchor_text, status in edges.iterator():
+        target = f'p{target_id}' if target_id else graph_node_id(target_url)
+        yield (f'<edge source="p{source_id}" target={quoteattr(target)}><data key="anchor_text">{xml_text(anchor_text)}'
+               f'</data><data key="status">{status}</data></edge>\n')
+    yield '</graph>\n</graphml>\n'
+
+
+def stream_graph(download_type, crawl_id, chunk_bytes=STREAM_CHUNK_BYTES):
+    '''
+    Generator producing the link graph of a crawl chunk by chunk, as it is read from the database.
+    Args:
+      @ download_type: one of GRAPH_TYPES.
+      @ crawl_id: primary key of the CrawlJob.
+      @ chunk_bytes: rows are buffered up to about this many bytes before being yielded.
+    Yields:
+      @ bytes of the file, UTF-8 encoded.
+    '''
+    encode = encode_edges_csv if download_type == 'edges-csv' else encode_graphml
+    yield from join_chunks(download_type, encode(crawl_id), chunk_bytes)
+
+
+async def iterate_in_thread(chunks):
+    '''
+    Async generator over a blocking generator, for streaming responses of async views.
+    Every chunk is produced in one thread of its own, so the database cursor the pages
+    are read from stays in the thread that opened it and the event loop never blocks.
+    The thread only exists while the download does, and its connections are closed after.
+    Args:
+      @ chunks: generator of bytes, consumed lazily.
+    Yields:
+      @ the same bytes.
+    '''
+    loop = asyncio.get_running_loop()
+    executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='download')
+    done = object()
+
+    def step():
+        chunk = next(chunks, done)
+        # What the download renders shows up in the metrics of other processes while it runs.
+        metrics.persist(metrics.PERSIST_INTERVAL)
+        return chunk
+
+    try:
+        while True:
+            chunk = await loop.run_in_executor(executor, step)
+            if chunk is done:
+                break
+            yield chunk
+    finally:
+        # Stops rendering when the client goes away, then releases the thread's connection.
+        def close():
+            chunks.close()
+            connections.close_all()
+            metrics.persist()
+        await loop.run_in_executor(executor, close)
+        executor.shutdown(wait=False)
+
+
+@lru_cache
+def get_template_version(download_type):
+    '''
+    Version of the renderer for one download type, including the PDF template source.
+    '''
+    version = f'{ARTIFACT_VERSION}'
+    if download_type == 'pdf':
+        source = get_template('pdf_result.html').template.source
+        version += '-' + hashlib.sha256(source.encode('utf-8')).hexdigest()[:16]
+    return version
+
+
+class ArtifactCache(DiskCache):
+    '''
+    Rendered export files keyed by (page content hash, download type, template version).
+    Pages with the same URL and content share an entry, whoever crawled them.
+    Args:
+      @ download_type: one of PAGE_TYPES.
+    '''
+
+    NAME = 'artifact'
+    STATS = ('hits', 'misses', 'stored', 'evicted')
+
+    def __init__(self, download_type, directory=None, max_bytes=None):
+        super().__init__(
+            directory or getattr(settings, 'SCRAPER_ARTIFACT_CACHE_DIR', os.path.join(settings.MEDIA_ROOT, 'artifacts')),
+            max_bytes or getattr(settings, 'SCRAPER_ARTIFACT_CACHE_MAX_BYTES', 1024 * 1024 * 1024),
+        )
+        self.download_type = download_type
+        self.version = get_template_version(download_type)
+
+    def _key(self, page):
+        # Everything the generators read from a page goes into the key, the body by its hash.
+        digest = hashlib.sha256(f'{self.download_type}\0{self.version}'.encode('utf-8'))
+        for part in (page.url, page.title, page.blob_id):
+            digest.update(b'\0')
+            digest.update((part or '').encode('utf-8'))
+        # Only PDFs list the links of their page, they come prefetched with it.
+        if self.download_type in LINK_TYPES:
+            for link in page.outlinks.all():
+                digest.update(f'\0{link.target_url}\0{link.anchor_text}'.encode('utf-8'))
+        return digest.hexdigest()
+
+    def lookup(self, page):
+        content = self.read(self._key(page))
+        self.count('misses' if content is None else 'hits')
+        return content
+
+    def store(self, page, content):
+        self.put(self._key(page), content, {'url': page.url, 'type': self.download_type})
+
+
+def get_export_processes():
+    '''
+    Number of processes used to render exports, settings.SCRAPER_EXPORT_PROCESSES
+    or every core available to this process.
+    '''
+    processes = getattr(settings, 'SCRAPER_EXPORT_PROCESSES', None)
+    if processes:
+        return processes
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+# The render pool, started by the first download that needs it and shared by every later one.
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_render_pool(processes):
+    '''
+    Returns the process pool shared by every download, starting it if needed.
+    Its processes are started by a fork server, or spawned, never forked from
+    the request thread with the server's threads and connections in them.
+    Args:
+      @ processes: pool size, used when the pool is started.
+    '''
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            methods = multiprocessing.get_all_start_methods()
+            context = multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+            # Pool processes render templates, which needs the app registry and settings.
+            _pool = ProcessPoolExecutor(max_workers=processes, mp_context=context, initializer=django.setup)
+        return _pool
+
+
+def retire_render_pool(pool):
+    '''
+    Stops handing work to a pool whose process is stuck on a render. Renders
+    queued in it are cancelled, their downloads send them to the next pool.
+    The stuck process exits once its render returns.
+    '''
+    global _pool
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def _timed_render(render, item):
+    # Pool processes have their own metrics registry, the duration goes back with the result.
+    start = time.perf_counter()
+    content = render(item)
+    return content, time.perf_counter() - start
+
+
+def render_all(render, items, processes=None, timeout=None, cache=None):
+    '''
+    Renders items, in the shared process pool when more than one process is available.
+    Only a few items per process are submitted ahead of the one being waited
+    for, so memory stays bounded however many items there are.
+    Args:
+      @ render: module level callable(item) -> bytes, so that it can be pickled.
+      @ items: iterable of picklable items, consumed lazily.
+      @ processes: processes to render with, defaults to get_export_processes().
+        1 renders in the calling thread.
+      @ timeout: seconds to wait for one item before giving up on it,
+        defaults to settings.SCRAPER_EXPORT_PAGE_TIMEOUT.
+      @ cache: optional ArtifactCache, items found in it are not rendered again.
+    Yields:
+      @ (item, content, error) in input order, content is None when error is set.
+    '''
+    processes = processes or get_export_processes()
+    timeout = timeout or getattr(settings, 'SCRAPER_EXPORT_PAGE_TIMEOUT', 60)
+
+    if processes <= 1:
+        for item in items:
+            content = cache.lookup(item) if cache else None
+            if content is not None:
+                yield item, content, None
+                continue
+            try:
+                with metrics.timer('render'):
+                    content, error = render(item), None
+            except Exception as e:
+                content, error = None, str(e)
+            else:
+                if cache:
+                    cache.store(item, content)
+            yield item, content, error
+        return
+
+    items = iter(items)
+    pending = deque()
+
+    def send(item):
+        while True:
+            pool = get_render_pool(processes)
+            try:
+                return item, pool.submit(_timed_render, render, item), pool
+            except RuntimeError:
+                # Retired by another download in the meantime, or broken by a process that died.
+                retire_render_pool(pool)
+
+    def submit(item):
+        content = cache.lookup(item) if cache else None
+        if content is not None:
+            future = Future()
+            future.set_result((content, None))
+            pending.append((item, future, None))
+        else:
+            pending.append(send(item))
+
+    try:
+        for item in islice(items, processes * 2):
+            submit(item)
+
+        while pending:
+            item, future, pool = pending.popleft()
+            cached = pool is None
+            try:
+                (content, elapsed), error = future.result(timeout=timeout), None
+            except CancelledError:
+                # The pool was retired by a stuck render, of this download or another one.
+                pending.appendleft(send(item))
+                continue
+            except TimeoutError:
+                # The process rendering it can not be interrupted, the pool is left to it.
+                retire_render_pool(pool)
+                content, error = None, f'Rendering timed out after {timeout}s'
+            except BrokenProcessPool as e:
+                retire_render_pool(pool)
+                content, error = None, str(e)
+            except Exception as e:
+                content, error = None, str(e)
+            else:
+                if not cached:
+                    metrics.observe('scraper_stage_seconds', elapsed, stage='render')
+                if cache and not cached:
+                    cache.store(item, content)
+
+            for next_item in islice(items, 1):
+                submit(next_item)
+            yield item, content, error
+    finally:
+        # A download closed early leaves nothing queued in the shared pool.
+        for _, future, _ in pending:
+            future.cancel()
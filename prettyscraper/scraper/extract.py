@@ -0,0 +1,177 @@
+'''
+Main-text extraction for crawls that only want the readable content of pages.
+
+Scripts, styles, navigation, footers, sidebars and other boilerplate are
+dropped, the block holding most of the page's paragraph text is kept along
+with its own <header>, and it is written back as compact HTML with only
+headings, paragraphs, list items, quotes, preformatted text and links. Text
+outside of those, loose or in a <div> or table cell, becomes a paragraph.
+Links are still collected from the full page by parse_page, so the crawl
+follows the same links either way.
+'''
+import re
+from collections import defaultdict
+from html import escape
+
+from bs4 import BeautifulSoup, Comment, Doctype, NavigableString, Tag
+
+from .parsers import lxml
+
+
+# Elements that never hold readable content. <header> is not one of them: the
+# page banner is left out with everything else outside the main block, the
+# header of an article (its title, byline) is kept with it.
+DROPPED_TAGS = (
+    'script', 'style', 'noscript', 'template', 'iframe', 'svg', 'canvas', 'object', 'embed',
+    'form', 'button', 'input', 'select', 'textarea', 'nav', 'footer', 'aside',
+)
+
+# Class or id of chrome around the content.
+BOILERPLATE = re.compile(
+    r'nav|menu|footer|header|sidebar|comment|share|social|advert|\bads?\b|banner|cookie|'
+    r'related|breadcrumb|promo|popup|subscribe|newsletter|masthead|widget',
+    re.I,
+)
+
+# Tags written to the extracted document, everything else is unwrapped to its text.
+BLOCK_TAGS = ('h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'p', 'li', 'blockquote', 'pre')
+
+# Tags that flow within a line of text. Any other tag ends the paragraph of loose text before it.
+INLINE_TAGS = (
+    'a', 'abbr', 'b', 'bdi', 'bdo', 'br', 'cite', 'code', 'data', 'del', 'dfn', 'em', 'font', 'i', 'img',
+    'ins', 'kbd', 'label', 'mark', 'q', 's', 'samp', 'small', 'span', 'strong', 'sub', 'sup', 'time', 'u', 'var',
+)
+
+LIST_TAGS = ('ul', 'ol')
+
+WHITESPACE = re.compile(r'\s+')
+
+
+def _is_boilerplate(tag):
+    if tag.attrs is None:
+        return False
+    if tag.get('role') in ('navigation', 'banner', 'contentinfo', 'complementary'):
+        return True
+    names = ' '.join(tag.get('class') or []) + ' ' + (tag.get('id') or '')
+    # The main container is sometimes called content-header or similar, keep anything that says main.
+    return bool(BOILERPLATE.search(names)) and not re.search(r'main|article|content', names, re.I)
+
+
+def _text_length(tag):
+    return len(WHITESPACE.sub(' ', tag.get_text(' ')).strip())
+
+
+def _link_density(tag):
+    length = _text_length(tag)
+    if not length:
+        return 1.0
+    return sum(_text_length(a) for a in tag.find_all('a')) / length
+
+
+def find_main_block(soup):
+    '''
+    Returns the element holding the main content: <article> or <main> when the page
+    has one, otherwise the block whose paragraphs have the most text, penalized by
+    the share of that text that is links.
+    '''
+    for candidate in (soup.find('article'), soup.find('main'), soup.find(attrs={'role': 'main'})):
+        if candidate is not None and _text_length(candidate) > 200:
+            return candidate
+
+    # Tags compare equal by markup, so two identical blocks would share a score: key them by id().
+    candidates = {}
+    scores = defaultdict(float)
+    for paragraph in soup.find_all(('p', 'pre', 'td')):
+        length = _text_length(paragraph)
+        # The text of the page banner does not make it the main block.
+        if length < 25 or paragraph.find_parent('header') is not None:
+            continue
+        score = 1 + paragraph.get_text().count(',') + min(length / 100, 3)
+        # A paragraph counts fully for its parent and half for its grandparent.
+        for ancestor, share in ((paragraph.parent, 1), (paragraph.parent and paragraph.parent.parent, 0.5)):
+            if ancestor is not None:
+                candidates[id(ancestor)] = ancestor
+                scores[id(ancestor)] += score * share
+
+    if not scores:
+        return soup.body or soup
+    best = max(scores, key=lambda key: scores[key] * (1 - _link_density(candidates[key])))
+    return candidates[best]
+
+
+def _inline_html(nodes):
+    '''
+    Text of a run of nodes with their links kept, everything else flattened.
+    '''
+    parts = []
+    for node in nodes:
+        if isinstance(node, (Comment, Doctype)):
+            continue
+        if isinstance(node, NavigableString):
+            parts.append(escape(str(node)))
+        elif node.name == 'a':
+            text = escape(WHITESPACE.sub(' ', node.get_text(' ')).strip())
+            href = node.get('href')
+            parts.append(f'<a href="{escape(href)}">{text}</a>' if href and text else text)
+        elif node.name == 'br':
+            parts.append(' ')
+        elif isinstance(node, Tag):
+            parts.append(_inline_html(node.children))
+    return WHITESPACE.sub(' ', ''.join(parts)).strip()
+
+
+def _write_blocks(element, out, wrap='p'):
+    '''
+    Appends the blocks of an element to out. Loose text and inline elements between
+    blocks are written as one wrap element per run.
+    '''
+    run = []
+
+    def flush():
+        text = _inline_html(run)
+        if text:
+            out.append(f'<{wrap}>{text}</{wrap}>')
+        run.clear()
+
+    for child in element.children:
+        if not isinstance(child, Tag) or child.name in INLINE_TAGS:
+            run.append(child)
+            continue
+        flush()
+        if child.name == 'li' and child.find(LIST_TAGS) is not None:
+            # An item holding a nested list is written as its own text, then the nested items.
+            _write_blocks(child, out, wrap='li')
+        elif child.name in BLOCK_TAGS:
+            text = child.get_text() if child.name == 'pre' else _inline_html(child.children)
+            if text.strip():
+                body = escape(text) if child.name == 'pre' else text
+                out.append(f'<{child.name}>{body}</{child.name}>')
+        else:
+            _write_blocks(child, out)
+    flush()
+
+
+def extract_main_text(text):
+    '''
+    Reduces a page to its main readable content.
+    Args:
+      @ text: the decoded page.
+    Returns:
+      @ html: compact HTML of headings, paragraphs, list items, quotes,
+        preformatted blocks and links.
+    '''
+    soup = BeautifulSoup(text, 'lxml' if lxml is not None else 'html.parser')
+    for tag in soup.find_all(DROPPED_TAGS):
+        tag.decompose()
+    for tag in soup.find_all(_is_boilerplate):
+        tag.decompose()
+
+    main = find_main_block(soup)
+    # When the main block is the whole page, its top-level headers are the page banner.
+    if main.name in ('[document]', 'html', 'body'):
+        for tag in main.find_all('header'):
+            if tag.find_parent(('article', 'main', 'section')) is None:
+                tag.decompose()
+    out = []
+    _write_blocks(main, out)
+    return '\n'.join(out)
@@ -0,0 +1,265 @@
+'''
+Crawl frontier: URL canonicalization, the visited set and the queue of pages
+waiting to be fetched.
+'''
+import hashlib
+import heapq
+import math
+import time
+from collections import defaultdict, deque
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+from django.conf import settings
+
+
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+
+def canonicalize_url(url, sort_query=None):
+    '''
+    Normalizes a URL so that trivially different spellings of one page compare equal.
+    Drops the fragment and default port, lowercases scheme and host, and strips
+    trailing slashes from non-root paths.
+    Args:
+      @ url: an absolute URL.
+      @ sort_query: sort query parameters, defaults to settings.SCRAPER_SORT_QUERY.
+    Returns:
+      @ url: the canonical URL, or the input unchanged if it can not be parsed.
+    '''
+    if sort_query is None:
+        sort_query = getattr(settings, 'SCRAPER_SORT_QUERY', False)
+
+    try:
+        parts = urlsplit(url.strip())
+        port = parts.port
+    except ValueError:
+        return url
+
+    scheme = parts.scheme.lower()
+    if scheme not in DEFAULT_PORTS or not parts.hostname:
+        return url
+
+    netloc = parts.hostname.lower()
+    if ':' in netloc:
+        netloc = f'[{netloc}]'
+    if port and port != DEFAULT_PORTS[scheme]:
+        netloc = f'{netloc}:{port}'
+    if parts.username:
+        userinfo = parts.username if parts.password is None else f'{parts.username}:{parts.password}'
+        netloc = f'{userinfo}@{netloc}'
+
+    path = parts.path or '/'
+    if len(path) > 1:
+        path = path.rstrip('/') or '/'
+
+    query = parts.query
+    if sort_query and query:
+        query = urlencode(sorted(parse_qsl(query, keep_blank_values=True)))
+
+    return urlunsplit((scheme, netloc, path, query, ''))
+
+
+def get_host(url):
+    '''
+    Returns the lowercased network location of a URL, used to group fetches per host.
+    '''
+    return urlsplit(url).netloc.lower()
+
+
+class BloomFilter:
+    '''
+    Memory-bounded visited set for very large crawls.
+    May report a URL that was never added as seen (with probability error_rate
+    once capacity URLs are stored), never the other way around.
+    Args:
+      @ capacity: expected number of URLs.
+      @ error_rate: acceptable false positive rate at capacity.
+    '''
+
+    def __init__(self, capacity, error_rate=0.001):
+        self.size = max(8, int(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, item):
+        # Double hashing: k positions derived from two 64 bit halves of one digest.
+        digest = hashlib.blake2b(item.encode('utf-8'), digest_size=16).digest()
+        a = int.from_bytes(digest[:8], 'little')
+        b = int.from_bytes(digest[8:], 'little') | 1
+        return ((a + i * b) % self.size for i in range(self.hashes))
+
+    def add(self, item):
+        for position in self._positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, item):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(item))
+
+
+def make_visited_set():
+    '''
+    Builds the visited set selected by settings.SCRAPER_VISITED_SET ('exact' or 'bloom').
+    '''
+    if getattr(settings, 'SCRAPER_VISITED_SET', 'exact') == 'bloom':
+        return BloomFilter(
+            getattr(settings, 'SCRAPER_BLOOM_CAPACITY', 1_000_000),
+            getattr(settings, 'SCRAPER_BLOOM_ERROR_RATE', 0.001),
+        )
+    return set()
+
+
+class Frontier:
+    '''
+    Queue of URLs waiting to be fetched in one crawl.
+    URLs are canonicalized and every canonical URL is handed out at most once.
+    Queues are kept per host, ordered by depth then arrival, so the crawl goes
+    breadth first: the shallowest task of any ready host is handed out next,
+    hosts with tasks at the same depth take turns. Hosts that already have
+    per_host fetches in flight or that politeness holds back are skipped.
+    Args:
+      @ per_host: maximum number of fetches in flight against one host.
+      @ visited: a set-like object with add and __contains__.
+      @ politeness: optional Politeness deciding when each host may be fetched
+        and which of its URLs robots.txt allows.
+      @ max_attempts: times a throttled URL is tried before it is given up on,
+        defaults to settings.SCRAPER_THROTTLE_RETRIES + 1.
+      @ scope: optional ScopePolicy, links it does not allow are not queued.
+    '''
+
+    def __init__(self, per_host, visited=None, politeness=None, max_attempts=None, scope=None):
+        self.per_host = per_host
+        self.visited = visited if visited is not None else make_visited_set()
+        self.politeness = politeness
+        self.scope = scope
+        self.max_attempts = max_attempts or getattr(settings, 'SCRAPER_THROTTLE_RETRIES', 3) + 1
+        self.out_of_scope = 0
+        self._queues = defaultdict(list)
+        self._hosts = deque()
+        self._host_load = defaultdict(int)
+        self._attempts = defaultdict(int)
+        self._seq = 0
+        self._size = 0
+        self._known_hosts = set()
+        # Hosts whose robots.txt has to be fetched, and tasks robots.txt disallows.
+        self._new_hosts = []
+        self._disallowed = []
+
+    def __len__(self):
+        return self._size
+
+    def _enqueue(self, task, first=False):
+        host = get_host(task[0])
+        if not self._queues[host]:
+            self._hosts.append(host)
+        # Within a depth tasks come out in arrival order, requeued ones first.
+        self._seq += 1
+        heapq.heappush(self._queues[host], (task[1], -self._seq if first else self._seq, task))
+        self._size += 1
+        return host
+
+    def push(self, url, depth, parent):
+        '''
+        Queues a URL unless its canonical form was already seen in this crawl,
+        or the scope does not allow it.
+        Args:
+          @ url: URL to fetch.
+          @ depth: level of the page in the crawl.
+          @ parent: the Page the URL was found on, None for the root.
+        Returns:
+          @ url: the canonical URL if it was queued, otherwise None.
+        '''
+        url = canonicalize_url(url)
+        if url in self.visited:
+            return None
+        if self.scope and parent is not None and not self.scope.allows(url):
+            self.out_of_scope += 1
+            return None
+        self.visited.add(url)
+
+        host = self._enqueue((url, depth, parent))
+        if host not in self._known_hosts:
+            self._known_hosts.add(host)
+            if self.politeness and self.politeness.needs_robots(host):
+                self._new_hosts.append((host, url))
+        return url
+
+    def requeue(self, task):
+        '''
+        Puts back a task whose fetch was throttled, at the head of its host's queue.
+        Returns:
+          @ Boolean: False once the URL has used up its attempts.
+        '''
+        self._attempts[task[0]] += 1
+        if self._attempts[task[0]] >= self.max_attempts:
+            return False
+        self._enqueue(task, first=True)
+        return True
+
+    def take_new_hosts(self):
+        '''
+        Returns and forgets the (host, url) pairs of hosts whose robots.txt is needed.
+        '''
+        new_hosts, self._new_hosts = self._new_hosts, []
+        return new_hosts
+
+    def take_disallowed(self):
+        '''
+        Returns and forgets the tasks that robots.txt did not allow to fetch.
+        '''
+        disallowed, self._disallowed = self._disallowed, []
+        return disallowed
+
+    def _wait_time(self, host, now):
+        return self.politeness.wait_time(host, now) if self.politeness else 0.0
+
+    def pop(self):
+        '''
+        Takes the shallowest task of the hosts that are ready and have a free slot,
+        and counts it as in flight.
+        Returns:
+          @ (url, depth, parent), or None if no host can take another fetch right now.
+        '''
+        now = time.monotonic()
+        while True:
+            best = None
+            for index, host in enumerate(self._hosts):
+                if self._host_load[host] >= self.per_host or self._wait_time(host, now) > 0:
+                    continue
+                if best is None or self._queues[host][0][0] < best_depth:
+                    best, best_depth = index, self._queues[host][0][0]
+            if best is None:
+                return None
+
+            # The host goes to the back of the line, so hosts at the same depth take turns.
+            host = self._hosts[best]
+            del self._hosts[best]
+            _, _, task = heapq.heappop(self._queues[host])
+            if self._queues[host]:
+                self._hosts.append(host)
+            else:
+                del self._queues[host]
+            self._size -= 1
+            if self.politeness and not self.politeness.allowed(host, task[0]):
+                self._disallowed.append(task)
+                continue
+            self._host_load[host] += 1
+            if self.politeness:
+                self.politeness.dispatched(host, now)
+            return task
+
+    def next_ready_in(self):
+        '''
+        Seconds until pop can hand out a task that only politeness holds back.
+        Returns:
+          @ seconds, or None if every queued host waits for a free slot or its robots.txt.
+        '''
+        now = time.monotonic()
+        waits = [self._wait_time(host, now) for host in self._hosts if self._host_load[host] < self.per_host]
+        waits = [wait for wait in waits if wait != math.inf]
+        return max(0.0, min(waits)) if waits else None
+
+    def done(self, url):
+        '''
+        Releases the in-flight slot taken by pop for this URL.
+        '''
+        self._host_load[get_host(url)] -= 1
@@ -0,0 +1,65 @@
+'''
+The link graph of a crawl.
+
+Every stored page has its links in the Link table, one row per target, written
+by PageWriter with the page. Once a crawl finishes, resolve_links points each
+link at the page stored for its target in the same crawl and records whether
+that target was crawled, broken or not followed. The graph questions below are
+then answered by indexed queries, without decoding anything in Python.
+'''
+from django.db.models import Case, Count, Exists, OuterRef, Subquery, Value, When
+
+from .crawler import ROBOTS_DISALLOWED
+from .frontier import canonicalize_url
+from .models import Link, Page, SkippedPage
+
+
+def resolve_links(crawl_job):
+    '''
+    Resolves the targets and statuses of every link of a finished crawl, in two UPDATE statements.
+    A target the crawl tried and failed to fetch is broken, one it did not follow
+    (out of scope, too deep, over budget or disallowed by robots.txt) is not crawled.
+    Args:
+      @ crawl_job: the CrawlJob whose pages the links were found on.
+    Returns:
+      @ count: number of links resolved.
+    '''
+    links = Link.objects.filter(source__crawl=crawl_job)
+    # Pages are looked up through the (user_id, url) index, there are few per URL.
+    targets = Page.objects.filter(user_id=crawl_job.user_id, url=OuterRef('target_url'), crawl=crawl_job)
+    failed = SkippedPage.objects.filter(crawl=crawl_job, url=OuterRef('target_url')).exclude(reason=ROBOTS_DISALLOWED)
+    links.update(target=Subquery(targets.order_by('id').values('pk')[:1]))
+    return links.update(status=Case(
+        When(target__isnull=False, then=Value(Link.CRAWLED)),
+        When(Exists(failed), then=Value(Link.BROKEN)),
+        default=Value(Link.NOT_CRAWLED),
+    ))
+
+
+def get_crawl_links(crawl_id):
+    '''
+    Returns a queryset of the links found on the pages of a crawl.
+    '''
+    return Link.objects.filter(source__crawl_id=crawl_id)
+
+
+def get_broken_links(crawl_id):
+    '''
+    Returns a queryset of the links of a crawl whose target could not be fetched, with their source page.
+    '''
+    return get_crawl_links(crawl_id).filter(status=Link.BROKEN).select_related('source')
+
+
+def get_linking_pages(crawl_id, url):
+    '''
+    Returns a queryset of the pages of a crawl that link to url, whether it was crawled or not.
+    '''
+    return Page.objects.filter(crawl_id=crawl_id, outlinks__target_url=canonicalize_url(url)).distinct()
+
+
+def get_in_degrees(crawl_id):
+    '''
+    Returns a queryset of the pages of a crawl annotated with in_degree, the number
+    of pages of the crawl linking to them, most linked first.
+    '''
+    return Page.objects.filter(crawl_id=crawl_id).annotate(in_degree=Count('inlinks')).order_by('-in_degree', 'id')
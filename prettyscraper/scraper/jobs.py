@@ -0,0 +1,167 @@
+'''
+Background crawl jobs.
+
+The scrape view only queues a CrawlJob; crawl_worker processes claim queued
+jobs from the database, run the crawl outside of any HTTP request and write
+progress back to the job row for the status and events endpoints to report.
+A distributed job is claimed by one worker like any other, then every idle
+worker joins it and they share its frontier, see distributed.py. A job whose
+worker died stops getting heartbeats and is queued again by another worker.
+'''
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from . import metrics
+from .distributed import claimable, crawl_distributed, finish_distributed_job
+from .models import CrawlJob, FrontierEntry, SkippedPage
+from .scope import ScopePolicy
+from .views import crawl
+
+
+# Minimum seconds between two progress writes of one job.
+PROGRESS_INTERVAL = 1.0
+
+
+def claim_next_job(pk=None):
+    '''
+    Atomically moves the oldest queued job to running.
+    The status check in the update makes sure two workers never claim the same job.
+    Args:
+      @ pk: only claim the job with this id.
+    Returns:
+      @ job: the claimed CrawlJob, or None if the queue is empty.
+    '''
+    while True:
+        with transaction.atomic():
+            queued = CrawlJob.objects.filter(status=CrawlJob.QUEUED)
+            if pk is not None:
+                queued = queued.filter(pk=pk)
+            job = queued.order_by('created_at', 'id').first()
+            if job is None:
+                return None
+            now = timezone.now()
+            claimed = CrawlJob.objects.filter(pk=job.pk, status=CrawlJob.QUEUED).update(
+                status=CrawlJob.RUNNING, started_at=now, heartbeat_at=now, attempts=F('attempts') + 1)
+        if claimed:
+            job.status = CrawlJob.RUNNING
+            job.started_at = job.heartbeat_at = now
+            job.attempts += 1
+            return job
+
+
+def recover_stale_jobs(now=None):
+    '''
+    Queues again the running jobs that had no heartbeat for settings.SCRAPER_JOB_STALE_SECONDS,
+    their worker presumably died, or fails those already claimed settings.SCRAPER_JOB_ATTEMPTS times.
+    Distributed jobs are left alone: the leases of a dead worker expire and the others carry on.
+    Args:
+      @ now: the time heartbeats are compared with, defaults to the current time.
+    Returns:
+      @ count: number of jobs queued again or failed.
+    '''
+    now = now or timezone.now()
+    cutoff = now - timedelta(seconds=getattr(settings, 'SCRAPER_JOB_STALE_SECONDS', 300))
+    attempts = getattr(settings, 'SCRAPER_JOB_ATTEMPTS', 3)
+    stale = CrawlJob.objects.filter(
+        Q(heartbeat_at__lt=cutoff) | Q(heartbeat_at__isnull=True, started_at__lt=cutoff),
+        status=CrawlJob.RUNNING, distributed=False,
+    )
+    failed = stale.filter(attempts__gte=attempts).update(
+        status=CrawlJob.FAILED, error=f'The crawl worker running the job stopped {attempts} times.', pages_queued=0,
+        pages_in_flight=0, finished_at=now,
+    )
+    requeued = stale.filter(attempts__lt=attempts).update(
+        status=CrawlJob.QUEUED, started_at=None, heartbeat_at=None, pages_in_flight=0)
+    return failed + requeued
+
+
+def join_next_job(pk=None):
+    '''
+    Finds the oldest running distributed job with entries left to claim, for an idle worker to help with.
+    Args:
+      @ pk: only join the job with this id.
+    Returns:
+      @ job: the CrawlJob, or None if no job needs help.
+    '''
+    entries = FrontierEntry.objects.filter(claimable(timezone.now()), crawl__status=CrawlJob.RUNNING,
+                                           crawl__distributed=True)
+    if pk is not None:
+        entries = entries.filter(crawl_id=pk)
+    crawl_id = entries.order_by('crawl_id').values_list('crawl_id', flat=True).first()
+    return CrawlJob.objects.filter(pk=crawl_id).first() if crawl_id else None
+
+
+def run_distributed_job(job):
+    '''
+    Works on a distributed job alongside the other workers, and finishes it if
+    this worker is the last one with work. Progress is written to the job row
+    by the shared frontier, as counts added to those of the other workers.
+    Args:
+      @ job: a running CrawlJob with distributed set.
+    Returns:
+      @ job: the same CrawlJob, refreshed. Still running if other workers are not done.
+    '''
+    try:
+        crawl_distributed(job, progress=lambda stats: metrics.persist(PROGRESS_INTERVAL))
+    except Exception as e:
+        # Leases this worker held were released or will expire, the others carry on without it.
+        CrawlJob.objects.filter(pk=job.pk).update(error=str(e))
+    if not finish_distributed_job(job):
+        job.refresh_from_db()
+    metrics.persist()
+    return job
+
+
+def run_job(job):
+    '''
+    Runs the crawl of a claimed job and records its progress and outcome.
+    Args:
+      @ job: a CrawlJob in the running state.
+    Returns:
+      @ job: the same CrawlJob, done or failed.
+    '''
+    if job.distributed:
+        return run_distributed_job(job)
+    last_write = 0.0
+
+    def progress(stats):
+        nonlocal last_write
+        job.pages_fetched = stats['fetched']
+        job.pages_queued = stats['queued']
+        job.pages_failed = stats['failed']
+        job.pages_in_flight = stats['in_flight']
+        if time.monotonic() - last_write < PROGRESS_INTERVAL:
+            return
+        last_write = time.monotonic()
+        job.heartbeat_at = timezone.now()
+        job.save(update_fields=['pages_fetched', 'pages_queued', 'pages_failed', 'pages_in_flight', 'heartbeat_at'])
+        # The metrics view runs in the web server, make this worker's numbers visible to it.
+        metrics.persist()
+
+    if job.attempts > 1:
+        # The worker of an earlier attempt died, the URLs it skipped are recorded again.
+        SkippedPage.objects.filter(crawl=job).delete()
+    try:
+        scope = ScopePolicy(job.root_url, scope=job.scope or None, max_pages=job.max_pages)
+        root_stored = crawl(job.user_id, job.root_url, job.max_depth, progress=progress, crawl_job=job, scope=scope,
+                            extract=job.extract_text)
+    except Exception as e:
+        job.status = CrawlJob.FAILED
+        job.error = str(e)
+    else:
+        job.status = CrawlJob.DONE if root_stored else CrawlJob.FAILED
+        if not root_stored:
+            job.error = 'The root page could not be fetched.'
+
+    job.pages_queued = 0
+    job.pages_in_flight = 0
+    job.finished_at = timezone.now()
+    job.save(update_fields=['status', 'error', 'pages_fetched', 'pages_queued', 'pages_failed', 'pages_in_flight',
+                            'pages_unchanged', 'finished_at'])
+    metrics.persist()
+    return job
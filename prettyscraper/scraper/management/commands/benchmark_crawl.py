@@ -0,0 +1,50 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from scraper.bench import SyntheticSite, run_benchmark
+
+
+class Command(BaseCommand):
+    help = ('Crawls a synthetic site served from a local HTTP server through the scrape and download views, '
+            'and prints pages/s, fetch latency, peak memory, query counts and export throughput as JSON.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--fan-out', type=int, default=5, help='Links to child pages on every page.')
+        parser.add_argument('--depth', type=int, default=3, help='Levels of the site, also the crawl depth.')
+        parser.add_argument('--page-bytes', type=int, default=20000, help='Approximate size of every page.')
+        parser.add_argument('--latency', type=float, default=0.02, help='Seconds every response is delayed by.')
+        parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of pages answering 500.')
+        parser.add_argument('--cycles', action='store_true',
+                            help='Also link every page to the root, its parent and a sibling.')
+        parser.add_argument('--seed', type=int, default=0, help='Seed of the generated site.')
+        parser.add_argument('--downloads', default='csv,json',
+                            help='Comma separated download types to benchmark after the crawl, empty for none.')
+        parser.add_argument('--host-rate', type=float, default=1000.0,
+                            help='Per-host request rate used for the crawl, requests per second.')
+        parser.add_argument('--output', help='Also append the report as one JSON line to this file.')
+        parser.add_argument('--keep', action='store_true', help='Crawl into the configured database and leave the crawled pages there, '
+                                 'instead of a throwaway database dropped after the run.')
+        parser.add_argument('--workers', type=int, default=0,
+                            help='Crawl as a distributed job with this many worker processes, 0 crawls in-process.')
+        parser.add_argument('--concurrency', type=int, help='Fetches in flight per worker.')
+
+    def handle(self, *args, **options):
+        site = SyntheticSite(
+            fan_out=options['fan_out'],
+            depth=options['depth'],
+            page_bytes=options['page_bytes'],
+            latency=options['latency'],
+            error_rate=options['error_rate'],
+            cycles=options['cycles'],
+            seed=options['seed'],
+        )
+        download_types = [name for name in options['downloads'].split(',') if name]
+        with site:
+            report = run_benchmark(site, download_types, host_rate=options['host_rate'], keep=options['keep'],
+                                   workers=options['workers'], concurrency=options['concurrency'])
+
+        if options['output']:
+            with open(options['output'], 'a') as f:
+                f.write(json.dumps(report) + '\n')
+        self.stdout.write(json.dumps(report, indent=2))
@@ -0,0 +1,49 @@
+import time
+from pathlib import Path
+
+from django.core.management.base import BaseCommand, CommandError
+
+from scraper.models import PageBlob
+from scraper.parsers import PARSERS, decode_body, lxml
+
+
+class Command(BaseCommand):
+    help = 'Compares the speed of the title/link parser backends on a corpus of saved pages.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--corpus', help='Directory of saved .html pages. Defaults to page bodies stored in the database.')
+        parser.add_argument('--limit', type=int, default=500, help='Maximum number of pages to load.')
+        parser.add_argument('--repeat', type=int, default=3, help='Passes over the corpus per backend, the best one is reported.')
+
+    def load_corpus(self, options):
+        if options['corpus']:
+            paths = sorted(Path(options['corpus']).rglob('*.htm*'))[:options['limit']]
+            return [decode_body(path.read_bytes()) for path in paths]
+        return [blob.unpack() for blob in PageBlob.objects.all()[:options['limit']]]
+
+    def handle(self, *args, **options):
+        corpus = self.load_corpus(options)
+        if not corpus:
+            raise CommandError('The corpus is empty, crawl something or pass --corpus.')
+        megabytes = sum(len(text.encode('utf-8')) for text in corpus) / 1e6
+        self.stdout.write(f'{len(corpus)} pages, {megabytes:.1f} MB')
+
+        reference = [PARSERS['soup'](text) for text in corpus]
+        for name, parse in PARSERS.items():
+            if name == 'lxml' and lxml is None:
+                self.stdout.write(f'{name:>8}: skipped, lxml is not installed')
+                continue
+
+            best = None
+            for _ in range(options['repeat']):
+                start = time.perf_counter()
+                results = [parse(text) for text in corpus]
+                elapsed = time.perf_counter() - start
+                best = elapsed if best is None else min(best, elapsed)
+
+            # Pages whose link list differs from BeautifulSoup's, as a sanity check.
+            differ = sum(len(result[1]) != len(expected[1]) for result, expected in zip(results, reference))
+            self.stdout.write(
+                f'{name:>8}: {len(corpus) / best:9.1f} pages/s {megabytes / best:8.2f} MB/s'
+                f' ({differ} pages with a different link count than soup)'
+            )
@@ -0,0 +1,36 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from scraper.jobs import claim_next_job, join_next_job, recover_stale_jobs, run_job
+
+
+class Command(BaseCommand):
+    help = ('Runs queued crawl jobs. Start as many workers as you like, each job is claimed by one of them. '
+            'Idle workers join running distributed jobs.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--poll-interval', type=float, default=1.0,
+                            help='Seconds to wait before looking again when the queue is empty.')
+        parser.add_argument('--once', action='store_true',
+                            help='Exit once the queue is empty instead of polling forever.')
+
+    def handle(self, *args, **options):
+        while True:
+            recovered = recover_stale_jobs()
+            if recovered:
+                self.stdout.write(f'Recovered {recovered} crawl jobs whose worker stopped')
+            job = claim_next_job() or join_next_job()
+            if job is None:
+                if options['once']:
+                    return
+                time.sleep(options['poll_interval'])
+                continue
+
+            mode = ' (distributed)' if job.distributed else ''
+            self.stdout.write(f'Running crawl job {job.pk}{mode}: {job.root_url} (depth {job.max_depth})')
+            job = run_job(job)
+            self.stdout.write(
+                f'Crawl job {job.pk} {job.status}: {job.pages_fetched} pages fetched, '
+                f'{job.pages_failed} failed in {job.elapsed():.1f}s'
+            )
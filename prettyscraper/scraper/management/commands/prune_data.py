@@ -0,0 +1,58 @@
+import json
+import time
+
+from django.core.management.base import BaseCommand
+
+from scraper import metrics
+from scraper.retention import RetentionPolicy
+
+
+DAY = 24 * 3600
+
+
+class Command(BaseCommand):
+    help = ('Deletes finished crawls past their TTL or their user\'s quota and users idle past theirs, '
+            'in small batches, then returns the freed space to the filesystem. Prints what was freed as JSON.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--crawl-ttl', type=float, default=None,
+                            help='Days after which a finished crawl expires (default: SCRAPER_RETENTION_CRAWL_TTL).')
+        parser.add_argument('--user-ttl', type=float, default=None,
+                            help='Days without a crawl after which a user expires (default: SCRAPER_RETENTION_USER_TTL).')
+        parser.add_argument('--max-crawls', type=int, default=None,
+                            help='Crawls kept per user (default: SCRAPER_RETENTION_MAX_CRAWLS).')
+        parser.add_argument('--max-pages', type=int, default=None,
+                            help='Pages kept per user (default: SCRAPER_RETENTION_MAX_PAGES).')
+        parser.add_argument('--batch-size', type=int, default=None,
+                            help='Rows deleted per transaction (default: SCRAPER_RETENTION_BATCH_SIZE).')
+        parser.add_argument('--pause', type=float, default=None,
+                            help='Seconds to sleep between batches (default: SCRAPER_RETENTION_PAUSE).')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Only count what would be deleted.')
+        parser.add_argument('--no-vacuum', action='store_true',
+                            help='Keep the freed space in the database file for new rows.')
+        parser.add_argument('--full-vacuum', action='store_true',
+                            help='Rebuild the database with VACUUM, needed once to switch an existing database '
+                                 'to incremental vacuum. Blocks crawls while it runs.')
+        parser.add_argument('--interval', type=float, default=None,
+                            help='Run again every this many seconds instead of once.')
+
+    def handle(self, *args, **options):
+        policy = RetentionPolicy(
+            crawl_ttl=options['crawl_ttl'] * DAY if options['crawl_ttl'] is not None else None,
+            user_ttl=options['user_ttl'] * DAY if options['user_ttl'] is not None else None,
+            max_crawls=options['max_crawls'],
+            max_pages=options['max_pages'],
+            batch_size=options['batch_size'],
+            pause=options['pause'],
+        )
+        full_vacuum = options['full_vacuum']
+        while True:
+            report = policy.run(dry_run=options['dry_run'], vacuum=not options['no_vacuum'], full_vacuum=full_vacuum)
+            # Once switched, the database is kept small incrementally.
+            full_vacuum = False
+            metrics.persist()
+            self.stdout.write(json.dumps(report))
+            if options['interval'] is None:
+                return
+            time.sleep(options['interval'])
@@ -0,0 +1,311 @@
+'''
+Crawl and export instrumentation.
+
+Stages (fetch, parse, persist, render) are timed into histograms and the work
+they do is counted (pages, bytes, errors, cache events). Values live in the
+process that recorded them; crawl workers, downloads and prune_data write
+theirs to settings.SCRAPER_METRICS_DIR, one file per process, and the metrics
+view adds them up with its own and serves the total in the Prometheus text
+format. The files of processes that exited are folded into one, so the
+directory does not grow with every restart.
+'''
+import fcntl
+import json
+import os
+import socket
+import threading
+import time
+import uuid
+from collections import defaultdict
+from contextlib import contextmanager
+
+from django.conf import settings
+
+
+# Seconds between two writes of the values of a busy process.
+PERSIST_INTERVAL = 5.0
+
+# Seconds between two looks for the files of processes that exited, when persisting.
+COMPACT_INTERVAL = 60.0
+
+# File holding the values of every process that exited.
+EXITED_FILE = 'exited.json'
+
+# Upper bounds in seconds of the stage duration histogram buckets.
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+DESCRIPTIONS = {
+    'scraper_stage_seconds': ('histogram', 'Time spent in one crawl or export stage.'),
+    'scraper_pages_fetched_total': ('counter', 'Pages downloaded and parsed.'),
+    'scraper_bytes_fetched_total': ('counter', 'Bytes of page bodies downloaded.'),
+    'scraper_pages_stored_total': ('counter', 'Pages written to the database.'),
+    'scraper_pages_updated_total': ('counter', 'Pages of an earlier crawl rewritten because they changed.'),
+    'scraper_pages_unchanged_total': ('counter', 'Pages of an earlier crawl found unchanged and not written.'),
+    'scraper_pages_skipped_total': ('counter', 'URLs found during a crawl that were not stored.'),
+    'scraper_pages_rendered_total': ('counter', 'Pages exported, by download type.'),
+    'scraper_bytes_rendered_total': ('counter', 'Bytes of exported files, by download type.'),
+    'scraper_errors_total': ('counter', 'Failures, by stage.'),
+    'scraper_cache_events_total': ('counter', 'Hits, misses, stores and evictions of the disk caches.'),
+    'scraper_links_stored_total': ('counter', 'Links found on stored pages and written to the database.'),
+    'scraper_retention_rows_deleted_total': ('counter', 'Rows deleted by the retention command, by table.'),
+}
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+class Metrics:
+    '''
+    Thread-safe registry of counters and histograms.
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = defaultdict(float)
+        self.histograms = {}
+        self._last_persist = 0.0
+
+    def inc(self, name, value=1, **labels):
+        with self._lock:
+            self.counters[_key(name, labels)] += value
+
+    def observe(self, name, value, **labels):
+        key = _key(name, labels)
+        with self._lock:
+            # Per bucket counts, then the sum and the number of observations.
+            histogram = self.histograms.setdefault(key, [0] * (len(BUCKETS) + 2))
+            for i, bound in enumerate(BUCKETS):
+                if value <= bound:
+                    histogram[i] += 1
+                    break
+            histogram[-2] += value
+            histogram[-1] += 1
+
+    @contextmanager
+    def timer(self, stage):
+        '''
+        Times the block into scraper_stage_seconds{stage=...}, also when it raises.
+        '''
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe('scraper_stage_seconds', time.perf_counter() - start, stage=stage)
+
+    def snapshot(self):
+        '''
+        Returns the current values as a JSON-serializable dict.
+        '''
+        with self._lock:
+            return {
+                'counters': [[name, dict(labels), value] for (name, labels), value in self.counters.items()],
+                'histograms': [[name, dict(labels), list(values)] for (name, labels), values in self.histograms.items()],
+            }
+
+    def merge(self, snapshot):
+        '''
+        Adds the values of a snapshot to this registry.
+        '''
+        with self._lock:
+            for name, labels, value in snapshot['counters']:
+                self.counters[_key(name, labels)] += value
+            for name, labels, values in snapshot['histograms']:
+                histogram = self.histograms.setdefault(_key(name, labels), [0] * (len(BUCKETS) + 2))
+                for i, value in enumerate(values):
+                    histogram[i] += value
+
+    def render(self):
+        '''
+        Returns the values in the Prometheus text exposition format.
+        '''
+        series = defaultdict(list)
+        with self._lock:
+            for (name, labels), value in self.counters.items():
+                series[name].append((labels, value))
+            for (name, labels), values in self.histograms.items():
+                series[name].append((labels, list(values)))
+
+        lines = []
+        for name in sorted(series):
+            kind, description = DESCRIPTIONS.get(name, ('untyped', ''))
+            lines.append(f'# HELP {name} {description}')
+            lines.append(f'# TYPE {name} {kind}')
+            for labels, value in sorted(series[name], key=lambda item: item[0]):
+                if kind != 'histogram':
+                    lines.append(f'{name}{_format_labels(labels)} {_format_value(value)}')
+                    continue
+                cumulative = 0
+                for bound, count in zip(BUCKETS + ('+Inf',), value[:-2] + [value[-1] - sum(value[:-2])]):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{_format_labels(labels + (("le", str(bound)),))} {cumulative}')
+                lines.append(f'{name}_sum{_format_labels(labels)} {_format_value(value[-2])}')
+                lines.append(f'{name}_count{_format_labels(labels)} {value[-1]}')
+        return '\n'.join(lines) + '\n'
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    pairs = ','.join(f'{name}="{str(value).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"'
+                     for name, value in labels)
+    return '{' + pairs + '}'
+
+
+def _format_value(value):
+    return str(int(value)) if float(value).is_integer() else repr(value)
+
+
+# Registry of this process.
+REGISTRY = Metrics()
+
+# Name of the file this process persists to, see get_process_id.
+_process_id = None
+_persist_lock = threading.Lock()
+_last_compact = 0.0
+
+
+def get_process_id():
+    '''
+    Returns the name of this process's metrics file: its host, its pid and a random
+    part, so that a later process given the same pid does not overwrite it.
+    '''
+    global _process_id
+    if _process_id is None:
+        _process_id = f'{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:12]}'
+    return _process_id
+
+
+def _has_exited(filename):
+    # Only processes of this host can be looked up, those of other hosts sharing the directory are left to them.
+    # Files named before the host was part of the name have none.
+    host, _, pid = filename[:-len('.json')].rpartition('-')[0].rpartition('-')
+    if host not in ('', socket.gethostname()) or not pid.isdigit():
+        return False
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return True
+    except OSError:
+        return False
+    return False
+
+
+def _after_fork():
+    # A forked process starts from its parent's values, which the parent persists itself.
+    global REGISTRY, _process_id
+    REGISTRY = Metrics()
+    _process_id = None
+
+
+os.register_at_fork(after_in_child=_after_fork)
+
+
+def inc(name, value=1, **labels):
+    REGISTRY.inc(name, value, **labels)
+
+
+def observe(name, value, **labels):
+    REGISTRY.observe(name, value, **labels)
+
+
+def timer(stage):
+    return REGISTRY.timer(stage)
+
+
+def get_metrics_dir():
+    return getattr(settings, 'SCRAPER_METRICS_DIR', os.path.join(settings.MEDIA_ROOT, 'metrics'))
+
+
+def _write(path, snapshot):
+    with open(path + '.tmp', 'w') as f:
+        json.dump(snapshot, f)
+    os.replace(path + '.tmp', path)
+
+
+def _read(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+@contextmanager
+def _lock_directory(directory, operation):
+    with open(os.path.join(directory, 'compact.lock'), 'a') as lock:
+        fcntl.flock(lock, operation)
+        yield
+
+
+def compact():
+    '''
+    Adds the files of the processes of this host that exited to the exited file and deletes them.
+    Returns:
+      @ count: number of files folded.
+    '''
+    global _last_compact
+    _last_compact = time.monotonic()
+    directory = get_metrics_dir()
+    if not os.path.isdir(directory):
+        return 0
+    # Two processes folding the same file would count it twice, and so would collect reading meanwhile.
+    with _lock_directory(directory, fcntl.LOCK_EX):
+        exited = [
+            filename for filename in os.listdir(directory)
+            if filename.endswith('.json') and filename != EXITED_FILE and _has_exited(filename)
+        ]
+        if not exited:
+            return 0
+        path = os.path.join(directory, EXITED_FILE)
+        total = Metrics()
+        for filename in [EXITED_FILE] + exited:
+            snapshot = _read(os.path.join(directory, filename))
+            if snapshot is not None:
+                total.merge(snapshot)
+        _write(path, total.snapshot())
+        for filename in exited:
+            os.remove(os.path.join(directory, filename))
+    return len(exited)
+
+
+def persist(min_interval=0.0):
+    '''
+    Writes the values of this process to the metrics directory, for the metrics view
+    of another process to read. Does nothing if the last write is under min_interval seconds old.
+    Folds the files of exited processes every COMPACT_INTERVAL seconds.
+    '''
+    now = time.monotonic()
+    if now - REGISTRY._last_persist < min_interval:
+        return
+    # Threads of one process write the same file.
+    with _persist_lock:
+        REGISTRY._last_persist = now
+        directory = get_metrics_dir()
+        os.makedirs(directory, exist_ok=True)
+        _write(os.path.join(directory, f'{get_process_id()}.json'), REGISTRY.snapshot())
+        if now - _last_compact >= COMPACT_INTERVAL:
+            compact()
+
+
+def collect():
+    '''
+    Returns the values of this process added to those persisted by every other process.
+    Processes that exited keep counting, their totals do not go away with them.
+    '''
+    if time.monotonic() - _last_compact >= COMPACT_INTERVAL:
+        compact()
+    total = Metrics()
+    total.merge(REGISTRY.snapshot())
+    directory = get_metrics_dir()
+    own = f'{get_process_id()}.json'
+    if not os.path.isdir(directory):
+        return total
+    with _lock_directory(directory, fcntl.LOCK_SH):
+        for filename in os.listdir(directory):
+            if not filename.endswith('.json') or filename == own:
+                continue
+            snapshot = _read(os.path.join(directory, filename))
+            if snapshot is not None:
+                total.merge(snapshot)
+    return total
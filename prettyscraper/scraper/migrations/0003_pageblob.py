@@ -0,0 +1,73 @@
+# Generated by Django 5.2.18 on 2026-10-18 14:26
+
+import hashlib
+import zlib
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+# Pages moved per batch, under SQLite's variable limit.
+BATCH_SIZE = 500
+
+
+def move_content_to_blobs(apps, schema_editor):
+    '''
+    Stores the body of every page once in PageBlob, hashed and compressed like PageBlob.pack does.
+    '''
+    Page = apps.get_model('scraper', 'Page')
+    PageBlob = apps.get_model('scraper', 'PageBlob')
+    level = getattr(settings, 'SCRAPER_BLOB_COMPRESSION_LEVEL', 6)
+    ids = list(Page.objects.filter(content__isnull=False).order_by('pk').values_list('pk', flat=True))
+    for start in range(0, len(ids), BATCH_SIZE):
+        blobs, pages = {}, []
+        for page in Page.objects.filter(pk__in=ids[start:start + BATCH_SIZE]).only('pk', 'content'):
+            raw = page.content.encode('utf-8')
+            content_hash = hashlib.sha256(raw).hexdigest()
+            if content_hash not in blobs:
+                blobs[content_hash] = PageBlob(hash=content_hash, data=zlib.compress(raw, level), size=len(raw))
+            page.blob_id = content_hash
+            pages.append(page)
+        # Bodies already stored by an earlier batch are skipped.
+        PageBlob.objects.bulk_create(blobs.values(), ignore_conflicts=True)
+        Page.objects.bulk_update(pages, ['blob'])
+
+
+def move_blobs_to_content(apps, schema_editor):
+    Page = apps.get_model('scraper', 'Page')
+    ids = list(Page.objects.filter(blob__isnull=False).order_by('pk').values_list('pk', flat=True))
+    for start in range(0, len(ids), BATCH_SIZE):
+        pages = list(Page.objects.filter(pk__in=ids[start:start + BATCH_SIZE]).select_related('blob'))
+        for page in pages:
+            page.content = zlib.decompress(bytes(page.blob.data)).decode('utf-8')
+        Page.objects.bulk_update(pages, ['content'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('scraper', '0002_crawljob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PageBlob',
+            fields=[
+                ('hash', models.CharField(max_length=64, primary_key=True, serialize=False)),
+                ('data', models.BinaryField()),
+                ('size', models.PositiveIntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='page',
+            name='blob',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='pages', to='scraper.pageblob'),
+        ),
+        migrations.RunPython(move_content_to_blobs, move_blobs_to_content),
+        migrations.RemoveField(
+            model_name='page',
+            name='content',
+        ),
+    ]
@@ -0,0 +1,57 @@
+# Generated by Django 5.2.18 on 2026-10-18 14:26
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def link_parents(apps, schema_editor):
+    '''
+    Gives the pages stored before crawl trees existed a parent and a depth. Their
+    parent is the latest earlier page of the same user at their parent_url, the
+    page the old recursive crawl had just stored when it found them.
+    '''
+    Page = apps.get_model('scraper', 'Page')
+    latest = {}
+    updates = []
+    for pk, user_id, url, parent_url in Page.objects.order_by('pk').values_list('pk', 'user_id', 'url', 'parent_url'):
+        parent = latest.get((user_id, parent_url)) if parent_url else None
+        depth = 1
+        if parent is not None:
+            depth = parent[1] + 1
+            updates.append(Page(pk=pk, parent_id=parent[0], depth=depth))
+        latest[(user_id, url)] = (pk, depth)
+    Page.objects.bulk_update(updates, ['parent', 'depth'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('scraper', '0003_pageblob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='page',
+            name='crawl',
+            field=models.ForeignKey(blank=True, db_index=False, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='pages', to='scraper.crawljob'),
+        ),
+        migrations.AddField(
+            model_name='page',
+            name='depth',
+            field=models.PositiveIntegerField(default=1),
+        ),
+        migrations.AddField(
+            model_name='page',
+            name='parent',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='children', to='scraper.page'),
+        ),
+        migrations.AddIndex(
+            model_name='page',
+            index=models.Index(fields=['crawl', 'parent'], name='page_crawl_parent_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='page',
+            index=models.Index(fields=['user_id', 'url'], name='page_user_url_idx'),
+        ),
+        migrations.RunPython(link_parents, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 5.2.18 on 2026-10-18 14:26
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('scraper', '0004_page_crawl_tree'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SkippedPage',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('user_id', models.CharField(blank=True, max_length=255, null=True)),
+                ('url', models.URLField()),
+                ('parent_url', models.URLField(blank=True, null=True)),
+                ('reason', models.CharField(max_length=255)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('crawl', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='skipped_pages', to='scraper.crawljob')),
+            ],
+        ),
+    ]
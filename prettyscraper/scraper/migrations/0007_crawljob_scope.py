@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-18 14:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('scraper', '0006_incremental_recrawl'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='crawljob',
+            name='max_pages',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='crawljob',
+            name='scope',
+            field=models.CharField(blank=True, default='', max_length=16),
+        ),
+    ]
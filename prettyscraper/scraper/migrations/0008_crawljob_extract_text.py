@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 14:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('scraper', '0007_crawljob_scope'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='crawljob',
+            name='extract_text',
+            field=models.BooleanField(blank=True, null=True),
+        ),
+    ]
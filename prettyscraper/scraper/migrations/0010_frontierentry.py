@@ -0,0 +1,37 @@
+# Generated by Django 5.2.18 on 2026-10-18 14:26
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('scraper', '0009_crawljob_pages_in_flight'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='crawljob',
+            name='distributed',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.CreateModel(
+            name='FrontierEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('url', models.URLField()),
+                ('depth', models.PositiveIntegerField(default=1)),
+                ('state', models.CharField(choices=[('pending', 'Pending'), ('leased', 'Leased'), ('done', 'Done'), ('failed', 'Failed')], default='pending', max_length=8)),
+                ('lease_owner', models.CharField(blank=True, default='', max_length=255)),
+                ('lease_expires', models.DateTimeField(blank=True, null=True)),
+                ('attempts', models.PositiveSmallIntegerField(default=0)),
+                ('crawl', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='frontier', to='scraper.crawljob')),
+                ('parent', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='scraper.page')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['crawl', 'state', 'depth', 'id'], name='frontier_claim_idx')],
+                'constraints': [models.UniqueConstraint(fields=('crawl', 'url'), name='frontier_crawl_url_uniq')],
+            },
+        ),
+    ]
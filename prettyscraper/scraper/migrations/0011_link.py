@@ -0,0 +1,115 @@
+# Generated by Django 5.2.18 on 2026-10-18 14:26
+
+import json
+from urllib.parse import urljoin, urlsplit
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Case, Exists, OuterRef, Subquery, Value, When
+
+from scraper.frontier import canonicalize_url
+
+
+# Pages moved per batch, under SQLite's variable limit.
+BATCH_SIZE = 500
+# SkippedPage reason of URLs that were not fetched at all, see scraper.crawler.
+ROBOTS_DISALLOWED = 'Disallowed by robots.txt'
+
+
+def move_hrefs_to_links(apps, schema_editor):
+    '''
+    Turns the JSON hrefs of every page into Link rows, absolute and canonical as
+    the crawler writes them, then resolves the links of each crawl like
+    scraper.graph.resolve_links does. Pages stored without a crawl keep their
+    links unresolved.
+    '''
+    Page = apps.get_model('scraper', 'Page')
+    Link = apps.get_model('scraper', 'Link')
+    SkippedPage = apps.get_model('scraper', 'SkippedPage')
+    CrawlJob = apps.get_model('scraper', 'CrawlJob')
+
+    ids = list(Page.objects.exclude(hrefs__isnull=True).exclude(hrefs='').order_by('pk').values_list('pk', flat=True))
+    for start in range(0, len(ids), BATCH_SIZE):
+        links = []
+        for page in Page.objects.filter(pk__in=ids[start:start + BATCH_SIZE]).only('pk', 'url', 'hrefs'):
+            try:
+                hrefs = json.loads(page.hrefs)
+            except ValueError:
+                continue
+            seen = set()
+            for href in hrefs:
+                if not isinstance(href, str) or not href.strip():
+                    continue
+                url = canonicalize_url(urljoin(page.url, href.strip()))
+                if urlsplit(url).scheme not in ('http', 'https') or url in seen:
+                    continue
+                seen.add(url)
+                links.append(Link(source_id=page.pk, target_url=url))
+        Link.objects.bulk_create(links, batch_size=BATCH_SIZE)
+
+    for crawl_job in CrawlJob.objects.filter(pages__isnull=False).distinct():
+        links = Link.objects.filter(source__crawl=crawl_job)
+        targets = Page.objects.filter(user_id=crawl_job.user_id, url=OuterRef('target_url'), crawl=crawl_job)
+        failed = SkippedPage.objects.filter(crawl=crawl_job, url=OuterRef('target_url')).exclude(reason=ROBOTS_DISALLOWED)
+        links.update(target=Subquery(targets.order_by('id').values('pk')[:1]))
+        links.update(status=Case(
+            When(target__isnull=False, then=Value('crawled')),
+            When(Exists(failed), then=Value('broken')),
+            default=Value('not_crawled'),
+        ))
+
+
+def move_links_to_hrefs(apps, schema_editor):
+    Page = apps.get_model('scraper', 'Page')
+    Link = apps.get_model('scraper', 'Link')
+    ids = list(Link.objects.order_by('source_id').values_list('source_id', flat=True).distinct())
+    for start in range(0, len(ids), BATCH_SIZE):
+        hrefs = {}
+        for source_id, target_url in (Link.objects.filter(source_id__in=ids[start:start + BATCH_SIZE])
+                                      .order_by('id').values_list('source_id', 'target_url')):
+            hrefs.setdefault(source_id, []).append(target_url)
+        pages = [Page(pk=pk, hrefs=json.dumps(urls)) for pk, urls in hrefs.items()]
+        Page.objects.bulk_update(pages, ['hrefs'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('scraper', '0010_frontierentry'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Link',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('target_url', models.URLField(db_index=True)),
+                ('anchor_text', models.CharField(blank=True, default='', max_length=255)),
+                ('status', models.CharField(choices=[('unresolved', 'Unresolved'), ('crawled', 'Crawled'), ('broken', 'Broken'), ('not_crawled', 'Not crawled')], default='unresolved', max_length=16)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='link',
+            name='source',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='outlinks', to='scraper.page'),
+        ),
+        migrations.AddField(
+            model_name='link',
+            name='target',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='inlinks', to='scraper.page'),
+        ),
+        migrations.AlterField(
+            model_name='skippedpage',
+            name='crawl',
+            field=models.ForeignKey(blank=True, db_index=False, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='skipped_pages', to='scraper.crawljob'),
+        ),
+        migrations.AddIndex(
+            model_name='skippedpage',
+            index=models.Index(fields=['crawl', 'url'], name='skipped_crawl_url_idx'),
+        ),
+        migrations.RunPython(move_hrefs_to_links, move_links_to_hrefs),
+        migrations.RemoveField(
+            model_name='page',
+            name='hrefs',
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 14:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('scraper', '0011_link'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='crawljob',
+            name='final_url',
+            field=models.URLField(blank=True, default=''),
+        ),
+    ]
@@ -1,9 +1,59 @@
 from django.db import models
+from django.db.models.expressions import RawSQL
+from django.conf import settings
+from django.utils import timezone
 from django.contrib.contenttypes.fields import GenericForeignKey
 from django.contrib.contenttypes.models import ContentType
-import json
+import hashlib
+import zlib
 # from django.contrib.auth.models import User
 
+class PageBlob(models.Model):
+    '''
+    Content-addressed, zlib compressed page body.
+    Identical bodies crawled by different users or crawls are stored once.
+    '''
+
+    # Definitions of this model
+    hash = models.CharField(max_length=64, primary_key=True)
+    data = models.BinaryField()
+    size = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f'{self.hash} ({self.size} bytes)'
+
+    @staticmethod
+    def digest(content):
+        '''
+        Returns the hash a body is stored under, without compressing it.
+        '''
+        return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def pack(content):
+        '''
+        Hashes and compresses a body without touching the database, so crawler
+        worker threads can do it.
+        Returns:
+          @ (hash, compressed data, uncompressed size).
+        '''
+        raw = content.encode('utf-8')
+        level = getattr(settings, 'SCRAPER_BLOB_COMPRESSION_LEVEL', 6)
+        return hashlib.sha256(raw).hexdigest(), zlib.compress(raw, level), len(raw)
+
+    @classmethod
+    def store(cls, packed):
+        '''
+        Returns the blob for a packed body, creating it only if no page has this body yet.
+        '''
+        content_hash, data, size = packed
+        blob, _ = cls.objects.get_or_create(hash=content_hash, defaults={'data': data, 'size': size})
+        return blob
+
+    def unpack(self):
+        return zlib.decompress(bytes(self.data)).decode('utf-8')
+
 class Page(models.Model):
 
     # Definitions of this model
@@ -11,32 +61,258 @@ class Page(models.Model):
     url = models.URLField(unique=False)
     title = models.CharField(max_length=255, null=True, blank=True)
     safe_filename = models.CharField(max_length=255, default='Original file name not available')
-    hrefs=models.TextField(null=True, blank=True)
-    content = models.TextField(null=True, blank=True)
+    # The body lives in PageBlob so that listing pages does not load it.
+    blob = models.ForeignKey(PageBlob, null=True, blank=True, on_delete=models.PROTECT, related_name='pages')
     parent_url = models.URLField(null=True, blank=True)
     uploaded_at = models.DateTimeField(auto_now_add=True)
+    # Position in the crawl tree. The (crawl, parent) index below also serves crawl-only lookups.
+    crawl = models.ForeignKey('CrawlJob', null=True, blank=True, on_delete=models.CASCADE, related_name='pages', db_index=False)
+    parent = models.ForeignKey('self', null=True, blank=True, on_delete=models.CASCADE, related_name='children')
+    depth = models.PositiveIntegerField(default=1)
+    # Validators of the response the page was stored from, sent again when it is re-crawled.
+    etag = models.CharField(max_length=255, null=True, blank=True)
+    last_modified = models.CharField(max_length=64, null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['crawl', 'parent'], name='page_crawl_parent_idx'),
+            models.Index(fields=['user_id', 'url'], name='page_user_url_idx'),
+        ]
 
     def __str__(self):
         return f'{self.safe_filename} ({self.url})'
 
+    @property
+    def content(self):
+        """
+        The page body, loaded from its blob on first access.
+        Use select_related('blob') when the bodies of many pages are needed.
+        """
+        if self.blob_id is None:
+            return None
+        if not hasattr(self, '_content'):
+            self._content = self.blob.unpack()
+        return self._content
+
     @classmethod
-    def create(cls, user_id, url, title, safe_filename, hrefs, content, parent_url):
-        page = cls(
+    def build(cls, user_id, url, title, safe_filename, parent_url, blob_id=None,
+              crawl=None, depth=1, parent=None, etag=None, last_modified=None):
+        """
+        Returns an unsaved Page, for PageWriter to insert in bulk.
+        """
+        return cls(
             user_id=user_id,
             url=url,
             title=title,
             safe_filename=safe_filename,
-            hrefs=json.dumps(hrefs),
-            content=content,
-            parent_url=parent_url
+            blob_id=blob_id,
+            parent_url=parent_url,
+            crawl=crawl,
+            depth=depth,
+            parent=parent,
+            etag=etag,
+            last_modified=last_modified,
+        )
+
+    @classmethod
+    def create(cls, user_id, url, title, safe_filename, content, parent_url, packed=None,
+               crawl=None, depth=1, parent=None):
+        blob = PageBlob.store(packed or PageBlob.pack(content)) if content is not None else None
+        page = cls.build(
+            user_id, url, title, safe_filename, parent_url,
+            blob_id=blob.hash if blob else None, crawl=crawl, depth=depth, parent=parent,
         )
         page.save()
-        page.refresh_from_db()
         return page
     
+    def get_children(self):
+        """
+        Returns a queryset of the pages found on this page.
+        """
+        return Page.objects.filter(parent=self)
+
+    def get_descendants(self):
+        """
+        Returns a queryset of all pages below this one in its crawl tree, in one query.
+        The root of a crawl job is answered by a scan of the crawl index,
+        any other page by a recursive query over parent links.
+        """
+        if self.crawl_id is not None and self.parent_id is None:
+            return Page.objects.filter(crawl_id=self.crawl_id).exclude(pk=self.pk)
+
+        table = Page._meta.db_table
+        subtree = RawSQL(
+            f'WITH RECURSIVE subtree(id) AS ('
+            f' SELECT id FROM {table} WHERE parent_id = %s'
+            f' UNION ALL SELECT page.id FROM {table} page JOIN subtree ON page.parent_id = subtree.id'
+            f') SELECT id FROM subtree',
+            (self.pk,),
+        )
+        return Page.objects.filter(pk__in=subtree)
+
     def get_all_children(self):
         """
         Recursively retrieves all descendant pages.
         Returns a list of Page instances.
         """
-        return list(Page.objects.filter(user_id=self.user_id, parent_url=self.url))
\ No newline at end of file
+        return list(self.get_descendants())
+
+
+class Link(models.Model):
+    '''
+    A link found on a stored page, one edge of the link graph of its crawl.
+    Links are written with their page and resolved once the crawl finishes:
+    target is then the page stored for target_url in the same crawl, if any,
+    and status says whether it was crawled, could not be fetched, or was not
+    followed (out of scope, too deep, disallowed by robots.txt).
+    '''
+
+    UNRESOLVED = 'unresolved'
+    CRAWLED = 'crawled'
+    BROKEN = 'broken'
+    NOT_CRAWLED = 'not_crawled'
+    STATUS_CHOICES = [
+        (UNRESOLVED, 'Unresolved'),
+        (CRAWLED, 'Crawled'),
+        (BROKEN, 'Broken'),
+        (NOT_CRAWLED, 'Not crawled'),
+    ]
+
+    # Definitions of this model
+    source = models.ForeignKey(Page, on_delete=models.CASCADE, related_name='outlinks')
+    # Absolute and canonical, as the crawler queues it. One link per target and source page.
+    target_url = models.URLField(db_index=True)
+    target = models.ForeignKey(Page, null=True, blank=True, on_delete=models.SET_NULL, related_name='inlinks')
+    anchor_text = models.CharField(max_length=255, blank=True, default='')
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=UNRESOLVED)
+
+    def __str__(self):
+        return f'{self.source_id} -> {self.target_url} ({self.status})'
+
+class CrawlJob(models.Model):
+    '''
+    One scrape request, queued by the scrape view and run by the crawl_worker command.
+    '''
+
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = [
+        (QUEUED, 'Queued'),
+        (RUNNING, 'Running'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    ]
+
+    # Definitions of this model
+    user_id = models.CharField(max_length=255, null=True, blank=True)
+    root_url = models.URLField()
+    # Canonical URL the root page was served from after redirects, the scope of a distributed crawl follows it.
+    final_url = models.URLField(blank=True, default='')
+    max_depth = models.PositiveIntegerField(default=1)
+    # Scope of the crawl, see ScopePolicy. Empty uses settings.SCRAPER_SCOPE.
+    scope = models.CharField(max_length=16, blank=True, default='')
+    max_pages = models.PositiveIntegerField(null=True, blank=True)
+    # Store the main text of pages instead of their full HTML. Null uses settings.SCRAPER_EXTRACT_MAIN_TEXT,
+    # the crawl then records the mode it used, a re-crawl only takes over pages stored the same way.
+    extract_text = models.BooleanField(null=True, blank=True)
+    # Crawled by every worker that joins, through the FrontierEntry table, instead of by the worker that claimed it.
+    distributed = models.BooleanField(default=False)
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=QUEUED, db_index=True)
+    pages_fetched = models.PositiveIntegerField(default=0)
+    pages_queued = models.PositiveIntegerField(default=0)
+    pages_failed = models.PositiveIntegerField(default=0)
+    # Fetches started and not yet answered, part of pages_queued.
+    pages_in_flight = models.PositiveIntegerField(default=0)
+    # Pages of an earlier crawl of the same root that were found unchanged and kept as they were.
+    pages_unchanged = models.PositiveIntegerField(default=0)
+    error = models.TextField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    # Last progress write of the worker running the job, see jobs.recover_stale_jobs.
+    heartbeat_at = models.DateTimeField(null=True, blank=True)
+    # Times a worker claimed the job.
+    attempts = models.PositiveIntegerField(default=0)
+
+    def __str__(self):
+        return f'{self.root_url} ({self.status})'
+
+    def elapsed(self):
+        '''
+        Seconds spent running so far, or in total once the job has finished.
+        '''
+        if not self.started_at:
+            return 0.0
+        end = self.finished_at or timezone.now()
+        return (end - self.started_at).total_seconds()
+
+
+class SkippedPage(models.Model):
+    '''
+    A URL found during a crawl that was not stored, and why.
+    '''
+
+    # Definitions of this model
+    # The (crawl, url) index below also serves crawl-only lookups.
+    crawl = models.ForeignKey(CrawlJob, null=True, blank=True, on_delete=models.CASCADE, related_name='skipped_pages',
+                              db_index=False)
+    user_id = models.CharField(max_length=255, null=True, blank=True)
+    url = models.URLField()
+    parent_url = models.URLField(null=True, blank=True)
+    reason = models.CharField(max_length=255)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            # Links are resolved to broken by the URL of the page that was skipped.
+            models.Index(fields=['crawl', 'url'], name='skipped_crawl_url_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.url} ({self.reason})'
+
+
+class FrontierEntry(models.Model):
+    '''
+    A URL of a distributed crawl, from the moment it is found until the crawl finishes.
+    Workers lease pending entries in batches and mark them done or failed once the
+    page is stored. A lease that expires, because its worker died, makes the entry
+    claimable again. The (crawl, url) constraint is the crawl's shared visited set.
+    '''
+
+    PENDING = 'pending'
+    LEASED = 'leased'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATE_CHOICES = [
+        (PENDING, 'Pending'),
+        (LEASED, 'Leased'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    ]
+
+    # Definitions of this model
+    crawl = models.ForeignKey(CrawlJob, on_delete=models.CASCADE, related_name='frontier', db_index=False)
+    url = models.URLField()
+    depth = models.PositiveIntegerField(default=1)
+    parent = models.ForeignKey(Page, null=True, blank=True, on_delete=models.CASCADE, related_name='+')
+    state = models.CharField(max_length=8, choices=STATE_CHOICES, default=PENDING)
+    # Worker holding the lease and when it runs out.
+    lease_owner = models.CharField(max_length=255, blank=True, default='')
+    lease_expires = models.DateTimeField(null=True, blank=True)
+    # Leases taken so far, an entry whose leases keep expiring is given up on.
+    attempts = models.PositiveSmallIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['crawl', 'url'], name='frontier_crawl_url_uniq'),
+        ]
+        indexes = [
+            # Claims take the shallowest pending entries of a crawl first.
+            models.Index(fields=['crawl', 'state', 'depth', 'id'], name='frontier_claim_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.url} ({self.state})'
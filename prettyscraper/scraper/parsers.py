@@ -0,0 +1,161 @@
+'''
+Title and link extraction for crawled pages.
+
+The crawler only needs a page's <title> and the href and text of its links, so the
+default backend does not build a BeautifulSoup tree: 'lxml' runs lxml's C
+parser and 'stream' is a one-pass tokenizer on the standard library's
+HTMLParser. 'soup' is the original BeautifulSoup path and the fallback when a
+faster backend is unavailable or fails on a page. Pages are stored as the
+original decoded body, never as a re-serialized tree.
+'''
+import re
+from html.parser import HTMLParser
+
+from bs4 import BeautifulSoup
+from django.conf import settings
+
+try:
+    import lxml.html
+except ImportError:
+    lxml = None
+
+
+NO_TITLE = 'No title available'
+
+CHARSET_HEADER = re.compile(r'charset=["\']?([\w.:-]+)', re.I)
+CHARSET_META = re.compile(rb'<meta[^>]+charset=["\']?([\w.:-]+)', re.I)
+
+
+def decode_body(body, content_type=None):
+    '''
+    Decodes a response body using the charset of its Content-Type header,
+    then of a <meta> tag near the top of the page, then UTF-8.
+    Args:
+      @ body: response bytes.
+      @ content_type: value of the Content-Type header, if any.
+    Returns:
+      @ text: the decoded page.
+    '''
+    match = CHARSET_HEADER.search(content_type or '') or CHARSET_META.search(body[:2048])
+    encoding = match.group(1) if match else 'utf-8'
+    if isinstance(encoding, bytes):
+        encoding = encoding.decode('ascii', 'replace')
+    try:
+        return body.decode(encoding, errors='replace')
+    except LookupError:
+        return body.decode('utf-8', errors='replace')
+
+
+def parse_soup(text):
+    '''
+    Extracts (title, links) with a full BeautifulSoup tree.
+    '''
+    soup = BeautifulSoup(text, 'html.parser')
+    title = soup.title.string if soup.title else None
+    links = [(a['href'], a.get_text()) for a in soup.find_all('a', href=True)]
+    return title, links
+
+
+def parse_lxml(text):
+    '''
+    Extracts (title, links) with lxml's C HTML parser.
+    '''
+    document = lxml.html.fromstring(text)
+    title = document.findtext('.//title')
+    links = [(str(a.get('href')), a.text_content()) for a in document.iter('a') if a.get('href') is not None]
+    return title, links
+
+
+class LinkTitleParser(HTMLParser):
+    '''
+    Tokenizer that only keeps the first <title> text and the href and text of every <a>.
+    '''
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.title = None
+        self.links = []
+        self._title_parts = None
+        self._anchor = None
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'a':
+            # An <a> left open ends at the next one, as browsers do.
+            self._end_anchor()
+            for name, value in attrs:
+                if name == 'href' and value is not None:
+                    self._anchor = (value, [])
+                    break
+        elif tag == 'title' and self.title is None:
+            self._title_parts = []
+
+    def handle_endtag(self, tag):
+        if tag == 'a':
+            self._end_anchor()
+        elif tag == 'title' and self._title_parts is not None:
+            self.title = ''.join(self._title_parts)
+            self._title_parts = None
+
+    def handle_data(self, data):
+        if self._title_parts is not None:
+            self._title_parts.append(data)
+        if self._anchor is not None:
+            self._anchor[1].append(data)
+
+    def _end_anchor(self):
+        if self._anchor is not None:
+            href, parts = self._anchor
+            self.links.append((href, ''.join(parts)))
+            self._anchor = None
+
+    def close(self):
+        super().close()
+        self._end_anchor()
+
+
+def parse_stream(text):
+    '''
+    Extracts (title, links) in one pass without building a tree.
+    '''
+    parser = LinkTitleParser()
+    parser.feed(text)
+    parser.close()
+    return parser.title, parser.links
+
+
+PARSERS = {
+    'lxml': parse_lxml,
+    'stream': parse_stream,
+    'soup': parse_soup,
+}
+
+
+def get_parser_name(name=None):
+    '''
+    Returns the backend to use: name, settings.SCRAPER_PARSER, or the fastest one available.
+    '''
+    name = name or getattr(settings, 'SCRAPER_PARSER', None) or 'lxml'
+    if name == 'lxml' and lxml is None:
+        return 'soup'
+    if name not in PARSERS:
+        raise ValueError(f'Unknown parser backend {name}')
+    return name
+
+
+def parse_page(text, parser=None):
+    '''
+    Extracts the title and links of a page, falling back to BeautifulSoup
+    when the selected backend fails on it.
+    Args:
+      @ text: the decoded page.
+      @ parser: backend name, defaults to get_parser_name().
+    Returns:
+      @ (title, links): title is never empty, links is a list of (href value, anchor text)
+        in page order, the text with its whitespace collapsed.
+    '''
+    try:
+        title, links = PARSERS[get_parser_name(parser)](text)
+    except Exception:
+        title, links = parse_soup(text)
+    title = title.strip() if title else ''
+    return title or NO_TITLE, [(href, ' '.join(text.split())) for href, text in links]
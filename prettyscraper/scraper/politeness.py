@@ -0,0 +1,159 @@
+'''
+Per-host politeness for the crawl frontier.
+
+Every host gets a token bucket limiting its request rate, slowed down further
+by the Crawl-delay of its robots.txt, and a backoff window that opens when it
+answers 429 or 503. The frontier only hands out URLs of hosts that are ready,
+so a crawl spreads its fetches over idle hosts instead of getting throttled.
+'''
+import math
+import time
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit, urlunsplit
+from urllib.robotparser import RobotFileParser
+
+import requests
+from django.conf import settings
+
+
+def parse_retry_after(value):
+    '''
+    Returns the seconds to wait from a Retry-After header (seconds or HTTP date), or None.
+    '''
+    if not value:
+        return None
+    if value.strip().isdigit():
+        return float(value)
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def get_robots_url(url):
+    parts = urlsplit(url)
+    return urlunsplit((parts.scheme, parts.netloc, '/robots.txt', '', ''))
+
+
+def get_robots(url, client):
+    '''
+    Fetches and parses the robots.txt of the host of url. Goes through the
+    crawl's HttpClient, so robots files are cached on disk between crawls.
+    Returns:
+      @ parser: a RobotFileParser, or None when the host has no usable robots.txt.
+    '''
+    try:
+        response = client.get(get_robots_url(url))
+    except requests.RequestException:
+        return None
+    if response.status_code != 200:
+        return None
+    parser = RobotFileParser()
+    parser.parse(response.text.splitlines())
+    return parser
+
+
+class TokenBucket:
+    '''
+    Allows rate requests per second on average, with bursts of up to burst requests.
+    '''
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.capacity = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now):
+        '''
+        Seconds until a token is available, 0 if one is available now.
+        '''
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+
+class HostState:
+
+    def __init__(self, bucket):
+        self.bucket = bucket
+        self.not_before = 0.0
+        self.strikes = 0
+        self.robots = None
+        self.robots_loaded = False
+
+
+class Politeness:
+    '''
+    Tracks when each host may be fetched again.
+    Args:
+      @ rate: requests per second allowed per host, defaults to settings.SCRAPER_HOST_RATE.
+      @ burst: requests a host may get back to back, defaults to settings.SCRAPER_HOST_BURST.
+      @ obey_robots: honour robots.txt rules and Crawl-delay, defaults to settings.SCRAPER_OBEY_ROBOTS.
+    '''
+
+    def __init__(self, rate=None, burst=None, obey_robots=None):
+        self.rate = rate or getattr(settings, 'SCRAPER_HOST_RATE', 5.0)
+        self.burst = burst or getattr(settings, 'SCRAPER_HOST_BURST', 4)
+        self.obey_robots = obey_robots if obey_robots is not None else getattr(settings, 'SCRAPER_OBEY_ROBOTS', True)
+        self.max_backoff = getattr(settings, 'SCRAPER_MAX_BACKOFF', 60)
+        self.user_agent = getattr(settings, 'SCRAPER_USER_AGENT', 'PrettyScraper')
+        self._hosts = {}
+
+    def _state(self, host):
+        if host not in self._hosts:
+            self._hosts[host] = HostState(TokenBucket(self.rate, self.burst))
+            self._hosts[host].robots_loaded = not self.obey_robots
+        return self._hosts[host]
+
+    def needs_robots(self, host):
+        return not self._state(host).robots_loaded
+
+    def set_robots(self, host, robots):
+        '''
+        Installs the parsed robots.txt of a host, slowing its bucket down to its Crawl-delay.
+        '''
+        state = self._state(host)
+        state.robots = robots
+        state.robots_loaded = True
+        delay = robots.crawl_delay(self.user_agent) if robots else None
+        if delay:
+            state.bucket = TokenBucket(min(self.rate, 1 / float(delay)), 1)
+
+    def allowed(self, host, url):
+        robots = self._state(host).robots
+        return robots is None or robots.can_fetch(self.user_agent, url)
+
+    def wait_time(self, host, now):
+        '''
+        Seconds until host may be fetched, math.inf while its robots.txt is being fetched.
+        '''
+        state = self._state(host)
+        if not state.robots_loaded:
+            return math.inf
+        return max(state.not_before - now, state.bucket.wait_time(now))
+
+    def dispatched(self, host, now):
+        self._state(host).bucket.take(now)
+
+    def succeeded(self, host):
+        self._state(host).strikes = 0
+
+    def throttled(self, host, retry_after=None):
+        '''
+        Keeps a host that answered 429/503 idle for Retry-After seconds, or an
+        exponentially growing delay when the server did not say.
+        '''
+        state = self._state(host)
+        state.strikes += 1
+        delay = retry_after if retry_after is not None else 2 ** state.strikes
+        state.not_before = time.monotonic() + min(delay, self.max_backoff)
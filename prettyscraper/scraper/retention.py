@@ -0,0 +1,271 @@
+'''
+Retention of crawled data.
+
+Nothing else ever deletes pages, so the prune_data command applies the
+retention settings: finished crawls expire some time after they finish or once
+their user keeps too many of them, and users idle for long enough are deleted
+with everything they crawled. Rows go in small batches, each in a transaction
+of its own with a pause after it, so crawl workers and downloads never wait
+long for the write lock. Page bodies no page refers to any more are dropped
+after that, then the freed database pages are handed back to the filesystem
+with incremental VACUUM.
+'''
+import logging
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import connection, transaction
+from django.db.models import Count, Q, Sum
+from django.db.models.functions import Coalesce, Length
+from django.utils import timezone
+
+from . import metrics
+from .models import CrawlJob, Page, PageBlob, SkippedPage
+
+
+logger = logging.getLogger(__name__)
+
+# Jobs still being worked on are never expired.
+FINISHED = (CrawlJob.DONE, CrawlJob.FAILED)
+
+
+def chunked(items, size):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+class RetentionPolicy:
+    '''
+    Decides what to delete and deletes it batch by batch, counting what went.
+    Args:
+      @ crawl_ttl: seconds after which a finished crawl expires, defaults to settings.SCRAPER_RETENTION_CRAWL_TTL.
+      @ user_ttl: seconds without a new crawl after which a user expires, defaults to
+        settings.SCRAPER_RETENTION_USER_TTL.
+      @ max_crawls: crawls with pages kept per user, newest first, defaults to settings.SCRAPER_RETENTION_MAX_CRAWLS.
+      @ max_pages: pages kept per user, in its newest crawls, defaults to settings.SCRAPER_RETENTION_MAX_PAGES.
+        The newest crawl of a user is kept whatever its size.
+      @ batch_size: rows deleted per transaction, defaults to settings.SCRAPER_RETENTION_BATCH_SIZE.
+      @ pause: seconds to sleep between two batches, defaults to settings.SCRAPER_RETENTION_PAUSE.
+      @ vacuum_pages: database pages freed per incremental VACUUM step,
+        defaults to settings.SCRAPER_RETENTION_VACUUM_PAGES.
+    None for any limit disables it.
+    '''
+
+    def __init__(self, crawl_ttl=None, user_ttl=None, max_crawls=None, max_pages=None, batch_size=None, pause=None,
+                 vacuum_pages=None):
+        self.crawl_ttl = crawl_ttl if crawl_ttl is not None else getattr(settings, 'SCRAPER_RETENTION_CRAWL_TTL', None)
+        self.user_ttl = user_ttl if user_ttl is not None else getattr(settings, 'SCRAPER_RETENTION_USER_TTL', None)
+        self.max_crawls = max_crawls if max_crawls is not None else getattr(settings, 'SCRAPER_RETENTION_MAX_CRAWLS', None)
+        self.max_pages = max_pages if max_pages is not None else getattr(settings, 'SCRAPER_RETENTION_MAX_PAGES', None)
+        self.batch_size = batch_size or getattr(settings, 'SCRAPER_RETENTION_BATCH_SIZE', 500)
+        self.pause = pause if pause is not None else getattr(settings, 'SCRAPER_RETENTION_PAUSE', 0.05)
+        self.vacuum_pages = vacuum_pages or getattr(settings, 'SCRAPER_RETENTION_VACUUM_PAGES', 1000)
+        self.rows = {}
+
+    def expired_crawls(self, now):
+        '''
+        Returns the ids of the finished crawls past the crawl TTL or beyond their user's quota, oldest first.
+        '''
+        finished = CrawlJob.objects.filter(status__in=FINISHED)
+        expired = set()
+        if self.crawl_ttl is not None:
+            cutoff = now - timedelta(seconds=self.crawl_ttl)
+            expired.update(
+                finished.filter(Q(finished_at__lt=cutoff) | Q(finished_at__isnull=True, created_at__lt=cutoff))
+                .values_list('pk', flat=True)
+            )
+
+        if self.max_crawls is not None or self.max_pages is not None:
+            # Only crawls still holding pages count, an incremental re-crawl takes over the pages of the one before.
+            sizes = dict(
+                Page.objects.filter(crawl__status__in=FINISHED).values_list('crawl_id').annotate(count=Count('id'))
+                .order_by()
+            )
+            kept = {}
+            jobs = finished.filter(pk__in=list(sizes)).order_by('user_id', '-finished_at', '-id')
+            for pk, user_id in jobs.values_list('pk', 'user_id'):
+                crawls, pages = kept.get(user_id, (0, 0))
+                over = (
+                    self.max_crawls is not None and crawls >= self.max_crawls
+                    or self.max_pages is not None and crawls and pages + sizes[pk] > self.max_pages
+                )
+                if over:
+                    expired.add(pk)
+                else:
+                    kept[user_id] = (crawls + 1, pages + sizes[pk])
+        return sorted(expired)
+
+    def idle_users(self, now):
+        '''
+        Returns the users that neither joined nor queued a crawl within the user TTL and have no unfinished crawl.
+        Staff and superuser accounts are never expired.
+        '''
+        if self.user_ttl is None:
+            return []
+        cutoff = now - timedelta(seconds=self.user_ttl)
+        active = CrawlJob.objects.filter(Q(created_at__gte=cutoff) | ~Q(status__in=FINISHED)).values('user_id')
+        return list(
+            User.objects.filter(date_joined__lt=cutoff, is_staff=False, is_superuser=False)
+            .exclude(username__in=active)
+            .order_by('pk')
+        )
+
+    def _count(self, deleted):
+        for label, count in deleted.items():
+            if count:
+                self.rows[label] = self.rows.get(label, 0) + count
+                metrics.inc('scraper_retention_rows_deleted_total', count, table=label.split('.')[-1].lower())
+
+    def _delete_batch(self, queryset):
+        with transaction.atomic():
+            _, deleted = queryset.delete()
+        self._count(deleted)
+        if self.pause:
+            time.sleep(self.pause)
+
+    def delete_pages(self, pages):
+        '''
+        Deletes pages deepest first, so that no batch cascades into the children of its pages.
+        Their links go with them.
+        Args:
+          @ pages: a Page queryset, filtered again in every batch so that pages
+            moved elsewhere meanwhile, by an incremental re-crawl, are kept.
+        '''
+        pks = list(pages.order_by('-depth', '-id').values_list('pk', flat=True))
+        for chunk in chunked(pks, self.batch_size):
+            self._delete_batch(pages.filter(pk__in=chunk))
+
+    def delete_crawl(self, crawl_id):
+        '''
+        Deletes one crawl job, its pages, the links found on them and the URLs it skipped.
+        '''
+        self.delete_pages(Page.objects.filter(crawl_id=crawl_id))
+        skipped = list(SkippedPage.objects.filter(crawl_id=crawl_id).values_list('pk', flat=True))
+        for chunk in chunked(skipped, self.batch_size):
+            self._delete_batch(SkippedPage.objects.filter(pk__in=chunk))
+        self._delete_batch(CrawlJob.objects.filter(pk=crawl_id, status__in=FINISHED))
+
+    def delete_user(self, user):
+        '''
+        Deletes a user with every crawl and page stored under its id.
+        '''
+        for crawl_id in CrawlJob.objects.filter(user_id=user.username).values_list('pk', flat=True):
+            self.delete_crawl(crawl_id)
+        self.delete_pages(Page.objects.filter(user_id=user.username, crawl__isnull=True))
+        self._delete_batch(User.objects.filter(pk=user.pk))
+
+    def delete_orphan_blobs(self):
+        '''
+        Deletes the page bodies no page refers to any more.
+        Returns:
+          @ size: bytes of compressed data freed.
+        '''
+        freed = 0
+        orphans = PageBlob.objects.filter(pages__isnull=True)
+        while True:
+            with transaction.atomic():
+                # Checked again under the write lock, a crawl may have stored one of these bodies meanwhile.
+                batch = orphans.filter(hash__in=list(orphans.values_list('hash', flat=True)[:self.batch_size]))
+                size = batch.aggregate(size=Coalesce(Sum(Length('data')), 0))['size']
+                _, deleted = batch.delete()
+            if not deleted:
+                return freed
+            freed += size
+            self._count(deleted)
+            if self.pause:
+                time.sleep(self.pause)
+
+    def vacuum(self, full=False):
+        '''
+        Returns free database pages to the filesystem, vacuum_pages per step.
+        Needs auto_vacuum=INCREMENTAL, which only a full VACUUM turns on for an existing database.
+        Args:
+          @ full: rebuild the whole database with VACUUM instead, switching it to incremental mode.
+            It holds the write lock until it is done.
+        Returns:
+          @ Boolean: whether free pages were returned.
+        '''
+        if connection.vendor != 'sqlite':
+            return False
+        with connection.cursor() as cursor:
+            if full:
+                cursor.execute('PRAGMA auto_vacuum=INCREMENTAL')
+                cursor.execute('VACUUM')
+            else:
+                cursor.execute('PRAGMA auto_vacuum')
+                if cursor.fetchone()[0] != 2:
+                    logger.warning('The database is not in incremental vacuum mode, run prune_data --full-vacuum once')
+                    return False
+                cursor.execute('PRAGMA freelist_count')
+                free = cursor.fetchone()[0]
+                while free:
+                    # Every row of the result is one page freed, fetching them runs the step.
+                    cursor.execute(f'PRAGMA incremental_vacuum({int(self.vacuum_pages)})')
+                    cursor.fetchall()
+                    cursor.execute('PRAGMA freelist_count')
+                    free, before = cursor.fetchone()[0], free
+                    if free >= before:
+                        break
+                    if self.pause:
+                        time.sleep(self.pause)
+            # With WAL the file only shrinks once the log is written back.
+            cursor.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        return True
+
+    def run(self, now=None, dry_run=False, vacuum=True, full_vacuum=False):
+        '''
+        Expires crawls and users, drops orphan page bodies and vacuums.
+        Args:
+          @ now: the time limits are counted back from, defaults to the current time.
+          @ dry_run: only report what would be deleted.
+          @ vacuum: hand freed space back to the filesystem.
+          @ full_vacuum: do so with a full VACUUM, see vacuum.
+        Returns:
+          @ report: a JSON-serializable dict of what was deleted and freed.
+        '''
+        start = time.monotonic()
+        now = now or timezone.now()
+        self.rows = {}
+        users = self.idle_users(now)
+        # Crawls of expiring users go with them.
+        usernames = {user.username for user in users}
+        crawls = [
+            pk for pk, user_id in CrawlJob.objects.filter(pk__in=self.expired_crawls(now)).values_list('pk', 'user_id')
+            if user_id not in usernames
+        ]
+        report = {'crawls': len(crawls), 'users': len(users)}
+        if dry_run:
+            report['pages'] = Page.objects.filter(Q(crawl_id__in=crawls) | Q(user_id__in=usernames)).count()
+            return report
+
+        size_before = get_database_size()
+        for crawl_id in crawls:
+            self.delete_crawl(crawl_id)
+        for user in users:
+            self.delete_user(user)
+        report['blob_bytes_freed'] = self.delete_orphan_blobs()
+        report['vacuumed'] = self.vacuum(full=full_vacuum) if vacuum or full_vacuum else False
+        size_after = get_database_size()
+
+        report['rows'] = self.rows
+        report['database_bytes'] = size_after
+        report['bytes_freed'] = max(0, size_before - size_after)
+        report['seconds'] = round(time.monotonic() - start, 2)
+        logger.info('Retention deleted %d crawls and %d users: %s, %d bytes freed',
+                    len(crawls), len(users), self.rows, report['bytes_freed'])
+        return report
+
+
+def get_database_size():
+    '''
+    Returns the size in bytes of the SQLite database file, 0 for other databases.
+    '''
+    if connection.vendor != 'sqlite':
+        return 0
+    with connection.cursor() as cursor:
+        cursor.execute('PRAGMA page_count')
+        page_count = cursor.fetchone()[0]
+        cursor.execute('PRAGMA page_size')
+        return page_count * cursor.fetchone()[0]
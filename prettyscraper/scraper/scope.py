@@ -0,0 +1,129 @@
+'''
+Crawl scope: which links a crawl follows and how much it may fetch.
+
+A ScopePolicy is built for one root URL and handed to the crawl engine, which
+rebases it on the URL the root redirects to, if any. Links are checked before
+they are queued, so off-site pages, other schemes and excluded paths never
+cost a request, and the crawl stops dispatching fetches once its page or byte
+budget is spent.
+'''
+import posixpath
+import re
+from urllib.parse import urlsplit
+
+from django.conf import settings
+
+
+SCOPES = ('host', 'domain', 'prefix', 'any')
+
+
+def get_site_domain(hostname):
+    '''
+    Returns the domain a host belongs to for same-domain crawls, the host without a leading 'www.'.
+    '''
+    hostname = (hostname or '').lower()
+    return hostname[4:] if hostname.startswith('www.') else hostname
+
+
+def get_path_prefix(path):
+    '''
+    Returns the path a same-prefix crawl stays under: the root path itself,
+    or its directory when it names a file.
+    '''
+    path = path or '/'
+    if '.' in posixpath.basename(path):
+        path = posixpath.dirname(path)
+    return path.rstrip('/') or '/'
+
+
+class ScopePolicy:
+    '''
+    Decides which URLs a crawl of root_url follows and when it has fetched enough.
+    Args:
+      @ root_url: canonical URL of the root page, always in scope.
+      @ scope: 'host' (same host and port), 'domain' (same host or its subdomains, ignoring www.),
+        'prefix' (same host, under the root path) or 'any'. Defaults to settings.SCRAPER_SCOPE.
+      @ include: regexes, when given a URL must match one of them. Defaults to settings.SCRAPER_SCOPE_INCLUDE.
+      @ exclude: regexes, a URL matching one of them is not followed. Defaults to settings.SCRAPER_SCOPE_EXCLUDE.
+      @ schemes: URL schemes followed. Defaults to settings.SCRAPER_SCOPE_SCHEMES.
+      @ max_pages: stop after storing this many pages, None for no limit. Defaults to settings.SCRAPER_MAX_PAGES.
+      @ max_bytes: stop after downloading this many body bytes, None for no limit.
+        Defaults to settings.SCRAPER_MAX_BYTES.
+    '''
+
+    def __init__(self, root_url, scope=None, include=None, exclude=None, schemes=None, max_pages=None,
+                 max_bytes=None):
+        self.scope = scope or getattr(settings, 'SCRAPER_SCOPE', 'domain')
+        if self.scope not in SCOPES:
+            raise ValueError(f'Unknown crawl scope {self.scope}')
+        include = include if include is not None else getattr(settings, 'SCRAPER_SCOPE_INCLUDE', ())
+        exclude = exclude if exclude is not None else getattr(settings, 'SCRAPER_SCOPE_EXCLUDE', ())
+        self.include = [re.compile(pattern) for pattern in include]
+        self.exclude = [re.compile(pattern) for pattern in exclude]
+        self.schemes = tuple(schemes or getattr(settings, 'SCRAPER_SCOPE_SCHEMES', ('http', 'https')))
+        self.max_pages = max_pages or getattr(settings, 'SCRAPER_MAX_PAGES', None)
+        self.max_bytes = max_bytes or getattr(settings, 'SCRAPER_MAX_BYTES', None)
+
+        self.root_url = root_url
+        # The root URL, and where it redirects to once rebase is called, with the site each of them defines.
+        self.roots = set()
+        self.sites = []
+        self.rebase(root_url)
+
+    def rebase(self, url):
+        '''
+        Adds the site of url to the crawl's own, for a root page that redirected to url,
+        e.g. from http:// to https://www. Links are then followed within either site.
+        Args:
+          @ url: canonical URL the root page was served from.
+        '''
+        if url in self.roots:
+            return
+        parts = urlsplit(url)
+        self.roots.add(url)
+        self.sites.append((parts.netloc.lower(), get_site_domain(parts.hostname), get_path_prefix(parts.path)))
+
+    def _in_site(self, parts):
+        if self.scope == 'any':
+            return True
+        hostname = (parts.hostname or '').lower()
+        netloc = parts.netloc.lower()
+        path = parts.path or '/'
+        for root_netloc, root_domain, root_prefix in self.sites:
+            if self.scope == 'domain':
+                if hostname == root_domain or hostname.endswith('.' + root_domain):
+                    return True
+            elif netloc != root_netloc:
+                continue
+            elif self.scope == 'host' or root_prefix == '/':
+                return True
+            elif path == root_prefix or path.startswith(root_prefix + '/'):
+                return True
+        return False
+
+    def allows(self, url):
+        '''
+        Returns whether a link to url should be followed.
+        '''
+        if url in self.roots:
+            return True
+        try:
+            parts = urlsplit(url)
+        except ValueError:
+            return False
+        if parts.scheme.lower() not in self.schemes or not self._in_site(parts):
+            return False
+        if self.include and not any(pattern.search(url) for pattern in self.include):
+            return False
+        return not any(pattern.search(url) for pattern in self.exclude)
+
+    def has_budget(self, pages, downloaded):
+        '''
+        Returns whether another fetch may start.
+        Args:
+          @ pages: pages stored so far plus fetches in flight.
+          @ downloaded: body bytes downloaded so far.
+        '''
+        if self.max_pages and pages >= self.max_pages:
+            return False
+        return not (self.max_bytes and downloaded >= self.max_bytes)
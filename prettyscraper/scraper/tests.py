@@ -1,3 +1,786 @@
-from django.test import TestCase
+import asyncio
+import json
+import math
+import multiprocessing
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
-# Create your tests here.
+from unittest import mock
+from urllib.robotparser import RobotFileParser
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import connections
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+
+from . import metrics
+from .bench import SyntheticSite, run_benchmark, run_workers
+from .cache import DiskCache, HttpCache
+from .client import HttpClient
+from .events import JobBroadcaster, get_broadcaster
+from .exports import ArtifactCache, iterate_in_thread, render_all
+from .extract import extract_main_text
+from .frontier import BloomFilter, canonicalize_url
+from .jobs import claim_next_job, recover_stale_jobs, run_job
+from .models import CrawlJob, FrontierEntry, Link, Page, PageBlob, SkippedPage
+from .politeness import Politeness, TokenBucket
+from .retention import RetentionPolicy
+from .scope import ScopePolicy
+from .views import crawl, get_page_content, render_pages, take_over_previous_crawl
+from .writer import PageWriter
+
+
+class LocalSite:
+    '''
+    Local HTTP server answering every GET with pages[path], a (status, headers, body) tuple.
+    '''
+
+    def __init__(self, pages):
+        self.pages = pages
+        self.requests = []
+        site = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                site.requests.append(self.path)
+                status, headers, body = site.pages.get(self.path, (404, {}, b''))
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self._server.server_port}'
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+class HttpCacheTests(SimpleTestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.site = LocalSite({
+            '/docs': (301, {'Location': '/docs/'}, b''),
+            '/docs/': (200, {'Content-Type': 'text/html', 'Cache-Control': 'max-age=600'},
+                       b'<html><head><title>Docs</title></head><body><a href="intro">Intro</a></body></html>'),
+        })
+
+    def tearDown(self):
+        self.site.stop()
+        shutil.rmtree(self.directory)
+
+    def test_cache_hit_resolves_links_against_redirect_target(self):
+        cache = HttpCache(self.directory)
+        client = HttpClient(cache=cache)
+        try:
+            fresh = get_page_content(f'{self.site.url}/docs', client)
+            cached = get_page_content(f'{self.site.url}/docs', client)
+        finally:
+            client.close()
+
+        self.assertEqual(cache.stats['hits'], 1)
+        self.assertEqual(self.site.requests, ['/docs', '/docs/'])
+        self.assertEqual(fresh['links'], [(f'{self.site.url}/docs/intro', 'Intro')])
+        self.assertEqual(cached['links'], fresh['links'])
+        self.assertEqual(cached['base_url'], f'{self.site.url}/docs/')
+
+    def test_eviction_keeps_cache_under_max_bytes(self):
+        cache = DiskCache(self.directory, max_bytes=250)
+        try:
+            for i in range(10):
+                cache.put(f'{i:02d}', b'x' * 100)
+            self.assertIsNone(cache.read('00'))
+            self.assertEqual(cache.read('09'), b'x' * 100)
+            self.assertEqual(cache.stats['evicted'], 8)
+        finally:
+            cache.close()
+
+
+class ExtractTests(SimpleTestCase):
+
+    ARTICLE_TEXT = 'The main text of the page, long enough to be chosen as the main block. ' * 4
+
+    def test_keeps_header_of_main_block_only(self):
+        html = (
+            '<html><body><header><h1>Site name</h1><p>Tagline of the site, shown on every page.</p></header>'
+            f'<article><header><h1>Article title</h1></header><p>{self.ARTICLE_TEXT}</p></article></body></html>'
+        )
+        text = extract_main_text(html)
+        self.assertIn('<h1>Article title</h1>', text)
+        self.assertNotIn('Site name', text)
+
+    def test_drops_page_header_when_main_block_is_body(self):
+        html = f'<html><body><header><h1>Site name</h1></header><p>{self.ARTICLE_TEXT}</p></body></html>'
+        text = extract_main_text(html)
+        self.assertNotIn('Site name', text)
+        self.assertIn('The main text of the page', text)
+
+    def test_nested_list_item_keeps_its_text(self):
+        html = f'<div><p>{self.ARTICLE_TEXT}</p><ul><li>one</li><li>two<ul><li>nested</li></ul></li></ul></div>'
+        text = extract_main_text(html)
+        self.assertIn('<li>one</li>\n<li>two</li>\n<li>nested</li>', text)
+
+    def test_keeps_loose_text_next_to_blocks(self):
+        html = (
+            f'<div><p>{self.ARTICLE_TEXT}</p>Loose <b>text</b> and a <a href="/x">link</a>'
+            '<div>Text of a div</div><table><tr><td>Text of a cell</td></tr></table></div>'
+        )
+        text = extract_main_text(html)
+        self.assertIn('<p>Loose text and a <a href="/x">link</a></p>', text)
+        self.assertIn('<p>Text of a div</p>', text)
+        self.assertIn('<p>Text of a cell</p>', text)
+
+    def test_drops_boilerplate(self):
+        html = (
+            '<html><body><nav><a href="/">Home</a></nav><div class="sidebar"><p>Sidebar text, with commas, and more.</p></div>'
+            f'<main><p>{self.ARTICLE_TEXT}</p><script>var x = 1;</script></main><footer>Copyright</footer></body></html>'
+        )
+        text = extract_main_text(html)
+        self.assertTrue(text.startswith('<p>The main text of the page'))
+        for dropped in ('Home', 'Sidebar', 'var x', 'Copyright'):
+            self.assertNotIn(dropped, text)
+
+    @override_settings(SCRAPER_EXTRACT_MAIN_TEXT=True)
+    def test_extract_checkbox_follows_setting(self):
+        response = self.client.get('/scraper/')
+        self.assertContains(response, 'id="extract" checked')
+
+    @override_settings(SCRAPER_EXTRACT_MAIN_TEXT=False)
+    def test_extract_checkbox_unchecked_by_default(self):
+        response = self.client.get('/scraper/')
+        self.assertNotContains(response, 'id="extract" checked')
+
+
+class ScopePolicyTests(SimpleTestCase):
+
+    def test_scopes(self):
+        root = 'http://www.example.com/docs'
+        cases = {
+            'host': ('http://www.example.com/blog', 'http://example.com/docs/a'),
+            'domain': ('https://blog.example.com/', 'http://example.org/'),
+            'prefix': ('http://www.example.com/docs/a', 'http://www.example.com/blog'),
+        }
+        for scope, (allowed, refused) in cases.items():
+            policy = ScopePolicy(root, scope=scope, include=(), exclude=())
+            self.assertTrue(policy.allows(allowed), (scope, allowed))
+            self.assertFalse(policy.allows(refused), (scope, refused))
+        self.assertTrue(ScopePolicy(root, scope='any', include=(), exclude=()).allows('http://example.org/'))
+
+    def test_include_exclude_and_schemes(self):
+        policy = ScopePolicy('http://example.com/', scope='host', include=(r'/docs/',), exclude=(r'\.pdf$',))
+        self.assertTrue(policy.allows('http://example.com/docs/a'))
+        self.assertFalse(policy.allows('http://example.com/blog/a'))
+        self.assertFalse(policy.allows('http://example.com/docs/a.pdf'))
+        self.assertFalse(policy.allows('ftp://example.com/docs/a'))
+        # The root is always in scope.
+        self.assertTrue(policy.allows('http://example.com/'))
+
+    def test_rebase_follows_redirected_root(self):
+        for scope in ('host', 'prefix'):
+            policy = ScopePolicy('http://example.com/docs', scope=scope, include=(), exclude=())
+            self.assertFalse(policy.allows('https://www.example.com/docs/a'))
+            policy.rebase('https://www.example.com/docs')
+            self.assertTrue(policy.allows('https://www.example.com/docs/a'), scope)
+            self.assertTrue(policy.allows('http://example.com/docs/a'), scope)
+
+    def test_budget(self):
+        policy = ScopePolicy('http://example.com/', max_pages=2, max_bytes=100)
+        self.assertTrue(policy.has_budget(1, 50))
+        self.assertFalse(policy.has_budget(2, 50))
+        self.assertFalse(policy.has_budget(1, 100))
+
+
+class CanonicalizeUrlTests(SimpleTestCase):
+
+    def test_spellings_of_one_page_compare_equal(self):
+        for url in ('HTTP://Example.COM:80/docs/#intro', 'http://example.com/docs/', ' http://example.com/docs '):
+            self.assertEqual(canonicalize_url(url), 'http://example.com/docs', url)
+        self.assertEqual(canonicalize_url('https://example.com:443'), 'https://example.com/')
+
+    def test_keeps_what_tells_pages_apart(self):
+        self.assertEqual(canonicalize_url('http://example.com:8080/'), 'http://example.com:8080/')
+        self.assertEqual(canonicalize_url('http://user:pw@Example.com/a'), 'http://user:pw@example.com/a')
+        self.assertEqual(canonicalize_url('http://[::1]:8000/a/'), 'http://[::1]:8000/a')
+        self.assertEqual(canonicalize_url('http://example.com/?b=2&a=1', sort_query=False),
+                         'http://example.com/?b=2&a=1')
+        self.assertEqual(canonicalize_url('http://example.com/?b=2&a=1', sort_query=True),
+                         'http://example.com/?a=1&b=2')
+
+    def test_leaves_other_urls_alone(self):
+        for url in ('mailto:someone@example.com', 'ftp://example.com/file', 'http://example.com:port/', '/relative'):
+            self.assertEqual(canonicalize_url(url), url)
+
+
+class BloomFilterTests(SimpleTestCase):
+
+    def test_no_false_negatives_and_bounded_false_positives(self):
+        bloom = BloomFilter(1000, error_rate=0.01)
+        added = [f'http://example.com/{index}' for index in range(1000)]
+        for url in added:
+            bloom.add(url)
+        self.assertTrue(all(url in bloom for url in added))
+        false_positives = sum(f'http://example.org/{index}' in bloom for index in range(10000))
+        self.assertLess(false_positives, 300)
+
+
+class PolitenessTests(SimpleTestCase):
+
+    def test_token_bucket_allows_burst_then_rate(self):
+        bucket = TokenBucket(rate=2, burst=3)
+        now = time.monotonic()
+        for _ in range(3):
+            self.assertEqual(bucket.wait_time(now), 0.0)
+            bucket.take(now)
+        self.assertAlmostEqual(bucket.wait_time(now), 0.5)
+        self.assertEqual(bucket.wait_time(now + 0.5), 0.0)
+        # Idle time refills the bucket up to its burst, not beyond.
+        self.assertEqual(bucket.wait_time(now + 60), 0.0)
+        self.assertEqual(bucket.tokens, 3)
+
+    def test_hosts_have_their_own_budget(self):
+        politeness = Politeness(rate=1, burst=2, obey_robots=False)
+        politeness.dispatched('a.example', time.monotonic())
+        politeness.dispatched('a.example', time.monotonic())
+        self.assertAlmostEqual(politeness.wait_time('a.example', time.monotonic()), 1.0, delta=0.01)
+        self.assertEqual(politeness.wait_time('b.example', time.monotonic()), 0.0)
+
+    @override_settings(SCRAPER_MAX_BACKOFF=10)
+    def test_throttled_host_backs_off(self):
+        politeness = Politeness(rate=100, burst=4, obey_robots=False)
+        politeness.throttled('a.example', retry_after=5)
+        self.assertAlmostEqual(politeness.wait_time('a.example', time.monotonic()), 5, delta=0.1)
+        # Without Retry-After the delay doubles with every strike, up to SCRAPER_MAX_BACKOFF.
+        politeness.throttled('a.example')
+        self.assertAlmostEqual(politeness.wait_time('a.example', time.monotonic()), 4, delta=0.1)
+        politeness.throttled('a.example')
+        politeness.throttled('a.example')
+        self.assertAlmostEqual(politeness.wait_time('a.example', time.monotonic()), 10, delta=0.1)
+        politeness.succeeded('a.example')
+        politeness.throttled('a.example')
+        self.assertAlmostEqual(politeness.wait_time('a.example', time.monotonic()), 2, delta=0.1)
+
+    def test_robots_rules_and_crawl_delay(self):
+        politeness = Politeness(rate=10, burst=4, obey_robots=True)
+        self.assertEqual(politeness.wait_time('a.example', time.monotonic()), math.inf)
+        robots = RobotFileParser()
+        robots.parse(['User-agent: *', 'Crawl-delay: 2', 'Disallow: /private'])
+        politeness.set_robots('a.example', robots)
+        self.assertFalse(politeness.allowed('a.example', 'http://a.example/private/page'))
+        self.assertTrue(politeness.allowed('a.example', 'http://a.example/public'))
+        now = time.monotonic()
+        self.assertEqual(politeness.wait_time('a.example', now), 0.0)
+        politeness.dispatched('a.example', now)
+        self.assertAlmostEqual(politeness.wait_time('a.example', now), 2.0)
+
+
+@override_settings(SCRAPER_HTTP_CACHE=False, SCRAPER_INCREMENTAL=False, SCRAPER_SCOPE_INCLUDE=(),
+                   SCRAPER_SCOPE_EXCLUDE=())
+class CrawlScopeTests(TestCase):
+
+    def setUp(self):
+        html = '<html><head><title>{}</title></head><body>{}</body></html>'
+        self.site = LocalSite({
+            '/start': (301, {'Location': '/docs/'}, b''),
+            '/docs/': (200, {'Content-Type': 'text/html'}, html.format('Docs', '<a href="a">A</a>').encode()),
+            '/docs/a': (200, {'Content-Type': 'text/html'}, html.format('A', '').encode()),
+        })
+
+    def tearDown(self):
+        self.site.stop()
+
+    def test_prefix_scope_follows_root_redirect(self):
+        job = CrawlJob.objects.create(user_id='user', root_url=f'{self.site.url}/start', max_depth=2)
+        scope = ScopePolicy(job.root_url, scope='prefix')
+        self.assertTrue(crawl('user', job.root_url, 2, crawl_job=job, scope=scope))
+        self.assertEqual(
+            sorted(Page.objects.filter(crawl=job).values_list('url', flat=True)),
+            [f'{self.site.url}/docs/a', f'{self.site.url}/start'],
+        )
+
+
+@override_settings(SCRAPER_HTTP_CACHE=False, SCRAPER_OBEY_ROBOTS=False, SCRAPER_SCOPE_INCLUDE=(),
+                   SCRAPER_SCOPE_EXCLUDE=(), SCRAPER_EXTRACT_MAIN_TEXT=False)
+class IncrementalCrawlTests(TestCase):
+
+    def setUp(self):
+        self.site = LocalSite({})
+        self.root_url = f'{self.site.url}/'
+        self.serve('<a href="/a">A</a> <a href="/b">B</a>')
+        for path in ('/a', '/b'):
+            self.serve(path, path)
+
+    def tearDown(self):
+        self.site.stop()
+
+    def serve(self, body, path='/'):
+        html = f'<html><head><title>{path}</title></head><body>{body}</body></html>'
+        self.site.pages[path] = (200, {'Content-Type': 'text/html'}, html.encode())
+
+    def crawl_job(self, extract=None):
+        job = CrawlJob.objects.create(user_id='user', root_url=self.root_url, max_depth=2, status=CrawlJob.RUNNING)
+        self.assertTrue(crawl('user', self.root_url, 2, crawl_job=job, incremental=True, extract=extract))
+        CrawlJob.objects.filter(pk=job.pk).update(status=CrawlJob.DONE)
+        return job
+
+    def test_recrawl_takes_over_pages_and_deletes_stale_ones(self):
+        first = self.crawl_job()
+        before = dict(Page.objects.filter(crawl=first).values_list('url', 'pk'))
+        self.assertEqual(len(before), 3)
+
+        # /b is no longer linked from the root.
+        self.serve('<a href="/a">A</a>')
+        second = self.crawl_job()
+        after = dict(Page.objects.filter(crawl=second).values_list('url', 'pk'))
+        self.assertEqual(after, {url: pk for url, pk in before.items() if url != f'{self.site.url}/b'})
+        self.assertFalse(Page.objects.filter(crawl=first).exists())
+        self.assertFalse(Page.objects.filter(url=f'{self.site.url}/b').exists())
+
+    def test_crawl_in_other_extraction_mode_is_not_taken_over(self):
+        first = self.crawl_job()
+        self.assertIs(CrawlJob.objects.get(pk=first.pk).extract_text, False)
+        second = self.crawl_job(extract=True)
+        self.assertEqual(Page.objects.filter(crawl=first).count(), 3)
+        root = Page.objects.get(crawl=second, url=self.root_url)
+        self.assertNotIn('<title>', root.content)
+        # Nor is a main text crawl taken over by a full page one.
+        third = self.crawl_job(extract=False)
+        self.assertEqual(Page.objects.filter(crawl=second).count(), 3)
+        self.assertIn('<title>', Page.objects.get(crawl=third, url=self.root_url).content)
+
+    def test_running_crawl_is_not_taken_over(self):
+        first = self.crawl_job()
+        CrawlJob.objects.filter(pk=first.pk).update(status=CrawlJob.RUNNING)
+        second = CrawlJob.objects.create(user_id='user', root_url=self.root_url, max_depth=2)
+        self.assertEqual(take_over_previous_crawl('user', self.root_url, second), {})
+        self.assertEqual(take_over_previous_crawl('someone else', self.root_url, second), {})
+        self.assertEqual(Page.objects.filter(crawl=first).count(), 3)
+
+
+class PageWriterTests(TestCase):
+
+    def build(self, url, depth=1, parent=None):
+        return Page.build('user', url, url, 'page.html', parent.url if parent else None, depth=depth, parent=parent)
+
+    def test_writes_full_batches(self):
+        writer = PageWriter(batch_size=3, flush_ms=60000)
+        root = writer.add(self.build('http://example.com/'), PageBlob.pack('<p>Root</p>'),
+                          [('http://example.com/a', 'A')])
+        child = writer.add(self.build('http://example.com/a', 2, root), PageBlob.pack('<p>A</p>'))
+        writer.maybe_flush()
+        self.assertFalse(Page.objects.exists())
+
+        writer.add(self.build('http://example.com/b', 2, root), PageBlob.pack('<p>Root</p>'))
+        self.assertEqual((writer.flushes, writer.written, writer.links), (1, 3, 1))
+        self.assertEqual(Page.objects.count(), 3)
+        # Children buffered with their parent point to it once written.
+        self.assertEqual(Page.objects.get(pk=child.pk).parent_id, root.pk)
+        # Pages with the same body share its blob.
+        self.assertEqual(PageBlob.objects.count(), 2)
+        self.assertEqual(Link.objects.get().source_id, root.pk)
+
+    def test_flushes_after_interval_and_on_exit(self):
+        with PageWriter(batch_size=100, flush_ms=10) as writer:
+            writer.add(self.build('http://example.com/'), PageBlob.pack('<p>Root</p>'))
+            time.sleep(0.02)
+            writer.maybe_flush()
+            self.assertEqual(Page.objects.count(), 1)
+            writer.add(self.build('http://example.com/a'), PageBlob.pack('<p>A</p>'))
+            writer.skip(SkippedPage(user_id='user', url='http://example.com/b', reason='Too large'))
+        self.assertEqual(Page.objects.count(), 2)
+        self.assertEqual(SkippedPage.objects.get().url, 'http://example.com/b')
+        self.assertEqual(writer.flushes, 2)
+
+    def test_update_replaces_links(self):
+        page = Page.create('user', 'http://example.com/', 'Old', 'page.html', '<p>Old</p>', None)
+        Link.objects.create(source=page, target_url='http://example.com/old', anchor_text='Old')
+        with PageWriter() as writer:
+            page.title = 'New'
+            writer.update(page, PageBlob.pack('<p>New</p>'), links=[('http://example.com/new', 'New')])
+        page = Page.objects.get(pk=page.pk)
+        self.assertEqual((page.title, page.content), ('New', '<p>New</p>'))
+        self.assertEqual(list(Link.objects.values_list('target_url', flat=True)), ['http://example.com/new'])
+
+
+@override_settings(SCRAPER_HTTP_CACHE=False, SCRAPER_INCREMENTAL=False, SCRAPER_OBEY_ROBOTS=False,
+                   SCRAPER_HOST_RATE=1000.0, SCRAPER_SCOPE='host', SCRAPER_SCOPE_INCLUDE=(), SCRAPER_SCOPE_EXCLUDE=())
+class DistributedCrawlTests(TransactionTestCase):
+    # Worker processes are forked, they only see what this process committed.
+
+    def create_job(self, site):
+        return CrawlJob.objects.create(user_id='user', root_url=canonicalize_url(site.url), max_depth=site.depth,
+                                       distributed=True)
+
+    def assert_crawled(self, job, site):
+        self.assertEqual(job.status, CrawlJob.DONE)
+        self.assertEqual(job.pages_fetched, site.expected_pages())
+        urls = list(Page.objects.filter(crawl=job).values_list('url', flat=True))
+        self.assertEqual(len(urls), site.expected_pages())
+        self.assertEqual(len(set(urls)), len(urls))
+        self.assertFalse(FrontierEntry.objects.filter(crawl=job).exists())
+        self.assertFalse(SkippedPage.objects.filter(crawl=job).exists())
+
+    def test_workers_share_crawl(self):
+        with SyntheticSite(fan_out=4, depth=3, page_bytes=2000, latency=0.02) as site:
+            job = run_workers(self.create_job(site).pk, 3)
+            self.assert_crawled(job, site)
+            # Every page was fetched once, by one of the workers.
+            self.assertEqual(site.requests, site.expected_pages())
+
+    @override_settings(SCRAPER_LEASE_SECONDS=2)
+    def test_lease_of_dead_worker_is_reclaimed(self):
+        with SyntheticSite(fan_out=3, depth=2, page_bytes=2000, latency=0.5) as site:
+            job = self.create_job(site)
+            connections.close_all()
+            doomed = multiprocessing.get_context('fork').Process(target=lambda: run_job(claim_next_job(pk=job.pk)))
+            doomed.start()
+            deadline = time.monotonic() + 10
+            while not FrontierEntry.objects.filter(crawl=job, state=FrontierEntry.LEASED).exists():
+                self.assertLess(time.monotonic(), deadline)
+                time.sleep(0.02)
+            # Killed while fetching the root, its lease is neither ended nor released.
+            doomed.kill()
+            doomed.join()
+            entry = FrontierEntry.objects.get(crawl=job)
+            self.assertEqual(entry.state, FrontierEntry.LEASED)
+            self.assertEqual(CrawlJob.objects.get(pk=job.pk).status, CrawlJob.RUNNING)
+
+            job = run_workers(job.pk, 2)
+            self.assert_crawled(job, site)
+
+
+class BenchmarkTests(TransactionTestCase):
+
+    def test_benchmark_leaves_no_rows(self):
+        with SyntheticSite(fan_out=2, depth=2, page_bytes=2000) as site:
+            report = run_benchmark(site, download_types=('json',))
+        self.assertEqual(report['crawl']['status'], CrawlJob.DONE)
+        self.assertEqual(report['crawl']['pages'], site.expected_pages())
+        self.assertGreater(report['downloads']['json']['bytes'], 0)
+        self.assertFalse(CrawlJob.objects.exists())
+        self.assertFalse(Page.objects.exists())
+        self.assertFalse(User.objects.exists())
+
+
+class ScrapeViewTests(TestCase):
+
+    def test_rejects_invalid_max_pages(self):
+        for max_pages in ('many', '-1', '0'):
+            response = self.client.post('/scraper/scrape/', {'input_url': 'http://example.com/', 'max_pages': max_pages})
+            self.assertEqual(response.status_code, 400, max_pages)
+        self.assertFalse(CrawlJob.objects.exists())
+
+    def test_queues_job(self):
+        response = self.client.post('/scraper/scrape/', {'input_url': 'http://example.com/', 'max_pages': '10'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(CrawlJob.objects.get().max_pages, 10)
+
+
+@override_settings(SCRAPER_JOB_STALE_SECONDS=60, SCRAPER_JOB_ATTEMPTS=2)
+class JobRecoveryTests(TestCase):
+
+    def create_job(self, heartbeat_age, attempts=1, **fields):
+        now = timezone.now()
+        return CrawlJob.objects.create(
+            user_id='user', root_url='http://example.com/', status=CrawlJob.RUNNING, attempts=attempts,
+            started_at=now - timedelta(seconds=600), heartbeat_at=now - timedelta(seconds=heartbeat_age), **fields,
+        )
+
+    def test_stale_jobs_are_queued_again_then_failed(self):
+        stale = self.create_job(120)
+        exhausted = self.create_job(120, attempts=2)
+        alive = self.create_job(10)
+        distributed = self.create_job(120, distributed=True)
+        self.assertEqual(recover_stale_jobs(), 2)
+
+        self.assertEqual(CrawlJob.objects.get(pk=stale.pk).status, CrawlJob.QUEUED)
+        exhausted.refresh_from_db()
+        self.assertEqual(exhausted.status, CrawlJob.FAILED)
+        self.assertIsNotNone(exhausted.finished_at)
+        self.assertEqual(CrawlJob.objects.get(pk=alive.pk).status, CrawlJob.RUNNING)
+        self.assertEqual(CrawlJob.objects.get(pk=distributed.pk).status, CrawlJob.RUNNING)
+
+        job = claim_next_job()
+        self.assertEqual((job.pk, job.attempts), (stale.pk, 2))
+        self.assertEqual(CrawlJob.objects.get(pk=stale.pk).attempts, 2)
+
+    def test_retry_revalidates_pages_of_earlier_attempt(self):
+        job = self.create_job(120)
+        page = Page.create('user', 'http://example.com/', 'Example', 'Example', '<p>Hello</p>', None, crawl=job)
+        self.assertEqual(take_over_previous_crawl('user', 'http://example.com/', job), {page.url: page})
+
+
+class JobEventsTests(TestCase):
+
+    async def test_broadcaster_reads_each_job_once_per_interval(self):
+        job = await CrawlJob.objects.acreate(user_id='user', root_url='http://example.com/', status=CrawlJob.RUNNING)
+        broadcaster = JobBroadcaster(0.01)
+        first, second = broadcaster.subscribe(job), broadcaster.subscribe(job)
+        self.assertIs(await first.get(), job)
+        self.assertIs(await second.get(), job)
+
+        await CrawlJob.objects.filter(pk=job.pk).aupdate(pages_fetched=3)
+        with mock.patch.object(CrawlJob.objects, 'filter', wraps=CrawlJob.objects.filter) as read:
+            for _ in range(3):
+                first_job, second_job = await first.get(), await second.get()
+                # Both clients got the job from the same read.
+                self.assertIs(first_job, second_job)
+        self.assertEqual(first_job.pages_fetched, 3)
+        read.assert_called_with(pk__in=[job.pk])
+
+        job_id = job.pk
+        await job.adelete()
+        self.assertIsNone(await first.get())
+        broadcaster.unsubscribe(job_id, first)
+        broadcaster.unsubscribe(job_id, second)
+        await asyncio.wait_for(broadcaster._task, 1)
+
+    @override_settings(SCRAPER_EVENTS_INTERVAL=0.01)
+    async def test_streams_progress_until_done(self):
+        job = await CrawlJob.objects.acreate(user_id='user', root_url='http://example.com/', status=CrawlJob.RUNNING)
+        session = await self.async_client.asession()
+        await session.aset('scraper_user_id', 'user')
+        await session.asave()
+        self.async_client.cookies[settings.SESSION_COOKIE_NAME] = session.session_key
+
+        response = await self.async_client.get(f'/scraper/jobs/{job.pk}/events/')
+        chunks = aiter(response.streaming_content)
+        self.assertTrue((await anext(chunks)).startswith(b'retry: 10'))
+        self.assertTrue((await anext(chunks)).startswith(b'event: progress'))
+        await CrawlJob.objects.filter(pk=job.pk).aupdate(status=CrawlJob.DONE, pages_fetched=1)
+        done = await anext(chunks)
+        self.assertTrue(done.startswith(b'event: done'))
+        self.assertEqual(json.loads(done.split(b'data: ')[1])['pagesFetched'], 1)
+        with self.assertRaises(StopAsyncIteration):
+            await anext(chunks)
+        self.assertFalse(get_broadcaster()._queues)
+
+
+def render_item(item):
+    # Module level, so that render pool processes can unpickle it.
+    if item == 'fail':
+        raise ValueError('Cannot render fail')
+    time.sleep(0.3 if item == 'slow' else 0.05 if item == 'stuck' else 0)
+    return item.upper().encode('utf-8')
+
+
+def render_stuck(item):
+    time.sleep(3 if item == 'stuck' else 0)
+    return item.encode('utf-8')
+
+
+class RenderAllTests(SimpleTestCase):
+
+    ITEMS = ['slow', 'a', 'fail', 'b', 'c', 'd', 'e']
+
+    def assert_rendered(self, rendered):
+        self.assertEqual([item for item, _, _ in rendered], self.ITEMS)
+        for item, content, error in rendered:
+            if item == 'fail':
+                self.assertIsNone(content)
+                self.assertIn('Cannot render fail', error)
+            else:
+                self.assertEqual((content, error), (item.upper().encode('utf-8'), None))
+
+    def test_in_process_keeps_order(self):
+        self.assert_rendered(list(render_all(render_item, iter(self.ITEMS), processes=1)))
+
+    def test_pool_keeps_order(self):
+        self.assert_rendered(list(render_all(render_item, iter(self.ITEMS), processes=2)))
+
+    def test_pool_gives_up_on_stuck_item(self):
+        # Starting the pool's processes does not count against the timeout below.
+        list(render_all(render_item, ['a', 'b'], processes=2))
+        rendered = list(render_all(render_stuck, ['a', 'stuck', 'b'], processes=2, timeout=1))
+        self.assertEqual([item for item, _, _ in rendered], ['a', 'stuck', 'b'])
+        self.assertEqual(rendered[0][1:], (b'a', None))
+        self.assertIn('timed out', rendered[1][2])
+        # Queued behind the stuck render, it is sent to a new pool.
+        self.assertEqual(rendered[2][1:], (b'b', None))
+
+
+class RenderPagesTests(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_artifact_cache_lives_in_rendering_thread(self):
+        page = Page.create('user', 'http://example.com/', 'Example', 'Example', '<p>Hello</p>', None)
+        # Loaded here, the test database can not be read from the rendering thread.
+        page.content
+        threads = []
+        init, close = ArtifactCache.__init__, ArtifactCache.close
+
+        def record_init(cache, *args, **kwargs):
+            threads.append(('open', threading.get_ident()))
+            init(cache, *args, **kwargs)
+
+        def record_close(cache):
+            threads.append(('close', threading.get_ident()))
+            close(cache)
+
+        with override_settings(SCRAPER_ARTIFACT_CACHE=True, SCRAPER_ARTIFACT_CACHE_DIR=self.directory), \
+                mock.patch.object(ArtifactCache, '__init__', record_init), \
+                mock.patch.object(ArtifactCache, 'close', record_close):
+            rendered = render_pages([page], 'json')
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                thread, results = executor.submit(lambda: (threading.get_ident(), list(rendered))).result()
+
+        self.assertEqual(threads, [('open', thread), ('close', thread)])
+        self.assertEqual(len(results), 1)
+        self.assertIsNone(results[0][2])
+
+
+class MetricsTests(SimpleTestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.settings = override_settings(SCRAPER_METRICS_DIR=self.directory)
+        self.settings.enable()
+        self.registry = metrics.REGISTRY
+        metrics.REGISTRY = metrics.Metrics()
+
+    def tearDown(self):
+        metrics.REGISTRY = self.registry
+        self.settings.disable()
+        shutil.rmtree(self.directory)
+
+    def pages_fetched(self):
+        return metrics.collect().counters[('scraper_pages_fetched_total', ())]
+
+    def test_persist_adds_other_processes_once(self):
+        metrics.inc('scraper_pages_fetched_total', 2)
+        metrics.persist()
+        own = f'{metrics.get_process_id()}.json'
+        self.assertTrue(own.startswith(f'{socket.gethostname()}-{os.getpid()}-'))
+        self.assertEqual([name for name in os.listdir(self.directory) if name.endswith('.json')], [own])
+        # The file of this process is not added to its live values again.
+        self.assertEqual(self.pages_fetched(), 2)
+
+        other = metrics.Metrics()
+        other.inc('scraper_pages_fetched_total', 3)
+        with open(os.path.join(self.directory, f'{socket.gethostname()}-{os.getpid()}-0123456789ab.json'), 'w') as f:
+            json.dump(other.snapshot(), f)
+        self.assertEqual(self.pages_fetched(), 5)
+
+    def test_files_of_exited_processes_are_folded(self):
+        exited = multiprocessing.get_context('fork').Process(target=lambda: None)
+        exited.start()
+        exited.join()
+        counts = {f'{socket.gethostname()}-{exited.pid}-0123456789ab.json': 2, 'otherhost-1-0123456789ab.json': 3,
+                  f'{exited.pid}-0123456789ab.json': 4}
+        for filename, count in counts.items():
+            other = metrics.Metrics()
+            other.inc('scraper_pages_fetched_total', count)
+            with open(os.path.join(self.directory, filename), 'w') as f:
+                json.dump(other.snapshot(), f)
+
+        self.assertEqual(metrics.compact(), 2)
+        # Files of other hosts are left to a process of that host.
+        self.assertEqual(sorted(os.listdir(self.directory)),
+                         ['compact.lock', metrics.EXITED_FILE, 'otherhost-1-0123456789ab.json'])
+        self.assertEqual(self.pages_fetched(), 9)
+        self.assertEqual(metrics.compact(), 0)
+        self.assertEqual(self.pages_fetched(), 9)
+
+    def test_persist_interval(self):
+        metrics.persist()
+        metrics.inc('scraper_pages_fetched_total')
+        metrics.persist(min_interval=60)
+        with open(os.path.join(self.directory, f'{metrics.get_process_id()}.json')) as f:
+            self.assertEqual(json.load(f)['counters'], [])
+
+    def test_download_persists(self):
+        def chunks():
+            metrics.inc('scraper_pages_rendered_total', type='csv')
+            yield b'chunk'
+
+        async def download():
+            return [chunk async for chunk in iterate_in_thread(chunks())]
+
+        self.assertEqual(asyncio.run(download()), [b'chunk'])
+        with open(os.path.join(self.directory, f'{metrics.get_process_id()}.json')) as f:
+            self.assertEqual(json.load(f)['counters'], [['scraper_pages_rendered_total', {'type': 'csv'}, 1]])
+
+
+@override_settings(SCRAPER_RETENTION_CRAWL_TTL=None, SCRAPER_RETENTION_USER_TTL=None, SCRAPER_RETENTION_MAX_CRAWLS=None,
+                   SCRAPER_RETENTION_MAX_PAGES=None, SCRAPER_RETENTION_PAUSE=0)
+class RetentionPolicyTests(TestCase):
+
+    def setUp(self):
+        self.now = timezone.now()
+
+    def create_crawl(self, user_id, age_days, pages=1, status=CrawlJob.DONE, content=None):
+        finished = self.now - timedelta(days=age_days)
+        job = CrawlJob.objects.create(user_id=user_id, root_url='http://example.com/', status=status,
+                                      finished_at=finished)
+        CrawlJob.objects.filter(pk=job.pk).update(created_at=finished)
+        for index in range(pages):
+            Page.create(user_id, f'http://example.com/{index}', 'Page', 'page.html',
+                        content or f'<p>Crawl {job.pk}, page {index}</p>', None, crawl=job)
+        return job
+
+    def test_crawl_ttl(self):
+        old = self.create_crawl('user', 2)
+        self.create_crawl('user', 0)
+        self.create_crawl('user', 5, status=CrawlJob.RUNNING)
+        self.assertEqual(RetentionPolicy(crawl_ttl=24 * 3600).expired_crawls(self.now), [old.pk])
+
+    def test_max_crawls_keeps_newest_with_pages(self):
+        oldest = self.create_crawl('user', 3)
+        self.create_crawl('user', 2)
+        self.create_crawl('user', 1)
+        # A crawl whose pages a re-crawl took over does not count.
+        self.create_crawl('user', 0, pages=0)
+        self.create_crawl('other', 4)
+        self.assertEqual(RetentionPolicy(max_crawls=2).expired_crawls(self.now), [oldest.pk])
+
+    def test_max_pages_keeps_newest_crawl(self):
+        old = self.create_crawl('user', 2, pages=2)
+        self.create_crawl('user', 1, pages=5)
+        self.assertEqual(RetentionPolicy(max_pages=3).expired_crawls(self.now), [old.pk])
+
+    def test_run_deletes_expired_data(self):
+        old = self.create_crawl('user', 10, pages=2)
+        Page.objects.filter(crawl=old, url='http://example.com/1').delete()
+        Page.create('user', 'http://example.com/shared', 'Page', 'page.html', '<p>Shared</p>', None, crawl=old)
+        new = self.create_crawl('user', 0, content='<p>Shared</p>')
+        idle = User.objects.create(username='idle', date_joined=self.now - timedelta(days=100))
+        idle_crawl = self.create_crawl('idle', 100)
+        staff = User.objects.create(username='staff', is_staff=True, date_joined=self.now - timedelta(days=100))
+        policy = RetentionPolicy(crawl_ttl=7 * 24 * 3600, user_ttl=30 * 24 * 3600)
+
+        report = policy.run(now=self.now, dry_run=True)
+        self.assertEqual(report, {'crawls': 1, 'users': 1, 'pages': 3})
+        self.assertEqual(Page.objects.count(), 4)
+
+        report = policy.run(now=self.now, vacuum=False)
+        self.assertEqual((report['crawls'], report['users']), (1, 1))
+        self.assertEqual(list(CrawlJob.objects.values_list('pk', flat=True)), [new.pk])
+        self.assertFalse(CrawlJob.objects.filter(pk=idle_crawl.pk).exists())
+        self.assertEqual(list(User.objects.values_list('pk', flat=True)), [staff.pk])
+        self.assertFalse(User.objects.filter(pk=idle.pk).exists())
+        # The body the new crawl still uses is kept, the others went with their pages.
+        self.assertEqual(list(PageBlob.objects.values_list('hash', flat=True)), [PageBlob.digest('<p>Shared</p>')])
@@ -0,0 +1,274 @@
+'''
+Direct-to-PDF rendering of pages with reportlab, the fast alternative to the
+xhtml2pdf template.
+
+There is no HTML or CSS layout pass: the stored body is tokenized in chunks,
+turned into blocks of text (headings, paragraphs, list items, preformatted
+text) as it is read, and every block is wrapped and drawn on the canvas right
+away, flowing onto new pages as needed. The links of the page are listed at
+the end. Only the current block is held besides the PDF being written.
+'''
+import io
+import re
+from functools import lru_cache
+from html.parser import HTMLParser
+
+from reportlab.lib.colors import HexColor
+from reportlab.lib.pagesizes import A4
+from reportlab.lib.units import cm
+from reportlab.pdfbase.pdfmetrics import stringWidth
+from reportlab.pdfgen import canvas
+
+
+# Elements whose content is never drawn.
+SKIPPED_TAGS = frozenset((
+    'head', 'script', 'style', 'noscript', 'template', 'svg', 'canvas', 'object', 'iframe', 'select', 'textarea',
+))
+
+# Elements that start and end a block of text.
+BLOCK_TAGS = frozenset((
+    'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'p', 'li', 'pre', 'blockquote', 'div', 'section', 'article', 'main',
+    'header', 'footer', 'nav', 'aside', 'ul', 'ol', 'dl', 'dt', 'dd', 'table', 'tr', 'td', 'th', 'figure',
+    'figcaption', 'address', 'br', 'hr', 'body',
+))
+
+# Font and size of every kind of block, body text being 'p'.
+STYLES = {
+    'title': ('Helvetica-Bold', 18),
+    'h1': ('Helvetica-Bold', 16),
+    'h2': ('Helvetica-Bold', 14),
+    'h3': ('Helvetica-Bold', 12),
+    'h4': ('Helvetica-Bold', 11),
+    'h5': ('Helvetica-Bold', 10),
+    'h6': ('Helvetica-Bold', 10),
+    'p': ('Helvetica', 10),
+    'li': ('Helvetica', 10),
+    'pre': ('Courier', 8.5),
+    'url': ('Helvetica', 8),
+    'link': ('Helvetica', 9),
+}
+
+MARGIN = 2 * cm
+
+TEXT_COLOR = HexColor('#333333')
+URL_COLOR = HexColor('#777777')
+LINK_COLOR = HexColor('#3498db')
+
+# Characters of body text fed to the tokenizer at a time.
+FEED_CHARS = 64 * 1024
+
+WHITESPACE = re.compile(r'\s+')
+
+
+class TextBlockParser(HTMLParser):
+    '''
+    Tokenizer that turns a page into (kind, text) blocks, taken with take_blocks as it is fed.
+    Kind is the heading tag for headings, 'li', 'pre', or 'p' for any other text.
+    '''
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self._blocks = []
+        self._parts = []
+        self._kinds = []
+        self._skipping = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in SKIPPED_TAGS:
+            self._skipping += 1
+        elif tag in BLOCK_TAGS:
+            self._end_block()
+            # A paragraph or list item left open ends at the next one.
+            if tag in ('p', 'li') and self._kinds and self._kinds[-1] == tag:
+                self._kinds.pop()
+            if tag in STYLES:
+                self._kinds.append(tag)
+
+    def handle_startendtag(self, tag, attrs):
+        if tag in BLOCK_TAGS:
+            self._end_block()
+
+    def handle_endtag(self, tag):
+        if tag in SKIPPED_TAGS:
+            self._skipping = max(0, self._skipping - 1)
+        elif tag in BLOCK_TAGS:
+            self._end_block()
+            # Tags left open inside this one end with it, as do list items with their list.
+            if tag in self._kinds:
+                while self._kinds.pop() != tag:
+                    pass
+            elif tag in ('ul', 'ol'):
+                while self._kinds and self._kinds[-1] == 'li':
+                    self._kinds.pop()
+
+    def handle_data(self, data):
+        if not self._skipping:
+            self._parts.append(data)
+
+    def _end_block(self):
+        if not self._parts:
+            return
+        kind = self._kinds[-1] if self._kinds else 'p'
+        text = ''.join(self._parts)
+        self._parts = []
+        if kind != 'pre':
+            text = WHITESPACE.sub(' ', text).strip()
+        if text.strip():
+            self._blocks.append((kind, text))
+
+    def close(self):
+        super().close()
+        self._end_block()
+
+    def take_blocks(self):
+        blocks, self._blocks = self._blocks, []
+        return blocks
+
+
+def iter_blocks(text, feed_chars=FEED_CHARS):
+    '''
+    Generator of the (kind, text) blocks of a page, tokenized feed_chars at a time.
+    '''
+    parser = TextBlockParser()
+    for start in range(0, len(text), feed_chars):
+        parser.feed(text[start:start + feed_chars])
+        yield from parser.take_blocks()
+    parser.close()
+    yield from parser.take_blocks()
+
+
+@lru_cache(maxsize=64 * 1024)
+def word_width(word, font, size):
+    # Measuring is most of the work of wrapping, and words repeat across a page and across pages.
+    return stringWidth(word, font, size)
+
+
+def split_words(text, font, size, width):
+    '''
+    Greedy word wrap: as many words as fit width on every line.
+    '''
+    space = word_width(' ', font, size)
+    lines, line, used = [], [], 0.0
+    for word in text.split():
+        length = word_width(word, font, size)
+        if line and used + space + length > width:
+            lines.append(' '.join(line))
+            line, used = [], 0.0
+        if length > width:
+            *pieces, word = break_line(word, font, size, width)
+            lines.extend(pieces)
+            length = word_width(word, font, size)
+        used += length + (space if line else 0.0)
+        line.append(word)
+    if line:
+        lines.append(' '.join(line))
+    return lines
+
+
+def break_line(line, font, size, width):
+    '''
+    Cuts a line wider than width, such as a long URL, wherever it reaches the edge.
+    '''
+    pieces, start, used = [], 0, 0.0
+    for end, char in enumerate(line):
+        char_width = word_width(char, font, size)
+        if used + char_width > width and end > start:
+            pieces.append(line[start:end])
+            start, used = end, 0.0
+        used += char_width
+    pieces.append(line[start:])
+    return pieces
+
+
+def wrap_lines(kind, text, font, size, width):
+    '''
+    Splits a block into lines that fit width: at spaces for text, only at the edge
+    for preformatted text, which keeps its spacing and line breaks.
+    '''
+    if kind != 'pre':
+        return split_words(text, font, size, width)
+    lines = []
+    for line in text.splitlines():
+        if stringWidth(line, font, size) > width:
+            lines.extend(break_line(line, font, size, width))
+        else:
+            lines.append(line)
+    return lines
+
+
+class TextPdf:
+    '''
+    A reportlab canvas with a cursor, drawing wrapped blocks of text top to bottom
+    and starting a new page when one is full.
+    '''
+
+    def __init__(self, output, title, pagesize=A4):
+        self.canvas = canvas.Canvas(output, pagesize=pagesize, pageCompression=1, invariant=1)
+        self.canvas.setTitle(title)
+        self.width, self.height = pagesize
+        self.y = self.height - MARGIN
+
+    def _line(self, leading):
+        if self.y - leading < MARGIN:
+            # A new page starts with the default font and color, the block goes on in its own.
+            self.canvas.showPage()
+            self.canvas.setFont(*self._style)
+            self.canvas.setFillColor(self._color)
+            self.y = self.height - MARGIN
+        self.y -= leading
+
+    def draw(self, kind, text, link=None, color=None):
+        '''
+        Draws one block, wrapped to the width of the page. A link makes every line of it clickable.
+        '''
+        font, size = STYLES[kind]
+        leading = size * 1.3
+        indent = 12 if kind in ('li', 'link') else 0
+        width = self.width - 2 * MARGIN - indent
+        # Headings get some room above them, paragraphs a little.
+        self.y -= size * 0.8 if kind.startswith('h') or kind == 'title' else size * 0.4
+        self._style, self._color = (font, size), color or TEXT_COLOR
+        self.canvas.setFont(font, size)
+        self.canvas.setFillColor(self._color)
+        for number, line in enumerate(wrap_lines(kind, text, font, size, width)):
+            self._line(leading)
+            x = MARGIN + indent
+            if kind == 'li' and number == 0:
+                self.canvas.drawString(MARGIN, self.y, '•')
+            self.canvas.drawString(x, self.y, line)
+            if link:
+                self.canvas.linkURL(link, (x, self.y - 2, x + self.canvas.stringWidth(line, font, size), self.y + size),
+                                    relative=0)
+
+    def save(self):
+        self.canvas.save()
+
+
+def render_text_pdf(title, url, content, links=()):
+    '''
+    Renders a page as a PDF of its text and links, without laying out its HTML.
+    Args:
+      @ title: title of the page, drawn first and set as the document title.
+      @ url: URL of the page, drawn under the title.
+      @ content: the stored body of the page, full HTML or extracted main text.
+      @ links: iterable of (target URL, anchor text) listed at the end.
+    Returns:
+      @ content: bytes of the PDF.
+    '''
+    output = io.BytesIO()
+    pdf = TextPdf(output, title or url)
+    pdf.draw('title', title or url)
+    pdf.draw('url', url, link=url, color=URL_COLOR)
+    for kind, text in iter_blocks(content or ''):
+        pdf.draw(kind, text)
+
+    pdf.draw('h2', 'Links found on this Page')
+    count = 0
+    for target_url, anchor_text in links:
+        text = f'{anchor_text} ({target_url})' if anchor_text else target_url
+        pdf.draw('link', text, link=target_url, color=LINK_COLOR)
+        count += 1
+    if not count:
+        pdf.draw('p', 'No links found.')
+    pdf.save()
+    return output.getvalue()
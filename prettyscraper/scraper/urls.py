@@ -4,6 +4,9 @@ from . import views
 urlpatterns = [
     path('', views.home, name='home'),
     path('scrape/', views.scrape, name='scrape'),
+    path('jobs/<int:job_id>/', views.job_status, name='job_status'),
+    path('jobs/<int:job_id>/events/', views.job_events, name='job_events'),
     path('download/', views.download, name='download'),
     path('verify_user_id/', views.verify_user_id, name='verify_user_id'),
+    path('metrics', views.metrics_view, name='metrics'),
 ]
\ No newline at end of file
@@ -1,11 +1,14 @@
 # Standard Python library imports
+import asyncio
 import csv
 import json
+import logging
 import os
 import io
 from pathlib import Path
-from zipfile import ZipFile
 import re
+from functools import partial
+from itertools import chain
 
 # Imports from Django libraries. 
 from django.shortcuts import render, redirect
@@ -14,30 +17,50 @@ from django.core.exceptions import ValidationError
 from django.core.files import File
 from django.core.files.base import ContentFile
 from django.http import HttpResponse
+from django.http import StreamingHttpResponse
 from django.http import JsonResponse
 from django.contrib import messages
 from django.contrib.auth.models import User
-from django.urls import path
+from django.urls import path, reverse
 from django.template.loader import get_template
-from django.db import transaction
+from django.db.models import Prefetch, Q, prefetch_related_objects
+from django.conf import settings
 
 # Imports from elsewhere
-from bs4 import BeautifulSoup
-from reportlab.pdfgen import canvas
+from asgiref.sync import sync_to_async
 from xhtml2pdf import pisa
 import requests
-from reportlab.pdfgen import canvas
 from urllib.parse import urljoin, urlparse
 
 # Imports from our models.
-from .models import Page
+from .models import CrawlJob, Link, Page, PageBlob, SkippedPage
+
+# Imports from elsewhere in this app.
+from . import metrics
+from .client import HttpClient, SkippedURL
+from .crawler import Crawler
+from .events import get_broadcaster
+from .exports import (GRAPH_TYPES, LINK_TYPES, PAGE_TYPES, POOLED_TYPES, STREAM_TYPES, ArtifactCache,
+                      iterate_in_thread, render_all, stream_graph, stream_records, stream_zip)
+from .extract import extract_main_text
+from .frontier import canonicalize_url
+from .graph import resolve_links
+from .parsers import decode_body, parse_page
+from .politeness import get_robots, parse_retry_after
+from .scope import SCOPES, ScopePolicy
+from .textpdf import render_text_pdf
+from .writer import PageWriter
+
+
+logger = logging.getLogger(__name__)
 
 
 def home(request):
     '''
     Default homepage. 
     '''
-    return render(request, 'home.html')
+    # The main text checkbox starts as the setting, so that leaving it alone keeps the setting.
+    return render(request, 'home.html', {'extract_default': getattr(settings, 'SCRAPER_EXTRACT_MAIN_TEXT', False)})
 
 def verify_user_id(request):
     '''
@@ -49,7 +72,7 @@ def verify_user_id(request):
     data = json.loads(request.body)
     user_id = data.get('scraper_user_id')
     # user_id = request.session['scraper_user_id']
-    print(f'In verify_user_id, we got the ID {user_id}')
+    logger.debug('In verify_user_id, we got the ID %s', user_id)
     if not user_id:
         return JsonResponse({'status': 'error', 'message': 'No User ID provided'})
 
@@ -92,7 +115,7 @@ def get_safe_filename(filename):
     safe_filename = ''.join([char if char not in invalid_char_set else '_' for char in filename])
     safe_filename = re.sub(r'^_+|_+$', '', safe_filename)
     safe_filename = re.sub(r'_{2,}', '_', safe_filename)
-    print(safe_filename)
+    logger.debug('Safe filename: %s', safe_filename)
     if len(safe_filename) >= 255:
         return safe_filename[0:255]
     return safe_filename
@@ -118,117 +141,343 @@ def is_absolute(link):
     '''
     return bool(urlparse(link).netloc)
 
-@transaction.atomic
-def get_and_store_page_content(request, url, parent_url):
+def resolve_link(link, base):
+    '''
+    Returns the absolute URL of a link found on the page served from base.
     '''
-    Creates Page objects that represents content on one webpage.
+    return link if is_absolute(link) else get_absolute_url(base, link)
+
+def get_page_links(links, base):
+    '''
+    Resolves the links found on a page to the canonical URLs the crawler queues.
+    Links to anything but http and https, such as mailto: or javascript:, are dropped.
+    Args:
+      @ links: list of (href value, anchor text) from parse_page.
+      @ base: URL the page was served from.
+    Returns:
+      @ links: list of (canonical URL, anchor text) in page order, one per target,
+        with the first non-empty anchor text of the target.
+    '''
+    targets = {}
+    for href, text in links:
+        try:
+            url = canonicalize_url(resolve_link(href.strip(), base))
+        except ValueError:
+            continue
+        if url.startswith(('http://', 'https://')) and not targets.get(url):
+            targets[url] = text
+    return list(targets.items())
+
+def get_page_content(url, client, previous=None, extract=False):
+    '''
+    Fetches one webpage and extracts its title and links. Safe to call from crawler worker threads,
+    it does not touch the database.
     Args:
-      @ request: Django request object.
       @ url: URL of a webpage. 
-      @ parent: page object from which url is found.
+      @ client: the HttpClient shared by the crawl.
+      @ previous: the Page stored for url by an earlier crawl, if any. Its validators
+        are sent along and the body is not parsed again when it did not change.
+      @ extract: keep only the main readable text of the page instead of the page as served.
     Returns:
-      @ page: One Page object.
-      @ hrefs: a list of URL. 
+      @ fetched: a dict with title, safe_filename, links and content,
+        a dict with unchanged set when previous is still current,
+        or a dict with the reason the page was skipped.
     '''
 
     # Check if URL is valid. 
     is_valid, error_message = validate_url(url)
     if not is_valid:
-        error_message = 'ERROR: URL is not valid.'
-        print(error_message)
-        return None, []
-
-    # Check if page is valid. 
-    response = requests.get(url)
+        return {'skipped': 'URL is not valid'}
+
+    # Check if page is valid. Only HTML pages under the size limit are downloaded.
+    headers = {}
+    if previous is not None and previous.etag:
+        headers['If-None-Match'] = previous.etag
+    if previous is not None and previous.last_modified:
+        headers['If-Modified-Since'] = previous.last_modified
+    try:
+        with metrics.timer('fetch'):
+            response = client.get(url, html_only=True, headers=headers)
+    except SkippedURL as e:
+        return {'skipped': str(e)}
+    except requests.RequestException as e:
+        metrics.inc('scraper_errors_total', stage='fetch')
+        logger.info('Failed to fetch %s: %r', url, e)
+        return {'skipped': f'Failed to get network response: {e.__class__.__name__}'}
+    # Rate limited or overloaded hosts are backed off by the crawler and the page fetched again later.
+    if response.status_code in (429, 503):
+        return {
+            'skipped': f'HTTP {response.status_code}',
+            'throttled': True,
+            'retry_after': parse_retry_after(response.headers.get('Retry-After')),
+        }
+    # Relative links are resolved against the URL the page was served from, after redirects.
+    served = {
+        'base_url': response.url or url,
+        'size': len(response.content),
+        'etag': response.headers.get('ETag'),
+        'last_modified': response.headers.get('Last-Modified'),
+    }
+    if previous is not None and response.status_code == 304:
+        return {'unchanged': True, **served}
     if not response:
-        error_message = 'ERROR: Failed to get network response.'
-        print(error_message)
-        return None, []
-
-    # Use BeautifulSoup to parse response.
-    soup = BeautifulSoup(response.content, 'html.parser')
-    if not soup:
-        error_message = 'ERROR: Failed to parse page content.'
-        print(error_message)
-        return None, []
+        metrics.inc('scraper_errors_total', stage='fetch')
+        return {'skipped': f'HTTP {response.status_code}'}
+    metrics.inc('scraper_bytes_fetched_total', len(response.content))
 
-    # Create and construct safe directory name from page title. 
-    title = soup.find('title').string if soup.title else 'No title available'
-
-    # Process raw filename to get one appropriate for HTTP response header.
-    safe_filename = get_safe_filename(title)
+    # Keep the page as it was served, or only its main text, the title and links are parsed out of the full page.
+    try:
+        with metrics.timer('parse'):
+            html = decode_body(response.content, response.headers.get('Content-Type'))
+        if extract:
+            with metrics.timer('extract'):
+                content = extract_main_text(html)
+        else:
+            content = html
+        with metrics.timer('parse'):
+            # A body identical to the stored one has the same title and links, no need to parse it.
+            if previous is not None and PageBlob.digest(content) == previous.blob_id:
+                return {'unchanged': True, **served}
+            title, links = parse_page(html)
+            links = get_page_links(links, served['base_url'])
+    except Exception as e:
+        metrics.inc('scraper_errors_total', stage='parse')
+        return {'skipped': f'Failed to parse page content: {e}'}
+    metrics.inc('scraper_pages_fetched_total')
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug('Fetched %s: %r with %d links: %s', url, title, len(links), [link for link, _ in links])
+
+    return {
+        'title': title,
+        # Process raw filename to get one appropriate for HTTP response header.
+        'safe_filename': get_safe_filename(title),
+        'links': links,
+        'content': content,
+        # Hash and compress here, in the worker thread, rather than in the storing thread.
+        'packed': PageBlob.pack(content),
+        **served,
+    }
 
-    # Extract links in this page for further scraping
-    hrefs = [a['href'] for a in soup.find_all('a', href=True)]
+def store_page_content(writer, user_id, url, fetched, depth, parent, crawl_job=None, previous=None):
+    '''
+    Creates the Page object that represents content on one webpage.
+    The page and its links are handed to the crawl's PageWriter and written with the next batch.
+    A page kept from an earlier crawl is updated instead, and only if something changed.
+    Args:
+      @ writer: the PageWriter of the crawl.
+      @ user_id: unique identifier of a user.
+      @ url: URL of a webpage. 
+      @ fetched: the dict returned by get_page_content, or None if the fetch raised.
+      @ depth: level of the page in the crawl, the root page being level 1.
+      @ parent: the Page on which url was found, None for the root page.
+      @ crawl_job: the CrawlJob this page belongs to.
+      @ previous: the Page stored for url by an earlier crawl, taken over by this one.
+    Returns:
+      @ page: One Page object.
+      @ hrefs: a list of URL. 
+    '''
+    # Record why a page was not stored.
+    if not fetched or 'skipped' in fetched:
+        writer.skip(SkippedPage(
+            crawl=crawl_job,
+            user_id=user_id,
+            url=url,
+            parent_url=parent.url if parent else None,
+            reason=(fetched['skipped'] if fetched else 'Fetch failed')[:255],
+        ))
+        return None, []
 
-    # Retrieve user ID. 
-    user_id = request.session.get('scraper_user_id')
+    if previous is not None:
+        return update_page_content(writer, previous, fetched, depth, parent)
 
-    # Store Page object in database.
-    page = Page.create(
+    # Queue Page object for the database.
+    page = writer.add(Page.build(
         user_id=user_id,
         url=url,
-        title=title,
-        safe_filename=safe_filename,
-        hrefs=hrefs, 
-        content=str(soup),
-        parent_url=parent_url
+        title=fetched['title'],
+        safe_filename=fetched['safe_filename'],
+        parent_url=parent.url if parent else None,
+        crawl=crawl_job,
+        depth=depth,
+        parent=parent,
+        etag=fetched['etag'],
+        last_modified=fetched['last_modified'],
+    ), fetched['packed'], fetched['links'])
+
+    return page, [link for link, _ in fetched['links']]
+
+def update_page_content(writer, page, fetched, depth, parent):
+    '''
+    Brings a page kept from an earlier crawl up to date. An unchanged page is
+    only written if it moved in the tree or got new validators, and its stored
+    links are followed instead of parsing the page again.
+    Args:
+      @ writer: the PageWriter of the crawl.
+      @ page: the saved Page.
+      @ fetched: the dict returned by get_page_content for it.
+      @ depth: level of the page in this crawl.
+      @ parent: the Page on which it was found in this crawl, None for the root page.
+    Returns:
+      @ page: the same Page object.
+      @ hrefs: a list of URL.
+    '''
+    changed = page.parent_id != (parent.pk if parent else None) or page.depth != depth
+    page.parent = parent
+    page.parent_url = parent.url if parent else None
+    page.depth = depth
+
+    for field in ('etag', 'last_modified'):
+        if fetched[field] and fetched[field] != getattr(page, field):
+            setattr(page, field, fetched[field])
+            changed = True
+
+    if fetched.get('unchanged'):
+        if changed:
+            writer.update(page)
+        return page, list(page.outlinks.order_by('id').values_list('target_url', flat=True))
+
+    page.title = fetched['title']
+    page.safe_filename = fetched['safe_filename']
+    writer.update(page, fetched['packed'], fetched['links'])
+    return page, [link for link, _ in fetched['links']]
+
+def take_over_previous_crawl(user_id, root_url, crawl_job, extract=False):
+    '''
+    Moves the pages of the latest finished crawl of root_url by this user to crawl_job,
+    so that re-crawling the site only has to write what changed. Only a crawl that
+    stored pages the same way is taken over: a page answering 304 keeps its body,
+    which must not be the full page when the main text is wanted or the other way round.
+    Args:
+      @ user_id: unique identifier of a user.
+      @ root_url: canonical URL of the root webpage.
+      @ crawl_job: the CrawlJob being run.
+      @ extract: whether crawl_job stores the main text of pages.
+    Returns:
+      @ known: dict of canonical URL to the Page taken over, or stored by an earlier attempt of crawl_job.
+    '''
+    same_mode = Q(crawl__extract_text=extract)
+    if not extract:
+        # Crawls from before the extraction mode was recorded stored full pages.
+        same_mode |= Q(crawl__extract_text__isnull=True)
+    root_page = (
+        Page.objects.filter(same_mode, user_id=user_id, url=root_url, parent__isnull=True, crawl__isnull=False)
+        .exclude(crawl=crawl_job)
+        .exclude(crawl__status=CrawlJob.RUNNING)
+        .order_by('-id')
+        .first()
     )
+    if root_page:
+        Page.objects.filter(crawl_id=root_page.crawl_id).update(crawl=crawl_job)
+    # Pages an earlier attempt of the job stored before its worker died are revalidated as well.
+    return {page.url: page for page in Page.objects.filter(crawl=crawl_job)}
 
-    print(f'saved page {page.safe_filename} in database! url: {page.url}, parent: {page.parent_url}')
-    return page, hrefs
+def record_extract_mode(crawl_job, extract):
+    '''
+    Stores on the job whether its pages hold their main text, for a later re-crawl to compare.
+    '''
+    if crawl_job.extract_text != extract:
+        crawl_job.extract_text = extract
+        CrawlJob.objects.filter(pk=crawl_job.pk).update(extract_text=extract)
 
-def recursive_scrape(request, base, url, max_depth, curr_depth, parent_url):
+def crawl(user_id, url, max_depth, progress=None, crawl_job=None, incremental=None, scope=None, extract=None):
     '''
-    This function recursively get page content from a URL.
-    It should collect to all URL present a current page and traverse to those links.
-    Later I want to store them in a structured thing.... But now we can just append. 
-    TODO: Can we add a detect add functionality, so that we rule out those links.
-    TODO: Notify user that this URL is not valid on frontend. We can do all this later.
+    Crawls a URL and the pages it links to with the concurrent crawl engine.
+    Fetches run in a thread pool, pages are stored from the calling thread.
+    An earlier crawl of the same root by the same user is re-crawled in place:
+    its pages are revalidated, and only new, changed and removed pages are written.
+    Args:
+      @ user_id: unique identifier of a user.
+      @ url: URL of the root webpage.
+      @ max_depth: number of levels to crawl, the root page being level 1.
+      @ progress: optional callable receiving the crawler's stats as pages complete.
+      @ crawl_job: the CrawlJob the pages are stored under.
+      @ incremental: re-crawl an earlier crawl in place, defaults to settings.SCRAPER_INCREMENTAL.
+      @ scope: the ScopePolicy deciding which links are followed, defaults to one built from settings.
+      @ extract: store the main text of pages rather than their full HTML,
+        defaults to settings.SCRAPER_EXTRACT_MAIN_TEXT.
     Returns:
-      @ Boolean. 
-    '''
-    # If we have gone through all files, return True to indicates that files are ready. 
-    if curr_depth > max_depth:
-        print("ALERT: max depth reached")
-        return True
-
-    # Get main page contents and all URL it links to, it is also stored in database.
-    page, hrefs = get_and_store_page_content(request, url, parent_url)
-    if not page:
-        print('Alert! get page returned none from get and store page')
-        return False
-
-    print(f'hey we found the links on your current webpage: {hrefs}')
-
-    if curr_depth < max_depth:
-        # Find all URLs on page and create page for them. 
-        for link in hrefs:
-            if not is_absolute(link):
-                link = get_absolute_url(base, link)
-                print(f'absolute link {link}')
-            # Here we can set the current Page object as the parent of the next one.
-            ret = recursive_scrape(request, base, link, max_depth, curr_depth + 1, page.url)
-    else:
-        print("ALERT: we end at current level")
-    return True
+      @ Boolean: whether the root page was stored.
+    '''
+    if incremental is None:
+        incremental = getattr(settings, 'SCRAPER_INCREMENTAL', True)
+    if extract is None:
+        extract = getattr(settings, 'SCRAPER_EXTRACT_MAIN_TEXT', False)
+    if crawl_job is not None:
+        record_extract_mode(crawl_job, extract)
+    known = take_over_previous_crawl(user_id, url, crawl_job, extract) if incremental and crawl_job else {}
+    if crawl_job is not None and not incremental:
+        # Pages of an earlier attempt of the job, whose worker died.
+        Page.objects.filter(crawl=crawl_job).delete()
+    reached = set()
+    unchanged = 0
+
+    # One pooled client for the whole crawl keeps connections to each host alive,
+    # one writer batches every page of the crawl into a few bulk inserts.
+    with HttpClient() as client, PageWriter() as writer:
+
+        def store(page_url, fetched, depth, parent):
+            nonlocal unchanged
+            previous = known.get(page_url)
+            page, hrefs = store_page_content(writer, user_id, page_url, fetched, depth, parent, crawl_job, previous)
+            if page is not None and previous is not None:
+                reached.add(previous.pk)
+                if fetched.get('unchanged'):
+                    unchanged += 1
+                    metrics.inc('scraper_pages_unchanged_total')
+            return page, hrefs
+
+        crawler = Crawler(
+            fetch=lambda page_url: get_page_content(page_url, client, known.get(page_url), extract),
+            store=store,
+            resolve=resolve_link,
+            progress=progress,
+            flush=writer.maybe_flush,
+            flush_interval=writer.flush_interval,
+            fetch_robots=lambda page_url: get_robots(page_url, client),
+            scope=scope or ScopePolicy(url),
+        )
+        root_stored = crawler.crawl(url, max_depth)
+        if client.cache is not None:
+            logger.info('HTTP cache: %s', client.cache.stats)
+    logger.info('Stored %d pages with %d links and updated %d (%d unchanged) in %d batches',
+                writer.written, writer.links, writer.updated, unchanged, writer.flushes)
+
+    # Pages of the earlier crawl that were not found again are gone from the site.
+    # They are kept when the root could not be fetched, the site may just be down.
+    if root_stored:
+        stale = [page.pk for page in known.values() if page.pk not in reached]
+        for start in range(0, len(stale), 500):
+            Page.objects.filter(pk__in=stale[start:start + 500]).delete()
+    if crawl_job is not None:
+        crawl_job.pages_unchanged = unchanged
+        resolve_links(crawl_job)
+    return root_stored
         
-@transaction.atomic
-def scrape(request):
+async def scrape(request):
     '''
-    Handles scrape requests.
+    Handles scrape requests by queueing a crawl job for the crawl_worker command.
+    Async, like the events and download views, so that it does not hold a thread under ASGI.
     Args:
       @ request: Django request object.
     Returns:
-      @ response: 
+      @ response: JSON with the id of the queued job and the URL of its progress events.
     '''
     if request.method == 'POST':
 
         # Get URL from session of the webpage that user wants to scrape.
         url = request.POST.get('input_url', None)
 
+        # Check if URL is valid. 
+        is_valid, error_message = validate_url(url)
+        if not is_valid:
+            return JsonResponse({'status': 'error', 'message': error_message}, status=400)
+
+        # The crawler stores pages under their canonical URL, so the root is looked up by it too.
+        url = canonicalize_url(url)
+
         # Set this URL as the root of this session (since it could be the parent of more webpages)
-        request.session['root_url'] = url 
+        await request.session.aset('root_url', url)
+        await request.session.aset('files_ready', 'False')
 
         # Get recursion depth from session. 
         max_depth = request.POST.get('depth', 1)
@@ -236,116 +485,316 @@ def scrape(request):
             max_depth = 1
         max_depth = int(max_depth)
 
-        # Set a base url for links that are partial. 
-        base_url = url
-
-        # Parent page should be None the first time recursive_scrape is called
-        files_ready = recursive_scrape(request, base_url, url, max_depth, 1, None)
-        if files_ready:
-            request.session['files_ready'] = 'True'
-        else:
-            request.session['files_ready'] = 'False'
-
-        # return render(request, 'home.html')
-        return JsonResponse({'filesReady': files_ready})
+        # Which links the crawl follows, and how many pages it may store at most.
+        scope = request.POST.get('scope') or ''
+        if scope and scope not in SCOPES:
+            return JsonResponse({'status': 'error', 'message': f'Unknown crawl scope {scope}'}, status=400)
+        max_pages = request.POST.get('max_pages') or None
+        if max_pages is not None:
+            try:
+                max_pages = int(max_pages)
+            except ValueError:
+                max_pages = 0
+            if max_pages < 1:
+                return JsonResponse({'status': 'error', 'message': 'Max pages must be a positive number'}, status=400)
+        # Whether to keep only the main text of pages, left to the settings when the form does not say.
+        extract = request.POST.get('extract') or None
+        if extract is not None:
+            extract = extract.lower() in ('1', 'true', 'on')
+
+        # Queue the crawl, a worker picks it up and the browser polls job_status.
+        job = await CrawlJob.objects.acreate(
+            user_id=await request.session.aget('scraper_user_id'),
+            root_url=url,
+            max_depth=max_depth,
+            scope=scope,
+            max_pages=max_pages,
+            extract_text=extract,
+            distributed=getattr(settings, 'SCRAPER_DISTRIBUTED', False),
+        )
+        return JsonResponse({'status': 'queued', 'jobId': job.pk, 'events': reverse('job_events', args=[job.pk])})
         
     else:
 
-        return render(request, 'home.html')
+        # The template reads the session, which is not loaded from async code.
+        return await sync_to_async(render)(request, 'home.html')
+
+def job_status(request, job_id):
+    '''
+    Reports the progress of one crawl job of the current user.
+    Args:
+      @ request: Django request object.
+      @ job_id: primary key of a CrawlJob.
+    Returns:
+      @ response: JSON with status, pages fetched/queued/failed and elapsed seconds.
+    '''
+    user_id = request.session.get('scraper_user_id')
+    job = CrawlJob.objects.filter(pk=job_id, user_id=user_id).first()
+    if not job:
+        return JsonResponse({'status': 'error', 'message': 'No such job'}, status=404)
+
+    if job.status == CrawlJob.DONE and request.session.get('root_url') == job.root_url:
+        request.session['files_ready'] = 'True'
+
+    return JsonResponse(get_job_progress(job))
+
+def get_job_progress(job):
+    '''
+    Returns the progress of a crawl job as reported to the browser.
+    '''
+    return {
+        'status': job.status,
+        'pagesFetched': job.pages_fetched,
+        'pagesQueued': job.pages_queued,
+        'pagesInFlight': job.pages_in_flight,
+        'pagesFailed': job.pages_failed,
+        'pagesUnchanged': job.pages_unchanged,
+        'elapsed': round(job.elapsed(), 1),
+        'error': job.error,
+        'filesReady': job.status == CrawlJob.DONE,
+    }
+
+def format_event(event, data):
+    '''
+    Formats one Server-Sent Event with a JSON payload.
+    '''
+    return f'event: {event}\ndata: {json.dumps(data)}\n\n'.encode('utf-8')
+
+async def job_events(request, job_id):
+    '''
+    Streams the progress of one crawl job of the current user as Server-Sent Events.
+    A 'progress' event is sent whenever the job row changes and a final 'done' or
+    'failed' event when it finishes, then the stream ends. Waiting costs no thread
+    under ASGI, and the job row is read by the shared JobBroadcaster every
+    settings.SCRAPER_EVENTS_INTERVAL seconds, once for all clients watching it.
+    Args:
+      @ request: Django request object.
+      @ job_id: primary key of a CrawlJob.
+    Returns:
+      @ response: a text/event-stream streaming response.
+    '''
+    user_id = await request.session.aget('scraper_user_id')
+    job = await CrawlJob.objects.filter(pk=job_id, user_id=user_id).afirst()
+    if not job:
+        return JsonResponse({'status': 'error', 'message': 'No such job'}, status=404)
+    root_url = await request.session.aget('root_url')
+    keepalive = getattr(settings, 'SCRAPER_EVENTS_KEEPALIVE', 15.0)
+
+    async def events():
+        broadcaster = get_broadcaster()
+        queue = broadcaster.subscribe(job)
+        last, quiet = None, 0.0
+        try:
+            # Tells the browser how long to wait before reconnecting if the stream drops.
+            yield f'retry: {int(broadcaster.interval * 1000)}\n\n'.encode('utf-8')
+            while True:
+                try:
+                    current = await asyncio.wait_for(queue.get(), timeout=keepalive)
+                except asyncio.TimeoutError:
+                    # The job rows could not be read for a while.
+                    yield b': keepalive\n\n'
+                    continue
+                if current is None:
+                    return
+                progress = get_job_progress(current)
+                if current.status in (CrawlJob.DONE, CrawlJob.FAILED):
+                    # The session was saved with the response headers, save it again now that the files are ready.
+                    if current.status == CrawlJob.DONE and root_url == current.root_url:
+                        await request.session.aset('files_ready', 'True')
+                        await request.session.asave()
+                    yield format_event(current.status, progress)
+                    return
+                if progress != last:
+                    yield format_event('progress', progress)
+                    last, quiet = progress, 0.0
+                elif quiet >= keepalive:
+                    # A comment line keeps proxies from closing an idle stream.
+                    yield b': keepalive\n\n'
+                    quiet = 0.0
+                quiet += broadcaster.interval
+        finally:
+            broadcaster.unsubscribe(job.pk, queue)
+
+    response = StreamingHttpResponse(events(), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    # Proxies such as nginx would otherwise hold the events back until their buffer is full.
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+def metrics_view(request):
+    '''
+    Serves crawl and export metrics of this server and of the crawl workers,
+    in the Prometheus text format.
+    Args:
+      @ request: Django request object.
+    Returns:
+      @ response: plain text counters and stage duration histograms.
+    '''
+    return HttpResponse(metrics.collect().render(), content_type='text/plain; version=0.0.4; charset=utf-8')
 
-def retrieve_all_pages(user_id, root_url):
+def retrieve_all_pages(user_id, root_url, links=False):
     '''
-    Retrieves all files linked to the root page.
+    Retrieves all files linked to the root page, from the latest crawl of root_url.
     Args:
       @ user_id: unqiue identifier of a user.
       @ root_url: URL of the webpage a user entered.
+      @ links: also load the links of every page, in page order, with one query per chunk of pages.
     Returns:
-      @ root_page, [pages]: a pair of root_page and all other pages. 
+      @ root_page, pages: the root_page and a lazy iterator over it and all its descendants. 
     '''
 
-    print(f"Retrieving pages for user ID: {user_id} with root URL: {root_url}")
+    logger.debug('Retrieving pages for user ID: %s with root URL: %s', user_id, root_url)
 
     # Get root page. 
-    root_page = Page.objects.filter(user_id=user_id, url=root_url, parent_url__isnull=True).first()
+    root_page = Page.objects.filter(user_id=user_id, url=root_url, parent__isnull=True).order_by('-id').first()
     if not root_page:
-        print(f"ALERT: No root page found in the database for URL {root_url}")
-        return None, []
+        logger.warning('No root page found in the database for URL %s', root_url)
+        return None, iter([])
     
-    print(f"Root page found: {root_page}")
-    # Get not only the direct children but grandchildren pages, etc. 
-    pages = root_page.get_all_children()
-    if not pages:
-        print(f'There is no pages associated with this root page.')
-
-    print(f"Total pages linked to root page (including all descendants): {len(pages)}")
-    for page in pages:
-        print(f"Linked page: {page.title} at {page.url}")
+    logger.debug('Root page found: %s', root_page)
+    # The whole tree comes from one indexed query and is streamed so that only one page is held in memory at a time.
+    # Bodies are joined in because every exporter needs them, and render processes can not query.
+    pages = root_page.get_descendants().select_related('blob').order_by('depth', 'id')
+    if links:
+        outlinks = Prefetch('outlinks', queryset=Link.objects.order_by('id'))
+        prefetch_related_objects([root_page], outlinks)
+        # Links are loaded per chunk of pages, with an IN list short enough for any SQLite.
+        return root_page, chain([root_page], pages.prefetch_related(outlinks).iterator(chunk_size=500))
+    return root_page, chain([root_page], pages.iterator())
+
+def render_page(page, download_type):
+    '''
+    Generates one file based on chosen download type. 
+    Args:
+      @ page: one Page object.
+      @ download_type: one of PAGE_TYPES.
+    Returns:
+      @ content: bytes of the file.
+    '''
+    match download_type:
+        case 'pdf':
+            return generate_pdf(page)
+        case 'pdf-fast':
+            return generate_fast_pdf(page)
+        case 'csv':
+            return generate_csv(page)
+        case 'json':
+            return generate_json(page)
+    raise ValueError(f'Unknown download type {download_type}')
+
+def render_pages(pages, download_type):
+    '''
+    Renders the pages of a zip download, through the artifact cache when it is on.
+    Runs in the thread streaming the download, which opens the cache index and closes it when done.
+    Args:
+      @ pages: iterable of Page objects.
+      @ download_type: one of PAGE_TYPES.
+    Yields:
+      @ (page, content, error) from render_all.
+    '''
+    cache = ArtifactCache(download_type) if getattr(settings, 'SCRAPER_ARTIFACT_CACHE', False) else None
+    # PDFs are spread over the render pool, the cheaper types rendered in place.
+    processes = None if download_type in POOLED_TYPES else 1
+    try:
+        yield from render_all(partial(render_page, download_type=download_type), pages, processes=processes,
+                              cache=cache)
+    finally:
+        if cache is not None:
+            cache.close()
 
-    print(f'returning root {root_page} and all {pages}')
-    return root_page, [root_page] + pages
+def export_entries(root_page, download_type, rendered):
+    '''
+    Names the rendered pages for the zip archive.
+    A page that failed to render is replaced by a text file saying why.
+    Args:
+      @ root_page: the root Page of the crawl.
+      @ download_type: one of PAGE_TYPES.
+      @ rendered: iterable of (page, content, error) from render_all.
+    Yields:
+      @ (filename, content bytes).
+    '''
+    for page, content, error in rendered:
+
+        # Generate one filename with folder. 
+        filename = f'{root_page.safe_filename}/{page.safe_filename}.{PAGE_TYPES[download_type]}'
+        if error:
+            metrics.inc('scraper_errors_total', stage='render')
+            logger.error('Failed to render %s: %s', page.url, error)
+            yield f'{filename}.error.txt', f'Could not render {page.url}: {error}'.encode('utf-8')
+        else:
+            metrics.inc('scraper_pages_rendered_total', type=download_type)
+            metrics.inc('scraper_bytes_rendered_total', len(content), type=download_type)
+            yield filename, content
 
-def download(request):
+async def download(request):
     '''
     A django view to zip files in directory and send it as downloadable response to the browser.
+    The archive is streamed, each page is rendered, written to the zip and dropped.
+    The ndjson and crawl-csv types send the whole crawl as one file instead of a zip.
+    The view is async, the blocking reads and renders run in one thread per download.
     Args:
       @request: Django request object
-      @file_name: Name of the directory to be zipped
     Returns:
-      A downloadable Http response
+      A downloadable streaming Http response
     '''
 
     if request.method == 'POST':
 
         # Get user ID and root_file URL from session. 
-        user_id = request.session.get('scraper_user_id')
-        root_url = request.session.get('root_url', None)
+        user_id = await request.session.aget('scraper_user_id')
+        root_url = await request.session.aget('root_url', None)
         if not root_url:
-            print(f'ERROR: You entered an empty URL and tried to download nothing.')
+            logger.warning('You entered an empty URL and tried to download nothing.')
 
-        # Retrieve all files associated with this user ID and root_file URL. 
-        root_page, all_pages = retrieve_all_pages(user_id, root_url)
-        if not root_page:
-            print('@@@@@@@@1@@@@@@@@')
-        if not all_pages[1:]:
-            print('@@@@@@@@2@@@@@@@@')
-        
-        print('@@@@@@@@3@@@@@@@@')
-        
         # Get download type from session. 
         download_type = request.POST.get('download_type')
+        if download_type not in PAGE_TYPES | STREAM_TYPES | GRAPH_TYPES:
+            return HttpResponse(f'Unknown download type {download_type}', status=400)
+
+        # Retrieve all files associated with this user ID and root_file URL. PDFs list the links of their page.
+        root_page, all_pages = await sync_to_async(retrieve_all_pages)(user_id, root_url,
+                                                                      links=download_type in LINK_TYPES)
+        if not root_page:
+            await request.session.aset('files_ready', 'False')
+            return await sync_to_async(render)(request, 'home.html', status=404)
+
+        # The link graph of the crawl comes straight from the link table, as one file.
+        if download_type in GRAPH_TYPES:
+            if root_page.crawl_id is None:
+                return HttpResponse('This crawl has no link graph', status=404)
+            content_type, extension = GRAPH_TYPES[download_type]
+            response = StreamingHttpResponse(iterate_in_thread(stream_graph(download_type, root_page.crawl_id)),
+                                             content_type=content_type)
+            response['Content-Disposition'] = f'attachment; filename="{root_page.safe_filename}.{extension}"'
+            await request.session.aset('files_ready', 'False')
+            return response
+
+        # Whole-crawl types are one file with a record per page, encoded as the pages are read.
+        if download_type in STREAM_TYPES:
+            content_type, extension = STREAM_TYPES[download_type]
+            chunks = stream_records(download_type, all_pages)
+            response = StreamingHttpResponse(iterate_in_thread(chunks), content_type=content_type)
+            response['Content-Disposition'] = f'attachment; filename="{root_page.safe_filename}.{extension}"'
+            await request.session.aset('files_ready', 'False')
+            return response
 
         # Generate zip filename from root_page name and download type. 
         zip_filename = f'({download_type}) {root_page.safe_filename}.zip'
 
+        # Each zip entry is rendered only when the response asks for the next chunk.
+        entries = export_entries(root_page, download_type, render_pages(all_pages, download_type))
+
         # Create a downloadable zip-typ HTTP response. 
-        response = HttpResponse(content_type='application/zip')
+        response = StreamingHttpResponse(iterate_in_thread(stream_zip(entries)), content_type='application/zip')
         response['Content-Disposition'] = f'attachment; filename="{zip_filename}"'
-
-        with ZipFile(response, 'w') as zf:
-            for page in all_pages:
-
-                # Generate one filename with folder. 
-                filename = f'{root_page.safe_filename}/{page.safe_filename}.{download_type}'
-                
-                # Generate one file based on chosen download type. 
-                match download_type:
-                    case 'pdf':
-                        content = generate_pdf(page)
-                    case 'csv':
-                        content = generate_csv(page)
-                    case 'json':
-                        content = generate_json(page)
-                
-                zf.writestr(filename, content)
         
-        request.session['files_ready'] = 'False'
-        render(request, 'home.html')
+        await request.session.aset('files_ready', 'False')
         return response
 
     else:
 
-        request.session['files_ready'] = 'False'
-        return render(request, 'home.html')
+        await request.session.aset('files_ready', 'False')
+        return await sync_to_async(render)(request, 'home.html')
 
 def generate_pdf(page):
     '''
@@ -361,8 +810,7 @@ def generate_pdf(page):
 
     # Create the PDF object, using the buffer as its 'file.'
     template = get_template('pdf_result.html')
-    links_found = page.hrefs if page.hrefs else f'No links found.'
-    html = template.render({ 'content': page.content, 'hrefs': links_found })
+    html = template.render({ 'content': page.content, 'links': page.outlinks.all() })
     pisa_status = pisa.CreatePDF(html, dest=pdf_buffer, encoding='utf-8')
 
     pdf_buffer.seek(0)
@@ -372,6 +820,18 @@ def generate_pdf(page):
     
     return pdf_buffer.getvalue()
 
+def generate_fast_pdf(page):
+    '''
+    Generates the fast PDF download type: the text, headings and links of the page
+    drawn directly with reportlab, without laying out its HTML like generate_pdf.
+    Args: 
+      @ page: one Page object. 
+    Returns:
+      @ content: bytes of the PDF.
+    '''
+    links = [(link.target_url, link.anchor_text) for link in page.outlinks.all()]
+    return render_text_pdf(page.title, page.url, page.content, links)
+
 def generate_csv(page):
     '''
     Generates CSV download type.
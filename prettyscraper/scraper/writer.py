@@ -0,0 +1,158 @@
+'''
+Batched persistence of crawled pages.
+
+The thread that runs a crawl is the only one writing to the database. Instead
+of an INSERT (and a blob lookup) per page, stored pages are buffered and
+written with bulk_create every SCRAPER_WRITE_BATCH_SIZE pages or
+SCRAPER_WRITE_FLUSH_MS milliseconds, whichever comes first. Pages kept from an
+earlier crawl and changed since are updated in the same batches. The links
+found on a page are inserted right after it, into the Link table.
+'''
+import time
+
+from django.conf import settings
+from django.db import connection, transaction
+
+from . import metrics
+from .models import Link, Page, PageBlob, SkippedPage
+
+
+# Columns an incremental crawl may change on a page it keeps.
+UPDATE_FIELDS = ['title', 'safe_filename', 'blob', 'etag', 'last_modified', 'parent', 'parent_url', 'depth']
+
+# Rows per statement when deleting the links of updated pages, under SQLite's variable limit.
+DELETE_BATCH_SIZE = 500
+
+
+class PageWriter:
+    '''
+    Buffers unsaved pages and their bodies and inserts them in bulk.
+    Use it as a context manager so that the last batch is written on exit.
+    Args:
+      @ batch_size: number of buffered pages that triggers a flush.
+      @ flush_ms: milliseconds after which a non-empty buffer is flushed anyway.
+    '''
+
+    def __init__(self, batch_size=None, flush_ms=None):
+        self.batch_size = batch_size or getattr(settings, 'SCRAPER_WRITE_BATCH_SIZE', 100)
+        self.flush_interval = (flush_ms or getattr(settings, 'SCRAPER_WRITE_FLUSH_MS', 500)) / 1000
+        self.flushes = 0
+        self.written = 0
+        self.updated = 0
+        self.links = 0
+        self._pages = []
+        self._updates = {}
+        self._links = []
+        self._relinked = []
+        self._blobs = {}
+        self._skipped = []
+        self._last_flush = time.monotonic()
+
+    def add(self, page, packed=None, links=()):
+        '''
+        Buffers a page built with Page.build, its packed body and the links found on it.
+        The page may be used as the parent of later pages before it is written.
+        Args:
+          @ links: list of (canonical URL, anchor text), one per target.
+        '''
+        if packed is not None:
+            content_hash, data, size = packed
+            page.blob_id = content_hash
+            self._blobs.setdefault(content_hash, PageBlob(hash=content_hash, data=data, size=size))
+        self._pages.append(page)
+        if links:
+            self._links.append((page, links))
+        if len(self._pages) >= self.batch_size:
+            self.flush()
+        return page
+
+    def update(self, page, packed=None, links=None):
+        '''
+        Buffers the new state of a saved page, and its new body if it has one.
+        Links given replace the ones stored for the page, None keeps them.
+        '''
+        if packed is not None:
+            content_hash, data, size = packed
+            page.blob_id = content_hash
+            self._blobs.setdefault(content_hash, PageBlob(hash=content_hash, data=data, size=size))
+        if links is not None:
+            self._links.append((page, links))
+            self._relinked.append(page.pk)
+        self._updates[page.pk] = page
+        if len(self._pages) + len(self._updates) >= self.batch_size:
+            self.flush()
+        return page
+
+    def skip(self, skipped_page):
+        '''
+        Buffers an unsaved SkippedPage, written with the next batch of pages.
+        '''
+        self._skipped.append(skipped_page)
+
+    def maybe_flush(self):
+        '''
+        Flushes the buffer if it has been waiting for longer than the flush interval.
+        '''
+        if (self._pages or self._updates or self._skipped) and time.monotonic() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        '''
+        Writes every buffered page in one transaction.
+        Pages are inserted one depth level at a time, so that parents have their
+        primary key by the time their children are inserted, and updated after
+        that, as their new parent may be one of the inserted pages. Their links
+        go in last, once every source page has its primary key.
+        '''
+        self._last_flush = time.monotonic()
+        if not self._pages and not self._updates and not self._skipped:
+            return
+        pages, self._pages = self._pages, []
+        updates, self._updates = list(self._updates.values()), {}
+        blobs, self._blobs = list(self._blobs.values()), {}
+        skipped, self._skipped = self._skipped, []
+        links, self._links = self._links, []
+        relinked, self._relinked = self._relinked, []
+
+        with metrics.timer('persist'), transaction.atomic():
+            # Bodies are content-addressed, one that is already stored is simply skipped.
+            PageBlob.objects.bulk_create(blobs, ignore_conflicts=True)
+
+            if connection.features.can_return_rows_from_bulk_insert:
+                levels = {}
+                for page in pages:
+                    levels.setdefault(page.depth, []).append(page)
+                for depth in sorted(levels):
+                    Page.objects.bulk_create(levels[depth])
+            else:
+                for page in pages:
+                    page.save()
+
+            if updates:
+                Page.objects.bulk_update(updates, UPDATE_FIELDS, batch_size=self.batch_size)
+
+            # Updated pages whose body changed were parsed again, their old links go.
+            for start in range(0, len(relinked), DELETE_BATCH_SIZE):
+                Link.objects.filter(source_id__in=relinked[start:start + DELETE_BATCH_SIZE]).delete()
+            rows = [
+                Link(source=page, target_url=url, anchor_text=text[:255])
+                for page, page_links in links for url, text in page_links
+            ]
+            Link.objects.bulk_create(rows)
+
+            SkippedPage.objects.bulk_create(skipped)
+
+        self.flushes += 1
+        self.written += len(pages)
+        self.updated += len(updates)
+        self.links += len(rows)
+        metrics.inc('scraper_pages_stored_total', len(pages))
+        metrics.inc('scraper_pages_updated_total', len(updates))
+        metrics.inc('scraper_pages_skipped_total', len(skipped))
+        metrics.inc('scraper_links_stored_total', len(rows))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.flush()